@@ -1,15 +1,39 @@
-import unittest
+import shutil
 import statistics
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
 from pathlib import Path
 # Dependency Imports
 from pyfaidx import Fasta
+import numpy
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 # THExBuilder Imports
-from thexb.STAGE_minifastas import get_seq
+from thexb.STAGE_minifastas import get_seq, parse_chromosome_into_windows
 from thexb.STAGE_pairwise_estimator import coverage_and_median
-from thexb.STAGE_pairwise_estimator import p_distance
-from thexb.STAGE_pairwise_filter import Mean, Median, StandardDeviation
+from thexb.STAGE_pairwise_estimator import intervals_are_stable, p_distance, window_statistics
+from thexb.STAGE_pairwise_filter import CalculatePairwiseDeletionDistanceForAlignedSeqsComparedToRefSeq, FormatMatrixOfNucleotideSeqsToFasta, MaskAlignedMatrixAndCalculatePercentCoverage, Mean, Median, SplitAlignedSeqsIntoWindows, StandardDeviation, SubWindowPairwiseDeletionDistances
 from thexb.STAGE_iqtree import remove_heterotachy_info as rhi
+from thexb.STAGE_iqtree import allocate_threads, calibrate_seconds_per_cell, iqtree_batch_task, make_batches, run_with_cache, window_shape
 from thexb.STAGE_iqtree_external import remove_heterotachy_info as rhie
+from thexb.TOOL_root_TreeViewer_file import root_TreeViewer_file
+from thexb.UTIL_file_reader import read_file_to_df, read_treeviewer_file, write_treeviewer_file
+from thexb.UTIL_iqtree_cache import IQTreeCache
+from thexb.UTIL_iqtree_models import choose_model, is_model_selection, model_finder_only, model_regions, read_best_model, region_signature, sample_windows
+from thexb.UTIL_gap_trimmer import allowed_gaps, compare_trimmed_windows, trim_alignment, trim_window
+from thexb.UTIL_encoding import CodeMatrix, ascii_codes, decode, encode, is_gap, is_letter, is_missing, is_unambiguous, mismatch, pack, unpack
+from thexb.UTIL_topology_hash import bin_topologies, cluster_topologies, topology_signature
+from thexb.UTIL_tree_arrays import parse_tree_column, tree_arrays
+from thexb.UTIL_scheduler import TaskResult, WindowTask, can_backfill, reservation, run_task, schedule_threaded_tasks, stream_chromosomes
+from thexb.UTIL_run_manifest import DROPPED, VALID, RunManifest, WindowRecord, is_dropped, previously_dropped, window_files
+from thexb.UTIL_window_archive import WindowArchive, WindowArchiveWriter, pack_window_dir
+from thexb.UTIL_alignment_store import LazyAlignmentStore, build_alignment_store, decode_sites, open_alignment_store, open_lazy_alignment_store, store_code_matrix
+from thexb.STAGE_pdistance_calculator import divide_windows_into_chunks, generate_windows, get_row_labels, iter_file_dfs, iter_file_tasks, pairwise_pi, process_chunk, process_file, process_matrix_chunk
 
 class TestTHExBuilder(unittest.TestCase):
     ########## Fasta Windower ##########
@@ -32,8 +56,59 @@ class TestTHExBuilder(unittest.TestCase):
         self.assertEqual(len(er1[0]), 20)
         self.assertEqual(len(er2[0]), 15)
         return
+
+    def test_minifasta_parse_chromosome_into_windows(self):
+        # -- Test inputs --
+        tmp_dir = tempfile.TemporaryDirectory()
+        test_file = Path(shutil.copy("src/tests/data/gap_seq.fasta", tmp_dir.name))
+        # -- Test Results --
+        with Fasta(test_file.as_posix()) as fh:
+            test_seqs = {s: fh[s][:].seq for s in fh.keys()}
+        test_windows = {
+            f"gap-seq_{s + 1}_{s + 50}.fasta": "".join(f">{k}\n{v[s:s + 50]}\n" for k, v in test_seqs.items())
+            for s in (0, 50)
+        }
+        # -- Module Results --
+        parse_chromosome_into_windows(test_file, Path(tmp_dir.name), 50)
+        windowed_outdir = Path(tmp_dir.name) / "windowed_fastas" / "gap_seq"
+        windows = {f.name: f.read_text() for f in windowed_outdir.iterdir()}
+        tmp_dir.cleanup()
+        # -- Assert results are valid --
+        self.assertDictEqual(windows, test_windows)
     
     
+    ########## Trimal ##########
+    def test_trimal_native_gap_trimmer(self):
+        # -- Test inputs --
+        tmp_dir = tempfile.TemporaryDirectory()
+        test_window = ">S1\nAC-Tg-\n>S2\nACGTg-\n>S3\nA--Tg-\n>S4\nACGTgA\n"
+        test_unaligned = ">S1\nACGT\n>S2\nACG\n"
+        test_all_gaps = ">S1\n--\n>S2\n--\n"
+        # -- Test Results --
+        test_allowed = [1, 1, 0, 4]
+        test_trimmed = {"S1": "ACTg", "S2": "ACTg", "S3": "A-Tg", "S4": "ACTg"}
+        # -- Module Results --
+        allowed = [allowed_gaps(10, 0.9), allowed_gaps(4, 0.75), allowed_gaps(4, 0.9), allowed_gaps(4, 0.0)]
+        trimmed = trim_alignment(test_window, 0.75)
+        trimmed = {s: row.tobytes().decode("ascii") for s, row in zip(trimmed.samples, trimmed.matrix)}
+        unaligned = trim_alignment(test_unaligned, 0.9)
+        all_gaps = trim_alignment(test_all_gaps, 0.9)
+        window = Path(tmp_dir.name) / "chr1_1_6.fasta"
+        window.write_text(test_window)
+        written = trim_window(window, Path(tmp_dir.name) / "native.fasta", 0.75)
+        (Path(tmp_dir.name) / "trimal.fasta").write_text(">S1\nACTg\n>S2\nACTg\n>S3\nA-Tg\n>S4\nACTg\n")
+        same = compare_trimmed_windows(Path(tmp_dir.name) / "trimal.fasta", Path(tmp_dir.name) / "native.fasta")
+        different = compare_trimmed_windows(window, Path(tmp_dir.name) / "native.fasta")
+        tmp_dir.cleanup()
+        # -- Assert results are valid --
+        self.assertListEqual(allowed, test_allowed)
+        self.assertDictEqual(trimmed, test_trimmed)
+        self.assertIsNone(unaligned)
+        self.assertIsNone(all_gaps)
+        self.assertIsNotNone(written)
+        self.assertIsNone(same)
+        self.assertIsNotNone(different)
+
     ########## Pairwise Estimator ##########
     def test_pwe_coverage_and_median(self):
         # -- Test inputs --
@@ -61,6 +136,25 @@ class TestTHExBuilder(unittest.TestCase):
         self.assertDictEqual(avg_p_distance, test_avg_p_distance)
         self.assertDictEqual(pdist_median, test_pdist_median)
 
+
+    def test_pwe_window_statistics(self):
+        # -- Test inputs --
+        seq_file = Path("src/tests/data/pwe/seq3.fasta")
+        test_intervals = [[(0.01, 0.015), (2, 2), (0.895, 0.9)], [(0.01, 0.015), (2, 2), (0.85, 0.9)], [(0.01, 0.015), (1, 2), (0.895, 0.9)]]
+        # -- Test Results --
+        test_coverage = {"Sample1": 1.0, "Sample2": (43 / 80)}
+        test_pdistance = {"Sample2": (37 / 80)}
+        test_stable = [True, False, False]
+        # -- Module Results --
+        stats = window_statistics(seq_file, "Sample1")
+        no_ref_stats = window_statistics(seq_file, "Sample3")
+        stable = [intervals_are_stable(i, 0.01) for i in test_intervals]
+        # -- Assert results are valid --
+        self.assertDictEqual(stats.coverage, test_coverage)
+        self.assertDictEqual(stats.pdistance, test_pdistance)
+        self.assertIsNone(no_ref_stats.pdistance)
+        self.assertListEqual(stable, test_stable)
+
     
     ########## Pairwise Filter ##########
     def test_pwf_Mean(self):
@@ -107,6 +201,62 @@ class TestTHExBuilder(unittest.TestCase):
         self.assertAlmostEqual(stdev1, test_stdev1)
         self.assertAlmostEqual(stdev2, test_stdev2)
 
+
+    def test_pwf_sub_window_scan(self):
+        # -- Test inputs --
+        test_ref = "ACGTACGTACGTACGTACGT"
+        test_seqs = {
+            "Ref": test_ref,
+            "Sample1": "ACGTACGTACGTACGTACGT",
+            "Sample2": "ACGTACGTAC-TACGTACGN",
+            "Sample3": "ACGTACGTACGTTTTTTTTT",
+            "Sample4": "acgtacgtacgtacgtacgt",
+        }
+        test_starts = numpy.arange(0, 20, 5)
+        # -- Test Results --
+        test_pdist = {
+            n: [CalculatePairwiseDeletionDistanceForAlignedSeqsComparedToRefSeq({n: seq[s:s+10], "Ref": test_ref[s:s+10]}, "Ref", ["Ref"], "N")[0][n] for s in test_starts]
+            for n, seq in test_seqs.items()
+        }
+        test_masked = "ACGTANNNNNNNNNNNNNNN"
+        # -- Module Results --
+        test_matrix = CodeMatrix.from_sequences(test_seqs.values(), [20] * 5, keep_case=True)
+        pdist = SubWindowPairwiseDeletionDistances(test_matrix, 0, test_starts, 10, "N")
+        newseqs = SplitAlignedSeqsIntoWindows(dict(test_seqs), 20, 10, 5, "N", "Ref", 1, 0.05, ["Ref"])
+        # -- Assert results are valid --
+        for row, n in enumerate(test_seqs.keys()):
+            self.assertListEqual(list(pdist[row]), test_pdist[n])
+        self.assertEqual(newseqs["Sample3"], test_masked)
+        self.assertEqual(newseqs["Sample2"], test_seqs["Sample2"])
+        self.assertEqual(newseqs["Ref"], test_ref)
+
+
+    def test_pwf_mask_coverage_and_fasta(self):
+        # -- Test inputs --
+        test_samples = ["Sample1", "Sample2"]
+        test_matrix = CodeMatrix.from_sequences(["ACGT-CGTAC", "ACnTACGTA"], [10, 9], keep_case=True)
+        test_starts = numpy.array([0, 5])
+        test_flags = numpy.array([[False, True], [False, False]])
+        # -- Test Results --
+        test_masked = b"ACGT-NNNNN"
+        test_coverage = [0.4, 0.9]
+        test_fasta = ">Sample1\nACGT\n-NNN\nNN\n>Sample2\nACnT\nACGT\nA"
+        # -- Module Results --
+        coverage = MaskAlignedMatrixAndCalculatePercentCoverage(test_matrix, 10, test_starts, test_flags, 5, "N")
+        fasta = FormatMatrixOfNucleotideSeqsToFasta(test_samples, test_matrix, width=4)
+        # A missing character that does not fit in 4 bits unpacks the matrix
+        unpacked_matrix = CodeMatrix.from_sequences(["ACGT-CGTAC", "ACnTACGTA"], [10, 9], keep_case=True)
+        unpacked_coverage = MaskAlignedMatrixAndCalculatePercentCoverage(unpacked_matrix, 10, test_starts, test_flags, 5, "?")
+        # -- Assert results are valid --
+        self.assertTrue(test_matrix.packed)
+        self.assertFalse(unpacked_matrix.packed)
+        self.assertEqual(test_matrix.decode_row(0).tobytes(), test_masked)
+        self.assertEqual(unpacked_matrix.decode_row(0).tobytes(), b"ACGT-?????")
+        self.assertEqual(unpacked_matrix.decode_row(1).tobytes(), b"ACnTACGTA")
+        self.assertListEqual(list(unpacked_coverage), test_coverage)
+        self.assertListEqual(list(coverage), test_coverage)
+        self.assertEqual(fasta, test_fasta)
+
     ########## Pairwise Filter ##########
     def test_iqtree_remove_heterotachy_info(self):
         # -- Test inputs --
@@ -125,8 +275,199 @@ class TestTHExBuilder(unittest.TestCase):
         self.assertEqual(test_tree1_clean, tree1)
         self.assertEqual(test_tree2_clean, tree2)
         self.assertEqual(test_tree3_clean, tree3)
+
+
+    def test_iqtree_result_cache(self):
+        # -- Test inputs --
+        tmp_dir = tempfile.TemporaryDirectory()
+        window_dir = Path(tmp_dir.name)
+        for name, seq in [("chr1_1_10", "ACGTACGTAC"), ("chr1_11_20", "ACGTACGTAC"), ("chr1_21_30", "ACGTTTGTAC")]:
+            (window_dir / f"{name}.fasta").write_text(f">A\n{seq}\n>B\n{seq}\n")
+        test_tasks = [WindowTask("chr1", f, window_dir, 1) for f in sorted(window_dir.glob("*.fasta"))]
+        cache = IQTreeCache(window_dir / "cache", "model=GTR\nbootstrap=1000\nversion=test\n", max_bytes=0)
+        calls = []
+        def fake_iqtree(tasks):
+            for task in tasks:
+                calls.append(task.window.name)
+                contree = task.outdir / f"{task.window.stem}.contree"
+                contree.write_text("(A,B);")
+                cache.put(cache.key(task.window), contree)
+                yield TaskResult(task, contree, None, 1, 0.0)
+        # -- Test Results --
+        test_first_calls = ["chr1_11_20.fasta", "chr1_21_30.fasta"]
+        test_attempts = [1, 0, 1]
+        # -- Module Results --
+        first = sorted(run_with_cache(fake_iqtree, test_tasks, cache), key=lambda r: r.task.window.name)
+        first_calls = list(calls)
+        calls.clear()
+        second = list(run_with_cache(fake_iqtree, test_tasks, cache))
+        trees = [r.result.read_text() for r in second]
+        num_entries = len(cache.entries())
+        removed = cache.evict()
+        tmp_dir.cleanup()
+        # -- Assert results are valid --
+        self.assertListEqual(first_calls, test_first_calls)
+        self.assertListEqual([r.attempts for r in first], test_attempts)
+        self.assertListEqual(calls, [])
+        self.assertListEqual(trees, ["(A,B);"] * 3)
+        self.assertEqual(num_entries, 2)
+        self.assertEqual(removed, 2)
     
 
+    def test_iqtree_window_cost(self):
+        # -- Test inputs --
+        test_fasta = ">A\nACGTA\nCG\n>B\nACGTACG\n>C\nACGTACG\n"
+        test_results = [
+            TaskResult(WindowTask("chr1", Path("a.fasta"), Path("."), 1000, None, 1), None, None, 1, 2.0),
+            TaskResult(WindowTask("chr1", Path("b.fasta"), Path("."), 1000, None, 16), None, None, 1, 1.0),
+            TaskResult(WindowTask("chr1", Path("c.fasta"), Path("."), 1000, None, 1), None, None, 1, 4.0),
+            TaskResult(WindowTask("chr1", Path("d.fasta"), Path("."), 1000, None, 1), None, None, 0, 0.0),
+            TaskResult(WindowTask("chr1", Path("e.fasta"), Path("."), 1000, None, 1), None, "failed", 1, 99.0),
+        ]
+        # -- Test Results --
+        test_shape = (3, 7)
+        test_threads = [1, 1, 2, 8, 4, 3, 3]
+        test_seconds_per_cell = 0.004
+        # -- Module Results --
+        with tempfile.TemporaryDirectory() as tmpdir:
+            f = Path(tmpdir) / "chr1_1_7.fasta"
+            f.write_text(test_fasta)
+            shape = window_shape(f)
+        threads = [
+            allocate_threads(0, "AUTO", 8),
+            allocate_threads(250000, "AUTO", 8),
+            allocate_threads(250001, "AUTO", 8),
+            allocate_threads(10 ** 9, "AUTO", 16),
+            allocate_threads(10 ** 9, "AUTO", 4),
+            allocate_threads(10, 3, 8),
+            allocate_threads(10, "4", 3),
+        ]
+        seconds_per_cell = calibrate_seconds_per_cell(test_results)
+        # -- Assert results are valid --
+        self.assertEqual(shape, test_shape)
+        self.assertListEqual(threads, test_threads)
+        self.assertAlmostEqual(seconds_per_cell, test_seconds_per_cell)
+        self.assertIsNone(calibrate_seconds_per_cell(test_results[3:]))
+
+    def test_iqtree_batch_task(self):
+        # -- Test inputs --
+        # Stub IQ-TREE - writes an ML tree of each window's sample names + a consensus tree, prefixed
+        # "con" (per locus for -S runs). -S runs fail when FAIL_BATCH exists and write no consensus
+        # trees when NO_CONTREE exists.
+        test_stub = "\n".join([
+            f"#!{sys.executable}",
+            "import os, re, sys",
+            "args = dict(zip(sys.argv[1::2], sys.argv[2::2]))",
+            "def tree(f):",
+            "    return '(' + ','.join(l[1:].split()[0] for l in open(f) if l.startswith('>')) + ');'",
+            "if '-S' in args:",
+            "    if os.path.exists(os.path.join(os.path.dirname(sys.argv[0]), 'FAIL_BATCH')):",
+            "        sys.exit(1)",
+            "    loci = re.findall(r'= (\\S+): \\*;', open(args['-S']).read())",
+            "    with open(args['-pre'] + '.treefile', 'w') as oh:",
+            "        oh.writelines(tree(os.path.join(os.path.dirname(args['-S']), f)) + '\\n' for f in loci)",
+            "    if not os.path.exists(os.path.join(os.path.dirname(sys.argv[0]), 'NO_CONTREE')):",
+            "        with open(args['-pre'] + '.contree', 'w') as oh:",
+            "            oh.writelines('con' + tree(os.path.join(os.path.dirname(args['-S']), f)) + '\\n' for f in loci)",
+            "else:",
+            "    open(args['-pre'] + '.treefile', 'w').write(tree(args['-s']) + '\\n')",
+            "    open(args['-pre'] + '.contree', 'w').write('con' + tree(args['-s']) + '\\n')",
+        ])
+        test_windows = {
+            "chr1_1_4.fasta": ">A\nACGT\n>B\nACGT\n",
+            "chr1_5_8.fasta": ">A\nACGT\n>C\nACGT\n>D\nACGT\n",
+            "chr1_9_12.fasta": ">B\nACGT\n>E\nACGT\n",
+        }
+        # -- Test Results --
+        test_trees = {"chr1_1_4": "con(A,B);\n", "chr1_5_8": "con(A,C,D);\n", "chr1_9_12": "con(B,E);\n"}
+        test_batch_sizes = [2, 1]
+        test_suffixes = {".contree"}
+        # -- Module Results --
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tmpdir = Path(tmpdir)
+            stub = tmpdir / "iqtree"
+            stub.write_text(test_stub)
+            stub.chmod(0o755)
+            outdir = tmpdir / "chr1"
+            outdir.mkdir()
+            tasks = list()
+            for name, text in test_windows.items():
+                (tmpdir / name).write_text(text)
+                tasks.append(WindowTask("chr1", tmpdir / name, outdir, len(text), None, 1))
+            batches = make_batches(tasks, 2, "AUTO", 4)
+            batched = iqtree_batch_task(batches[0], "GTR", 1000, "AUTO", stub.as_posix())
+            batched += iqtree_batch_task(batches[1], "GTR", 1000, "AUTO", stub.as_posix())
+            batched_trees = {r.result.stem: r.result.read_text() for r in batched}
+            # Failed batches are rerun one window at a time
+            for f in outdir.iterdir():
+                f.unlink()
+            (tmpdir / "FAIL_BATCH").touch()
+            with self.assertLogs("thexb.STAGE_iqtree", level="WARNING") as logs:
+                fallback = iqtree_batch_task(batches[0], "GTR", 1000, "AUTO", stub.as_posix())
+            fallback_trees = {r.result.stem: r.result.read_text() for r in fallback}
+            # Batches without per-locus consensus trees are also rerun one window at a time
+            (tmpdir / "FAIL_BATCH").unlink()
+            (tmpdir / "NO_CONTREE").touch()
+            with self.assertLogs("thexb.STAGE_iqtree", level="WARNING"):
+                no_contree = iqtree_batch_task(batches[0], "GTR", 1000, "AUTO", stub.as_posix())
+            no_contree_trees = {r.result.stem: r.result.read_text() for r in no_contree}
+            (tmpdir / "NO_CONTREE").unlink()
+            # Batched and single-window trees are cached under different keys
+            batch_cache = IQTreeCache(tmpdir / "cache", "model=GTR\nbootstrap=1000\nversion=test\nbatch=per-locus\n")
+            window_cache = IQTreeCache(tmpdir / "cache", "model=GTR\nbootstrap=1000\nversion=test\n")
+            iqtree_batch_task(batches[1], "GTR", 1000, "AUTO", stub.as_posix(), batch_cache)
+            window = batches[1].tasks[0].window
+            window_hit = window_cache.get(window_cache.key(window), tmpdir / "hit.contree")
+        # -- Assert results are valid --
+        self.assertListEqual([len(b.tasks) for b in batches], test_batch_sizes)
+        self.assertDictEqual(batched_trees, test_trees)
+        self.assertTrue(all(r.error is None for r in batched + fallback))
+        self.assertDictEqual(fallback_trees, {t.window.stem: test_trees[t.window.stem] for t in batches[0].tasks})
+        self.assertDictEqual(no_contree_trees, fallback_trees)
+        self.assertSetEqual({r.result.suffix for r in batched + fallback}, test_suffixes)
+        self.assertTrue(all(t.window.name in logs.output[0] for t in batches[0].tasks))
+        self.assertFalse(window_hit)
+
+    def test_iqtree_region_models(self):
+        # -- Test inputs --
+        test_tasks = [WindowTask("chr1", Path(f"chr1_{s}_{s + 9}.fasta"), Path("."), 10) for s in range(1, 101, 10)]
+        test_report = "Akaike Information Criterion:           GTR+F+G4\nBest-fit model according to BIC: HKY+F+I\n"
+        # -- Test Results --
+        test_regions = [["chr1_1_10", "chr1_11_20", "chr1_21_30", "chr1_31_40"], ["chr1_41_50", "chr1_51_60", "chr1_61_70", "chr1_71_80"], ["chr1_81_90", "chr1_91_100"]]
+        test_sampled = ["chr1_11_20", "chr1_31_40"]
+        # -- Module Results --
+        regions = model_regions(reversed(test_tasks), 4)
+        whole_chromosome = model_regions(test_tasks, 0)
+        sampled = sample_windows(regions[0], 2)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            report = Path(tmpdir) / "chr1_1_10.iqtree"
+            report.write_text(test_report)
+            best_model = read_best_model(report)
+            # Region signatures change with the region's windows + its sampled alignments
+            region = [t._replace(window=Path(tmpdir) / t.window.name) for t in regions[0]]
+            for t in region:
+                t.window.write_text(">A\nACGT\n>B\nACGT\n")
+            signature = region_signature(region, 2)
+            same_signature = region_signature(list(region), 2)
+            fewer_windows = region_signature(region[:3], 2)
+            region[1].window.write_text(">A\nACGT\n>B\nACGA\n")
+            edited_sample = region_signature(region, 2)
+        # -- Assert results are valid --
+        self.assertEqual(signature, same_signature)
+        self.assertNotEqual(signature, fewer_windows)
+        self.assertNotEqual(signature, edited_sample)
+        self.assertListEqual([[t.window.stem for t in r] for r in regions], test_regions)
+        self.assertEqual(len(whole_chromosome), 1)
+        self.assertListEqual([t.window.stem for t in sampled], test_sampled)
+        self.assertEqual(len(sample_windows(regions[2], 5)), 2)
+        self.assertEqual(best_model, "HKY+F+I")
+        self.assertEqual(choose_model(["HKY", None, "GTR", "GTR"]), "GTR")
+        self.assertIsNone(choose_model([None, None]))
+        self.assertTrue(is_model_selection("MFP+MERGE"))
+        self.assertFalse(is_model_selection("GTR*H4"))
+        self.assertEqual(model_finder_only("MFP+MERGE"), "MF+MERGE")
+        self.assertEqual(model_finder_only("TEST"), "TESTONLY")
+
     def test_iqtree_external_remove_heterotachy_info(self):
         # -- Test inputs --
         test_tree1 = "(A[0.0000346/0.0000106/0.0837614/0.0739605]:1,(B[0.0000346/0.0000106/0.0837614/0.0739605]:1,C[0.0000346/0.0000106/0.0837614/0.0739605]:1));"
@@ -145,5 +486,501 @@ class TestTHExBuilder(unittest.TestCase):
         self.assertEqual(test_tree2_clean, tree2)
         self.assertEqual(test_tree3_clean, tree3)
 
+    ########## Topobinner ##########
+    def test_topobinner_bin_topologies(self):
+        # -- Test inputs --
+        test_trees = [
+            "((A,B),(C,D),E);",
+            "NoTree",
+            "((C,D)90:0.1,E,(B,A)100:0.2);",
+            "(((A,B),E),(C,D));",
+            "((A,C),(B,D),E);",
+            "(E,((A,C),(D,B)));",
+            "(((A,B),(C,D)),E);",
+        ]
+        # -- Test Results --
+        test_unrooted_bins = {0: {"count": 4, "idx": [0, 2, 3, 6]}, 4: {"count": 2, "idx": [4, 5]}}
+        test_rooted_counts = [2, 1, 1, 1, 1]
+        # -- Module Results --
+        unrooted_bins = bin_topologies(test_trees)
+        rooted_bins = bin_topologies(test_trees, rooted=True)
+        # -- Assert results are valid --
+        self.assertDictEqual(unrooted_bins, test_unrooted_bins)
+        self.assertListEqual([b["count"] for b in rooted_bins.values()], test_rooted_counts)
+        self.assertEqual(topology_signature(test_trees[0]), topology_signature(test_trees[3]))
+        self.assertNotEqual(topology_signature("((A,B),(C,D),E);"), topology_signature("((A,B),(C,F),E);"))
+
+    def test_topobinner_cluster_topologies(self):
+        # -- Test inputs --
+        test_trees = [
+            "(((A,B),C),(D,E),F);",
+            "(((A,B),C),(D,E),F);",
+            "(((A,C),B),(D,E),F);",
+            "NoTree",
+            "(((A,F),D),(B,E),C);",
+            "(((A,B),C),(D,E),F);",
+            "(((A,B),C),(D,F),E);",
+            "(((A,B),(C,D)),E,F);",
+        ]
+        # -- Test Results --
+        test_rf2_clusters = {0: {"count": 5, "idx": [0, 1, 2, 5, 6]}, 4: {"count": 1, "idx": [4]}, 7: {"count": 1, "idx": [7]}}
+        test_rf4_counts = [6, 1]
+        # -- Module Results --
+        exact = cluster_topologies(test_trees, 0)
+        rf2_clusters = cluster_topologies(test_trees, 2)
+        rf4_clusters = cluster_topologies(test_trees, 4)
+        # -- Assert results are valid --
+        self.assertDictEqual(exact, bin_topologies(test_trees))
+        self.assertDictEqual(rf2_clusters, test_rf2_clusters)
+        self.assertListEqual([c["count"] for c in rf4_clusters.values()], test_rf4_counts)
+
+    def test_topobinner_tree_arrays(self):
+        # -- Test inputs --
+        test_tree = "((B:0.1,A:0.2)90:0.3,C:0.4);"
+        test_column = [test_tree, "NoTree", float("nan"), "((A,C),B);"] * 3
+        # -- Test Results --
+        test_parents = [-1, 0, 1, 1, 0]
+        test_lengths = [0.0, 0.3, 0.1, 0.2, 0.4]
+        test_names = ("A", "B", "C")
+        test_leaf_ids = [-1, -1, 1, 0, 2]
+        test_splits = (0b111, 0b011, 0b010, 0b001, 0b100)
+        # -- Module Results --
+        arrays = tree_arrays(test_tree)
+        serial = parse_tree_column(test_column)
+        parallel = parse_tree_column(test_column, cpu_count=2, chunksize=2)
+        # -- Assert results are valid --
+        self.assertListEqual(arrays.parents.tolist(), test_parents)
+        self.assertListEqual(arrays.lengths.tolist(), test_lengths)
+        self.assertTupleEqual(arrays.names, test_names)
+        self.assertListEqual(arrays.leaf_ids.tolist(), test_leaf_ids)
+        self.assertTupleEqual(arrays.splits, test_splits)
+        self.assertListEqual([a is None for a in parallel], [False, True, True, False] * 3)
+        self.assertListEqual([a.splits for a in parallel if a], [a.splits for a in serial if a])
+
+    def test_root_treeviewer_file(self):
+        # -- Test inputs --
+        test_df = pd.DataFrame({
+            "Chromosome": ["chr1"] * 6,
+            "Window": [100, 200, 300, 400, 500, 600],
+            "NewickTree": ["(((A,B),C),(D,E));", "NoTree", "((C,(A,B)),(E,D));", "((C,D),(F,G));", "((C,D),(E,F));", "(C,(D,(E,F)));"],
+            "TopologyID": [None] * 6,
+        })
+        # -- Test Results --
+        # Trees that can not be rooted keep their root and are binned unrooted
+        test_topologies = ["Tree001", None, "Tree001", "Tree003", "Tree002", "Tree002"]
+        test_failed = "chr1_400"
+        # -- Module Results --
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tmpdir = Path(tmpdir)
+            (tmpdir / "logs").mkdir()
+            test_df.to_excel(tmpdir / "tv.xlsx", index=False)
+            root_TreeViewer_file(tmpdir / "tv.xlsx", tmpdir, ["A", "B"], False, tmpdir, "INFO")
+            outputs = sorted(f.name for f in tmpdir.iterdir() if f.is_file())
+            rooted_df = pd.read_excel(tmpdir / "tv.rooted_to_A_B.xlsx")
+            log_text = (tmpdir / "logs/root_TreeViewer_file.log").read_text()
+        # -- Assert results are valid --
+        self.assertListEqual(outputs, ["tv.rooted_to_A_B.xlsx", "tv.xlsx"])
+        self.assertListEqual([None if pd.isna(t) else t for t in rooted_df["TopologyID"]], test_topologies)
+        self.assertIn(test_failed, log_text)
+
+    def test_treeviewer_file_io(self):
+        # -- Test inputs --
+        test_df = pd.DataFrame({
+            "Chromosome": ["chr2", "chr1", "chr1"],
+            "Window": [100, 200, 100],
+            "NewickTree": ["((A,B),C);", "NoTree", "((A,C),B);"],
+            "TopologyID": ["Tree001", None, "Tree002"],
+            "Data": [0.5, 0.25, 1.0],
+        })
+        # -- Test Results --
+        test_dictionary_cols = ["Chromosome", "TopologyID"]
+        test_topologies = ["Tree001", None, "Tree002"]
+        test_sorted_windows = [100, 200, 100]
+        # -- Module Results --
+        with tempfile.TemporaryDirectory() as tmpdir:
+            results = dict()
+            for suffix in (".parquet", ".feather", ".xlsx", ".csv", ".tsv"):
+                write_treeviewer_file(test_df, Path(tmpdir) / f"tv{suffix}")
+                results[suffix] = read_treeviewer_file(Path(tmpdir) / f"tv{suffix}")
+            schema = pq.read_schema(Path(tmpdir) / "tv.parquet")
+            dictionary_cols = [f.name for f in schema if pa.types.is_dictionary(f.type)]
+            sorted_df = read_file_to_df(Path(tmpdir) / "tv.parquet")
+            with self.assertRaises(ValueError):
+                write_treeviewer_file(test_df, Path(tmpdir) / "tv.json")
+        # -- Assert results are valid --
+        self.assertListEqual(dictionary_cols, test_dictionary_cols)
+        for df in results.values():
+            self.assertListEqual(df.columns.to_list(), test_df.columns.to_list())
+            self.assertListEqual(df["Chromosome"].to_list(), test_df["Chromosome"].to_list())
+            self.assertListEqual(df["Window"].to_list(), test_df["Window"].to_list())
+            self.assertListEqual(df["NewickTree"].to_list(), test_df["NewickTree"].to_list())
+            self.assertListEqual([None if pd.isna(t) else t for t in df["TopologyID"]], test_topologies)
+        self.assertEqual(results[".parquet"]["Chromosome"].dtype, object)
+        self.assertListEqual(sorted_df["Chromosome"].to_list(), ["chr1", "chr1", "chr2"])
+        self.assertListEqual(sorted_df["Window"].to_list(), test_sorted_windows)
+
+    ########## p-Distance Calculator ##########
+    def test_pdist_process_file(self):
+        # -- Test inputs --
+        tmp_dir = tempfile.TemporaryDirectory()
+        test_file = Path(shutil.copy("src/tests/data/gap_seq.fasta", tmp_dir.name))
+        # -- Test Results --
+        test_values = []
+        with Fasta(test_file.as_posix()) as fh:
+            windows = generate_windows(len(fh["Sample1"]), 20)
+            for sample in ["Sample2", "Sample1"]:
+                for s, e in windows:
+                    value = pairwise_pi(fh["Sample1"][s:e].seq, fh[sample][s:e].seq, "N", True, 0.75)
+                    test_values.append(None if value is pd.NA else value)
+        # -- Module Results --
+        df = process_file(test_file, 20, "N", 0.75, "Sample1", True, True)
+        values = [None if pd.isna(v) else v for v in df["Value"]]
+        tmp_dir.cleanup()
+        # -- Assert results are valid --
+        self.assertListEqual(list(df.columns), ["Chromosome", "Window", "Sample", "Value"])
+        self.assertListEqual(list(df["Sample"].unique()), ["Sample2", "Sample1_reference"])
+        self.assertListEqual(values, test_values)
+
+    def test_pdist_process_chunk(self):
+        # -- Test inputs --
+        tmp_dir = tempfile.TemporaryDirectory()
+        test_file = Path(shutil.copy("src/tests/data/gap_seq.fasta", tmp_dir.name))
+        test_samples = ["Sample2", "Sample1"]
+        test_windows = generate_windows(79, 10)
+        # -- Test Results --
+        test_values = process_chunk(test_file, test_samples, test_windows, "N", 0.75, True)
+        # -- Module Results --
+        chunk_values = [process_chunk(test_file, test_samples, c, "N", 0.75, True) for c in divide_windows_into_chunks(test_windows, 3)]
+        values = numpy.hstack(chunk_values)
+        tmp_dir.cleanup()
+        # -- Assert results are valid --
+        self.assertEqual(len(chunk_values), 3)
+        numpy.testing.assert_array_equal(values, test_values)
+
+    def test_pdist_process_matrix_chunk(self):
+        # -- Test inputs --
+        tmp_dir = tempfile.TemporaryDirectory()
+        test_file = Path(shutil.copy("src/tests/data/gap_seq.fasta", tmp_dir.name))
+        test_windows = generate_windows(79, 20)
+        # -- Test Results --
+        with Fasta(test_file.as_posix()) as fh:
+            test_values = [pairwise_pi(fh["Sample1"][s:e].seq, fh["Sample2"][s:e].seq, "N", False, 0.75) for s, e in test_windows]
+        # -- Module Results --
+        values = process_matrix_chunk(test_file, ["Sample1", "Sample2"], test_windows, "N", 0.75, False)
+        tmp_dir.cleanup()
+        # -- Assert results are valid --
+        self.assertEqual(values.shape, (1, len(test_windows)))
+        self.assertListEqual(list(values[0]), test_values)
+
+    def test_pdist_generate_windows_step(self):
+        # -- Test inputs --
+        test_seq_len = 79
+        # -- Test Results --
+        test_windows = [(1, 20), (11, 30), (21, 40), (31, 50), (41, 60), (51, 70), (61, 79), (71, 79)]
+        # -- Module Results --
+        windows = generate_windows(test_seq_len, 20, 10)
+        tiled_windows = generate_windows(test_seq_len, 20, 20)
+        # -- Assert results are valid --
+        self.assertListEqual(windows, test_windows)
+        self.assertListEqual(tiled_windows, generate_windows(test_seq_len, 20))
+
+    def test_pdist_process_chunk_step(self):
+        # -- Test inputs --
+        tmp_dir = tempfile.TemporaryDirectory()
+        test_file = Path(shutil.copy("src/tests/data/gap_seq.fasta", tmp_dir.name))
+        test_windows = generate_windows(79, 20, 5)
+        # -- Test Results --
+        with Fasta(test_file.as_posix()) as fh:
+            test_values = [pairwise_pi(fh["Sample1"][s:e].seq, fh["Sample2"][s:e].seq, "N", True, 0.75) for s, e in test_windows]
+        # -- Module Results --
+        values = process_chunk(test_file, ["Sample2", "Sample1"], test_windows, "N", 0.75, True)
+        tmp_dir.cleanup()
+        # -- Assert results are valid --
+        self.assertListEqual(list(values[0]), test_values)
+
+    def test_pdist_iter_file_dfs(self):
+        # -- Test inputs --
+        tmp_dir = tempfile.TemporaryDirectory()
+        test_file = Path(shutil.copy("src/tests/data/gap_seq.fasta", tmp_dir.name))
+        test_samples = ["Sample2", "Sample1"]
+        test_windows = generate_windows(79, 20)
+        test_labels = get_row_labels(test_samples, "Sample1", True)
+        # -- Test Results --
+        test_df = process_file(test_file, 20, "N", 0.75, "Sample1", True, True)
+        # -- Module Results --
+        values = process_chunk(test_file, test_samples, test_windows, "N", 0.75, True)
+        with mock.patch("thexb.STAGE_pdistance_calculator.PDIST_WRITE_ROWS", len(test_windows)):
+            dfs = list(iter_file_dfs("gap_seq", test_labels, test_windows, values, "Sample1"))
+        tmp_dir.cleanup()
+        # -- Assert results are valid --
+        self.assertEqual(len(dfs), 2)
+        pd.testing.assert_frame_equal(pd.concat(dfs, ignore_index=True), test_df)
+
+    def test_pdist_iter_file_tasks(self):
+        # -- Test inputs --
+        test_file_tasks = [["f0c0", "f0c1"], ["f1c0"], ["f2c0"]]
+        file_slots = threading.Semaphore(2)
+        # -- Test Results --
+        test_queued = ["f0c0", "f0c1", "f1c0"]
+        # -- Module Results --
+        tasks = iter_file_tasks(test_file_tasks, file_slots)
+        queued = [next(tasks) for _ in range(3)]
+        free_slot = file_slots.acquire(blocking=False)
+        # Writing a file releases its slot, letting the next file be queued
+        file_slots.release()
+        queued_after_write = list(tasks)
+        # -- Assert results are valid --
+        self.assertListEqual(queued, test_queued)
+        self.assertFalse(free_slot)
+        self.assertListEqual(queued_after_write, ["f2c0"])
+
+    ########## Alignment Store ##########
+    def test_alignment_store(self):
+        # -- Test inputs --
+        tmp_dir = tempfile.TemporaryDirectory()
+        test_file = Path(shutil.copy("src/tests/data/gap_seq.fasta", tmp_dir.name))
+        # -- Test Results --
+        with Fasta(test_file.as_posix()) as fh:
+            test_seqs = {s: fh[s][:].seq for s in ["Sample2", "Sample1"]}
+        # -- Module Results --
+        store = build_alignment_store(test_file, Path(tmp_dir.name) / "store.npy", ["Sample2", "Sample1"])
+        matrix = open_alignment_store(store)
+        seqs = {s: decode_sites(row) for s, row in zip(store.samples, matrix)}
+        window = decode_sites(matrix[1, 10:30])
+        # Lazy stores are built on first open, then reopened as is
+        lazy = LazyAlignmentStore(test_file, Path(tmp_dir.name) / "lazy.npy", ["Sample2", "Sample1"], store.lengths, False)
+        lazy_built = lazy.path.exists()
+        lazy_matrix = open_lazy_alignment_store(lazy, threading.Lock())
+        lazy_reopened = open_lazy_alignment_store(lazy, threading.Lock())
+        lazy_files = sorted(p.name for p in Path(tmp_dir.name).glob("*.npy*"))
+        lazy_equal = numpy.array_equal(lazy_matrix, matrix) and numpy.array_equal(lazy_reopened, matrix)
+        # Encoded stores are packed 4 bits per site
+        encoded = build_alignment_store(test_file, Path(tmp_dir.name) / "encoded.npy", ["Sample2", "Sample1"], encoded=True)
+        encoded_matrix = store_code_matrix(open_alignment_store(encoded), encoded.lengths)
+        encoded_width = encoded_matrix.data.shape[1]
+        encoded_region = [decode(row) for row in encoded_matrix.region(9, 30)]
+        del matrix, lazy_matrix, lazy_reopened, encoded_matrix
+        tmp_dir.cleanup()
+        # -- Assert results are valid --
+        self.assertFalse(lazy_built)
+        self.assertTrue(lazy_equal)
+        self.assertListEqual(lazy_files, ["lazy.npy", "store.npy"])
+        self.assertEqual(encoded_width, (max(encoded.lengths) + 1) // 2)
+        self.assertListEqual(encoded_region, [test_seqs[s][9:30].upper() for s in ["Sample2", "Sample1"]])
+        self.assertDictEqual(seqs, test_seqs)
+        self.assertEqual(window, test_seqs["Sample1"][10:30])
+        self.assertListEqual(store.lengths, [len(test_seqs["Sample2"]), len(test_seqs["Sample1"])])
+
+    ########## Nucleotide Encoding ##########
+    def test_encoding_round_trip(self):
+        # -- Test inputs --
+        test_seq = "ACGTacgtNn-RYKMSWBDHV?X"
+        # -- Test Results --
+        test_decoded = test_seq.upper()
+        # -- Module Results --
+        codes = encode(test_seq)
+        decoded = decode(codes)
+        ascii = ascii_codes(test_seq)
+        packed = pack(codes[:19])
+        unpacked = unpack(packed, 19)
+        matrix = CodeMatrix.from_sequences([test_seq[:19], test_seq], [19, len(test_seq)], keep_case=True)
+        matrix_rows = [matrix.decode_row(n).tobytes().decode("ascii") for n in range(2)]
+        # -- Assert results are valid --
+        self.assertEqual(decoded, test_decoded)
+        self.assertEqual(ascii.tobytes().decode("ascii"), test_seq)
+        self.assertListEqual(is_letter(codes).tolist(), [c.isalpha() for c in test_seq])
+        self.assertEqual(len(packed), 10)
+        self.assertListEqual(unpacked.tolist(), codes[:19].tolist())
+        self.assertRaises(ValueError, pack, codes)
+        self.assertFalse(matrix.packed)
+        self.assertListEqual(matrix_rows, [test_seq[:19], test_seq])
+
+    def test_encoding_predicates(self):
+        # -- Test inputs --
+        test_seq1 = encode("AcGT-Nn?")
+        test_seq2 = encode("aCTTNN-?")
+        # -- Test Results --
+        test_gap = [False, False, False, False, True, False, False, False]
+        test_missing = [False, False, False, False, False, True, True, False]
+        test_unambiguous = [True, True, True, True, False, False, False, False]
+        test_mismatch = [False, False, True, False, True, False, True, False]
+        # -- Module Results --
+        gap = is_gap(test_seq1)
+        missing = is_missing(test_seq1, "N")
+        unambiguous = is_unambiguous(test_seq1)
+        mismatches = mismatch(test_seq1, test_seq2)
+        # -- Assert results are valid --
+        self.assertListEqual(list(gap), test_gap)
+        self.assertListEqual(list(missing), test_missing)
+        self.assertListEqual(list(unambiguous), test_unambiguous)
+        self.assertListEqual(list(mismatches), test_mismatch)
+
+    ########## Window Archive ##########
+    def test_window_archive(self):
+        # -- Test inputs --
+        tmp_dir = tempfile.TemporaryDirectory()
+        test_windows = {
+            "chr1_1_4.fasta": ">Sample1\nACGT\n>Sample2\nAC-T\n",
+            "chr1_5_8-DROPPED.fasta": "",
+            "chr1_9_12.fasta": ">Sample1\nTTGA\n>Sample2\nTNGA\n",
+        }
+        # -- Test Results --
+        test_records = {"Sample1": "TTGA", "Sample2": "TNGA"}
+        # -- Module Results --
+        with WindowArchiveWriter(Path(tmp_dir.name) / "chr1.windows") as writer:
+            for name, text in test_windows.items():
+                writer.add(name, text)
+        with WindowArchive(Path(tmp_dir.name) / "chr1.windows") as archive:
+            windows = {n: archive.read(n) for n in archive.names()}
+            records = archive.records("chr1_9_12.fasta")
+            extracted = archive.extract(Path(tmp_dir.name) / "chr1")
+        packed_names = pack_window_dir(Path(tmp_dir.name) / "chr1", Path(tmp_dir.name) / "packed.windows")
+        with WindowArchive(Path(tmp_dir.name) / "packed.windows") as archive:
+            packed_windows = {n: archive.read(n) for n in archive.names()}
+        tmp_dir.cleanup()
+        # -- Assert results are valid --
+        self.assertDictEqual(windows, test_windows)
+        self.assertDictEqual(records, test_records)
+        self.assertEqual(len(extracted), 3)
+        self.assertListEqual(packed_names, sorted(test_windows.keys()))
+        self.assertDictEqual(packed_windows, test_windows)
+
+    ########## Run Manifest ##########
+    def test_run_manifest(self):
+        # -- Test inputs --
+        tmp_dir = tempfile.TemporaryDirectory()
+        root = Path(tmp_dir.name)
+        test_manifest = root / "run_manifest.sqlite"
+        test_trimal_records = [
+            WindowRecord("chr1_1_4.fasta", VALID, None, (root / "trimal/chr1/chr1_1_4.fasta").as_posix(), 0.1),
+            WindowRecord("chr1_5_8.fasta", DROPPED, "All alignment sequence was removed by Trimal", (root / "trimal/chr1/chr1_5_8-DROPPED.fasta").as_posix(), 0.1),
+        ]
+        test_pw_records = [
+            WindowRecord("chr1_1_4.fasta", DROPPED, "Failed to meet coverage threshold", (root / "pw/chr1/chr1_1_4-DROPPED.fasta").as_posix(), 0.2),
+            WindowRecord("chr1_5_8-DROPPED.fasta", DROPPED, "Dropped by a previous stage", (root / "pw/chr1/chr1_5_8-DROPPED.fasta").as_posix(), 0.0),
+        ]
+        (root / "external/chr1").mkdir(parents=True)
+        (root / "external/chr1/chr1_1_4.fasta").write_text(">A\nACGT\n")
+        # -- Test Results --
+        test_pw_dropped = {"chr1_1_4": "Failed to meet coverage threshold", "chr1_5_8": "Dropped by a previous stage"}
+        test_report = [("chr1", "All alignment sequence was removed by Trimal", 1)]
+        test_pw_files = ["chr1_1_4-DROPPED.fasta", "chr1_5_8-DROPPED.fasta"]
+        # -- Module Results --
+        with RunManifest(test_manifest) as manifest:
+            manifest.record("trimal", "chr1", test_trimal_records)
+            manifest.record("pairwise_filter", "chr1", test_pw_records)
+            pw_dropped = manifest.dropped_windows("pairwise_filter", "chr1")
+            report = manifest.drop_report("trimal")
+            coordinates = manifest.conn.execute("SELECT start, end FROM windows WHERE window = 'chr1_5_8' LIMIT 1").fetchone()
+        # Lookups only use the rows of the stage that wrote the input
+        iqtree_dropped = previously_dropped(test_manifest, "chr1", root / "pw/chr1")
+        trimal_input_dropped = previously_dropped(test_manifest, "chr1", root / "trimal/chr1")
+        missing_chrom = previously_dropped(test_manifest, "chr2", root / "pw/chr2")
+        external_dropped = previously_dropped(test_manifest, "chr1", root / "external/chr1")
+        pw_files = window_files(test_manifest, "chr1", root / "pw/chr1")
+        external_files = window_files(test_manifest, "chr1", root / "external/chr1")
+        with RunManifest(test_manifest) as manifest:
+            manifest.set_output("trimal", "chr1", (root / "trimal/chr1.windows").as_posix())
+            archive_stage = manifest.input_stage("chr1", root / "trimal/chr1.windows")
+        tmp_dir.cleanup()
+        # -- Assert results are valid --
+        self.assertDictEqual(pw_dropped, test_pw_dropped)
+        self.assertListEqual(report, test_report)
+        self.assertTupleEqual(coordinates, (5, 8))
+        self.assertSetEqual(iqtree_dropped, {"chr1_1_4", "chr1_5_8"})
+        self.assertSetEqual(trimal_input_dropped, {"chr1_5_8"})
+        self.assertIsNone(missing_chrom)
+        self.assertIsNone(external_dropped)
+        self.assertListEqual([f.name for f in pw_files], test_pw_files)
+        self.assertListEqual([f.name for f in external_files], ["chr1_1_4.fasta"])
+        self.assertEqual(archive_stage, "trimal")
+        self.assertTrue(is_dropped("chr1_1_4.fasta", iqtree_dropped))
+        self.assertFalse(is_dropped("chr1_1_4.fasta", trimal_input_dropped))
+        self.assertTrue(is_dropped("chr2_1_4-DROPPED.fasta", missing_chrom))
+        self.assertFalse(is_dropped("chr2_1_4.fasta", missing_chrom))
+
+    ########## Window Scheduler ##########
+    def test_scheduler_run_task(self):
+        # -- Test inputs --
+        test_task = WindowTask("chr1", Path("chr1_1_100.fasta"), Path("."), 100)
+        calls = []
+        def flaky(task):
+            calls.append(task)
+            if len(calls) < 2:
+                raise ValueError("first attempt fails")
+            return task.window.name
+        def slow(task):
+            time.sleep(5)
+        # -- Test Results --
+        test_result = "chr1_1_100.fasta"
+        # -- Module Results --
+        retried = run_task(flaky, test_task, RETRIES=1)
+        failed = run_task(flaky, test_task._replace(window=Path("chr1_101_200.fasta")), RETRIES=0)
+        calls.clear()
+        not_retried = run_task(flaky, test_task, RETRIES=0)
+        timed_out = run_task(slow, test_task, TIMEOUT=0.1)
+        # -- Assert results are valid --
+        self.assertEqual(retried.result, test_result)
+        self.assertEqual(retried.attempts, 2)
+        self.assertIsNone(failed.error)
+        self.assertIn("first attempt fails", not_retried.error)
+        self.assertIn("Timed out", timed_out.error)
+        self.assertLess(timed_out.seconds, 5)
+
+    def test_scheduler_stream_chromosomes(self):
+        # -- Test inputs --
+        test_tasks = [
+            WindowTask("chr1", Path("chr1_1_100.fasta"), Path("."), 100),
+            WindowTask("chr2", Path("chr2_1_100.fasta"), Path("."), 100),
+            WindowTask("chr1", Path("chr1_101_200.fasta"), Path("."), 100),
+        ]
+        test_results = [TaskResult(t, None, None, 1, 0.0) for t in test_tasks]
+        # -- Test Results --
+        test_order = [("chr3", 0), ("chr2", 1), ("chr1", 2)]
+        # -- Module Results --
+        order = [(c, len(r)) for c, r in stream_chromosomes(iter(test_results), test_tasks, ["chr1", "chr2", "chr3"])]
+        # -- Assert results are valid --
+        self.assertListEqual(order, test_order)
+
+    def test_scheduler_threaded_tasks(self):
+        # -- Test inputs --
+        test_tasks = [
+            WindowTask("chr1", Path("chr1_1_100.fasta"), Path("."), 100, None, 1),
+            WindowTask("chr1", Path("chr1_101_200.fasta"), Path("."), 300, None, 8),
+            WindowTask("chr2", Path("chr2_1_100.fasta"), Path("."), 200, None, 2),
+        ]
+        # -- Test Results --
+        test_windows = ["chr1_101_200.fasta", "chr1_1_100.fasta", "chr2_1_100.fasta"]
+        # -- Module Results --
+        results = list(schedule_threaded_tasks(repr, test_tasks, core_budget=2))
+        # -- Assert results are valid --
+        self.assertListEqual(sorted(r.task.window.name for r in results), test_windows)
+        self.assertTrue(all(r.error is None and r.result == repr(r.task) for r in results))
+        self.assertListEqual(list(schedule_threaded_tasks(repr, [], core_budget=2)), [])
+
+    def test_scheduler_backfill(self):
+        # -- Test inputs --
+        # 2 of 8 cores free - a 1 core task ends at t=1, a 4 core task at t=10
+        test_running = [
+            (0.0, WindowTask("chr1", Path("chr1_1_100.fasta"), Path("."), 10, None, 4), 4),
+            (0.0, WindowTask("chr1", Path("chr1_101_200.fasta"), Path("."), 1, None, 1), 1),
+            (0.0, WindowTask("chr1", Path("chr1_201_300.fasta"), Path("."), 1, None, 1), 1),
+        ]
+        test_short = WindowTask("chr2", Path("chr2_1_100.fasta"), Path("."), 5, None, 2)
+        test_long = WindowTask("chr2", Path("chr2_101_200.fasta"), Path("."), 20, None, 2)
+        # -- Test Results --
+        test_reservations = [(0.0, 0), (1.0, 0), (10.0, 2)]
+        # -- Module Results --
+        reservations = [reservation(test_running, head, 2, 1.0) for head in [2, 4, 6]]
+        # Waiting task reserved to start at t=10 - ends before it, or uses spare cores
+        short_backfill = can_backfill(test_short, 2, 0.0, 1.0, 10.0, 0)
+        long_backfill = can_backfill(test_long, 2, 0.0, 1.0, 10.0, 0)
+        spare_backfill = can_backfill(test_long, 2, 0.0, 1.0, 10.0, 2)
+        # -- Assert results are valid --
+        self.assertListEqual(reservations, test_reservations)
+        self.assertTupleEqual(short_backfill, (True, 0))
+        self.assertTupleEqual(long_backfill, (False, 0))
+        self.assertTupleEqual(spare_backfill, (True, 2))
+
 if __name__ == '__main__':
     unittest.main()
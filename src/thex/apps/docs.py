@@ -103,9 +103,10 @@ docs_treeviewer_contents = html.Div(
                 The input file for Tree Viewer is designed to be simple to make and even easier to incorporate new window-based data. 
                 Tree Viewer takes a tab or comma delimited file where the first four columns are Chromosome, Window (i.e., 100,000 - which 
                 covers bases 1-100,000 for 100kb windows), NewickTree, and TopologyID. The first four columns are required and must have 
-                the appropriate headers in the order given in the example input below. Tree Viewer accepts four different file extensions 
-                (.csv, .tsv, .txt, .xlsx) for the input file. Note there are column and per-cell limitations to [Excel files](https://support.microsoft.com/en-us/office/excel-specifications-and-limits-1672b34d-7043-467e-8e27-269d656771c3) (.xlsx) files, so 
-                large datasets may be better off in a flat file format like .csv, .tsv, or .txt. Ensure the headers of your file match the headers shown in the example below.
+                the appropriate headers in the order given in the example input below. Tree Viewer accepts six different file extensions 
+                (.parquet, .feather, .csv, .tsv, .txt, .xlsx) for the input file. THExBuilder writes Tree Viewer files as Parquet (.parquet) by default, 
+                which loads fastest and is read memory-mapped. Note there are column and per-cell limitations to [Excel files](https://support.microsoft.com/en-us/office/excel-specifications-and-limits-1672b34d-7043-467e-8e27-269d656771c3) (.xlsx) files, so 
+                large datasets may be better off in a columnar (.parquet, .feather) or flat file format like .csv, .tsv, or .txt. Ensure the headers of your file match the headers shown in the example below.
 
                 """
                 ],
@@ -820,7 +821,7 @@ docs_thexb_contents = html.Div(
 
                     _Example Command_:
                     ```py
-                    $ thexb --phybin_external -i pathway_to_phybin_output_directory/ --tv_file_name ./THExBuilderOutput/TreeViewer_input_file.xlsx
+                    $ thexb --phybin_external -i pathway_to_phybin_output_directory/ --tv_file_name ./THExBuilderOutput/TreeViewer_input_file.parquet
                     ```
                 
                 """
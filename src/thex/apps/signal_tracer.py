@@ -350,7 +350,7 @@ def signalTracer_layout():
                     dbc.ModalBody(
                         children=[
                             dbc.FormText(
-                                "Required column headers = Chromosome | Window | Sample | Value", 
+                                "Required column headers = Chromosome | Window | Sample | Value (or Chromosome | Window | SampleA | SampleB | Value for all-vs-all input)", 
                                 color="white",
                                 className='modal-info-text'
                             ),
@@ -758,6 +758,23 @@ def signalTracer_layout():
                                                         ],
                                                         style={'padding': '5px'},
                                                     ),
+                                                    # Sample pair choice (all-vs-all input)
+                                                    html.Div(
+                                                        id='pair-choice-div',
+                                                        children=[
+                                                            html.H6(
+                                                                children=["Sample Pairs | "],
+                                                                style={'color': 'black', "padding-bottom": "2px"},
+                                                            ),
+                                                            dcc.Dropdown(
+                                                                id='pdist-pair-options',
+                                                                className='dropdown-style',
+                                                                multi=True,
+                                                                disabled=True,
+                                                            ),
+                                                        ],
+                                                        style={'padding': '5px', 'width': '25%'},
+                                                    ),
                                                     # Graph Switches
                                                     html.Div(
                                                         children=[
@@ -1126,6 +1143,30 @@ def set_chromosome_choice(chrom_quantity, fileData, input_modal):
         return options, options[0]['value']
 
 
+@app.callback(
+    [Output('pdist-pair-options', 'options'),
+     Output('pdist-pair-options', 'value'),
+     Output('pdist-pair-options', 'disabled'),
+    ],
+    [Input('pdist-input-df', 'children'),
+     Input("pdist-new-session-modal", "is_open"),
+    ]
+)
+def set_sample_pair_choice(fileData, input_modal):
+    if not fileData:
+        raise PreventUpdate
+    elif input_modal:
+        raise PreventUpdate
+    read_file = pd.read_json(fileData)
+    if not signal_utils.is_pairwise_matrix(read_file):
+        return [], [], True
+    pair_labels = signal_utils.get_sample_pair_labels(read_file)
+    options = [dict(label=pair, value=pair) for pair in pair_labels.unique()]
+    # Start with all pairs of the first sample
+    init_pairs = [i for i in pair_labels[read_file['SampleA'] == read_file['SampleA'].iloc[0]].unique()]
+    return options, init_pairs, False
+
+
 @app.callback(
     Output("color-palette", "data"),
     [Input('pdist-input-df', 'children'),
@@ -1187,6 +1228,7 @@ def set_line_colors(
      Input("view-option", "value"),
      Input("graph-type-dropdown", "value"),
      Input("st-font-family-option", "value"),
+     Input("pdist-pair-options", "value"),
     ]
 )
 def update_main_graph(
@@ -1207,6 +1249,7 @@ def update_main_graph(
     view,
     graph_type,
     font_family,
+    sample_pairs,
 ):
     # Prevent update if True
     if not currData:
@@ -1222,6 +1265,9 @@ def update_main_graph(
         editable_graphs = True
     # Load in data and clean data
     df = pd.read_json(currData)
+    df = signal_utils.filter_sample_pairs(df, sample_pairs)
+    if df.empty:
+        raise PreventUpdate
     df.columns = ["Chromosome", "Window", "Sample", "Value"]
     df = df.sort_values(by=["Chromosome", "Window"])
     # Get sample and chromosome data
@@ -1422,6 +1468,7 @@ def update_gff_graph(
         editable_graphs = True
     # Load in data and clean data
     df = pd.read_json(currData)
+    df = signal_utils.filter_sample_pairs(df, None)
     # df = df.melt(id_vars=["Chromosome", "Window"])
     df.columns = ["Chromosome", "Window", "Sample", "Value"]
     df = df.sort_values(by=["Chromosome", "Window"])
@@ -1546,10 +1593,11 @@ def update_gff_graph(
     [State("pdist-input-df", "children"),
      State("pdist-gff-data-upload", "children"),
      State("pdist-chromosome-options", "value"),
-     State('pdist-graph', 'relayoutData'),],
+     State('pdist-graph', 'relayoutData'),
+     State("pdist-pair-options", "value"),],
     prevent_initial_call=True,
 )
-def current_window_summary(n, data_json, gff_json, current_chromosome, relayout_data):
+def current_window_summary(n, data_json, gff_json, current_chromosome, relayout_data, sample_pairs):
     if not data_json:
         raise PreventUpdate
     ctx = dash.callback_context
@@ -1563,6 +1611,7 @@ def current_window_summary(n, data_json, gff_json, current_chromosome, relayout_
         raise PreventUpdate
     elif button_id == "pdist-curr-view-button":
         df = pd.read_json(data_json)
+        df = signal_utils.filter_sample_pairs(df, sample_pairs)
         relayout_keys = [k for k in relayout_data.keys()]
         if "xaxis.range" in relayout_keys[0]:
             dataMin, dataMax = [relayout_data['xaxis.range[0]'], relayout_data['xaxis.range[1]']]
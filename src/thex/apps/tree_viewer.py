@@ -2087,6 +2087,8 @@ def load_input_files(
     # TreeViewer input button color
     if not tvFilename:
         tvButtonColor = "primary"
+    elif tree_utils.is_columnar_file(tvFilename):
+        tvButtonColor = "success"
     elif 'txt' in tvFileType:
         tvButtonColor = "success"
     elif 'csv' in tvFileType:
@@ -2369,7 +2371,42 @@ def load_input_files(
                             None,
                         ]
             # Load file by suffix
-            if "csv" in tvFilename:
+            if tree_utils.is_columnar_file(tvFilename):
+                # Assume that the user uploaded a Parquet/Feather file
+                tvDF = tree_utils.read_columnar_tree_viewer_file(tvFilename, tvFilename)
+                tvDF.sort_values(by=["Chromosome", "Window"], inplace=True)
+                validated_tvDF = tree_utils.tv_header_validation(tvDF)
+                # If validated_DF returns False, raise error 
+                # indicating issue with input file 
+                if not validated_tvDF:
+                    tvDF = dash.no_update
+                    tvFilename = f"{tvFilename} is malformed!"
+                    tvButtonColor = 'danger'
+                    chromButtonColor = 'warning'
+                    tvWarningLabel = "WARNING: Tree Viewer file appears to be malformed. First four headers must be ['Chromosome', 'Window', 'NewickTree', 'TopologyID']"
+                    return [
+                        tvDF,
+                        chromDF,
+                        modalOpen,
+                        tvFilename,
+                        chromFilename,
+                        projectName,
+                        windowSize,
+                        tvButtonColor,
+                        chromButtonColor,
+                        projectButtonColor,
+                        tvWarningLabel, 
+                        treeTaxaOptions,
+                        treeTaxaValues,
+                        gffData,
+                        None,
+                    ]
+                if len(tvDF.columns) == 4:
+                    tvDF["None"] = [pd.NA]*len(tvDF)
+                tvDF["TopologyID"] = tvDF["TopologyID"].apply(lambda x: "NODATA" if type(x) != str else x)
+                tvDF[["TopologyID"]] = tvDF[["TopologyID"]].fillna(value="NoData")
+                pass
+            elif "csv" in tvFilename:
                 # Assume that the user uploaded a CSV file
                 tvDF = pd.read_csv(tvFilename, comments="#")
                 tvDF.sort_values(by=["Chromosome", "Window"], inplace=True)
@@ -2688,7 +2725,41 @@ def load_input_files(
             tvDecoded = base64.b64decode(tvcontent_string)
             _, ChromContent_string = chromFile_contents.split(",")
             chromDecoded = base64.b64decode(ChromContent_string)
-            if "csv" in tvFileType:
+            if tree_utils.is_columnar_file(tvFilename):
+                # Assume that the user uploaded a Parquet/Feather file
+                tvDF = tree_utils.read_columnar_tree_viewer_file(tvDecoded, tvFilename)
+                tvDF.sort_values(by=["Chromosome", "Window"], inplace=True)
+                validated_tvDF = tree_utils.tv_header_validation(tvDF)
+                # If validated_DF returns False, raise error 
+                # indicating issue with input file 
+                if not validated_tvDF:
+                    tvFilename = f"{tvFilename} is malformed!"
+                    tvButtonColor = 'danger'
+                    chromButtonColor = 'warning'
+                    tvWarningLabel = "WARNING: Tree Viewer file appears to be malformed. First four headers must be ['Chromosome', 'Window', 'NewickTree', 'TopologyID']"
+                    return [
+                        tvDF.to_json(),
+                        chromDF,
+                        modalOpen,
+                        tvFilename,
+                        chromFilename,
+                        projectName,
+                        windowSize,
+                        tvButtonColor,
+                        chromButtonColor,
+                        projectButtonColor,
+                        tvWarningLabel, 
+                        treeTaxaOptions,
+                        treeTaxaValues,
+                        gffData,
+                        None,
+                    ]
+                if len(tvDF.columns) == 4:
+                    tvDF["None"] = [pd.NA]*len(tvDF)
+                tvDF["TopologyID"] = tvDF["TopologyID"].apply(lambda x: "NODATA" if type(x) != str else x)
+                tvDF[["TopologyID"]] = tvDF[["TopologyID"]].fillna(value="NoData")
+                pass
+            elif "csv" in tvFileType:
                 # Assume that the user uploaded a CSV file
                 tvDF = pd.read_csv(io.StringIO(tvDecoded.decode("utf-8")))
                 tvDF.sort_values(by=["Chromosome", "Window"], inplace=True)
@@ -5569,7 +5640,7 @@ def tree_pruning_export(
         # Clear TopologyID column
         df["TopologyID"] = [pd.NA]*len(df)
         # Prune trees with selected taxa
-        df["NewickTree"] = df["NewickTree"].apply(lambda x: tree_utils.prune_tree(x, prune_taxa_choices))
+        df["NewickTree"] = tree_utils.prune_tree_column(df["NewickTree"], prune_taxa_choices)
         # Add comment row on top to track what was done -- Not implemented yet
         # taxa_join = "-".join(prune_taxa_choices)
         # df.columns = [f"# TreePrune: {taxa_join}"] + [pd.NA]*(len(df.columns)-1)
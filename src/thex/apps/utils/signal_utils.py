@@ -323,12 +323,36 @@ def validate_signal_tracer_headers(df):
     """Validate that headers are correct"""
     expected_headers = ["Chromosome", "Window", "Sample", "Value"]
     try:
-        assert list(df.columns) == expected_headers
+        assert (list(df.columns) == expected_headers) or is_pairwise_matrix(df)
         return True
     except AssertionError:
         return False
 
 
+def is_pairwise_matrix(df):
+    """Return True if data is in the all-vs-all long format (thexb --pdistance-matrix)"""
+    return list(df.columns) == ["Chromosome", "Window", "SampleA", "SampleB", "Value"]
+
+
+# -------------------- Sample Pair Functions --------------------
+
+def get_sample_pair_labels(df):
+    """Return 'SampleA vs SampleB' label for each row of all-vs-all data"""
+    return df["SampleA"].astype(str) + " vs " + df["SampleB"].astype(str)
+
+
+def filter_sample_pairs(df, sample_pairs):
+    """Filter all-vs-all data to the chosen sample pairs and return it in the
+    standard Chromosome | Window | Sample | Value format. Data already in the
+    standard format is returned unchanged."""
+    if not is_pairwise_matrix(df):
+        return df
+    df = df.assign(Sample=get_sample_pair_labels(df))
+    if sample_pairs is not None:
+        df = df[df["Sample"].isin(sample_pairs)]
+    return df[["Chromosome", "Window", "Sample", "Value"]]
+
+
 def validate_signal_tracer_values(xlsx_df):
     """Return False if value column data are not int or float"""
     try:
@@ -1,6 +1,8 @@
 import math
 import itertools
+import os
 import re
+from functools import partial
 
 import numpy as np
 import pandas as pd
@@ -11,6 +13,9 @@ import scikit_posthocs as sp
 from dash_table.Format import Format, Scheme
 from Bio import Phylo
 from ete3 import Tree
+from thexb.UTIL_file_reader import COLUMNAR_SUFFIXES, read_columnar_treeviewer
+from thexb.UTIL_topology_hash import bin_topologies
+from thexb.UTIL_tree_arrays import map_trees, tree_arrays
 from plotly.subplots import make_subplots
 
 # -------------------------------------------------------------------------------------
@@ -2976,11 +2981,7 @@ def get_taxa_from_tree(tree):
     """Collect leaf names from tree"""
     if tree == "NoTree":
         return "NoTree"
-    tree = Tree(tree)
-    taxa = []
-    for leaf in tree.iter_leaves():
-        taxa.append(leaf.name)
-    return sorted(taxa)
+    return list(tree_arrays(tree).names)
 
 
 def get_valid_init_tree(trees):
@@ -3061,6 +3062,16 @@ def validate_tree_viewer_input(df):
         return df
 
 
+def is_columnar_file(filename):
+    """Return True for Parquet/Feather Tree Viewer files"""
+    return os.path.splitext(filename)[1] in COLUMNAR_SUFFIXES
+
+
+def read_columnar_tree_viewer_file(source, filename):
+    """Load a Parquet/Feather Tree Viewer file from its path (memory-mapped) or uploaded bytes"""
+    return read_columnar_treeviewer(source, filename)
+
+
 def tv_header_validation(df):
     """Return False if first four required column headers are not valid"""
     required_cols = list(df.columns[:4])
@@ -3106,6 +3117,11 @@ def prune_tree(x, prune_taxa_choices):
     return tree.write()
 
 
+def prune_tree_column(trees, prune_taxa_choices):
+    """Prune every tree of a NewickTree column - trees are pruned across all cores"""
+    return map_trees(partial(prune_tree, prune_taxa_choices=prune_taxa_choices), trees, os.cpu_count())
+
+
 def remove_heterotachy_info(l):
     """Remove any information in brackets - ete3 
        does not support this format of newick"""
@@ -3124,41 +3140,11 @@ def remove_heterotachy_info(l):
 
 
 def tv_topobinner(df):
-    """Bin tree topologies that have RF-distance of 0"""
+    """Bin tree topologies that have RF-distance of 0 (rooted comparison)"""
     trees = df['NewickTree']
-    topologies = dict()
     topoCount = 1
-    
-    for n, t in enumerate(trees):
-        if t == "NoTree":
-            continue
-        elif len(topologies.keys()) == 0:
-            topologies[n] = {'count': 1, 'idx': [n]}
-            continue
-        else:
-            # Iterate through topology list
-            # add new topology if no rf == 0
-            # increase count if rf == 0 with topology 
-            new_topology = True
-            for idx in topologies.keys():
-                t1 = Tree(remove_heterotachy_info(t))
-                t2 = Tree(remove_heterotachy_info(df.at[idx, 'NewickTree']))
-                comparison = t1.compare(t2)
-                rf = comparison['rf']
-                if rf == 0:
-                    topologies[idx]['count'] += 1
-                    topologies[idx]['idx'].append(n)
-                    new_topology = False
-                    break
-                else:
-                    continue
-            if new_topology:
-                topologies[n] = {'count': 1, 'idx': [n]}
-                continue
-            else:
-                continue
-    # Sort topologies dictionary by 'count'
-    topologies = {k: v for k, v in sorted(topologies.items(), key=lambda item: item[1]['count'], reverse=True)}
+    # Topologies sorted by 'count' - see thexb.UTIL_topology_hash
+    topologies = bin_topologies([remove_heterotachy_info(t) for t in trees], rooted=True, cpu_count=os.cpu_count())
 
     # Update DataFrame TopologyID column with results
     for topology in topologies.keys():
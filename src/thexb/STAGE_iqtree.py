@@ -1,18 +1,41 @@
+import json
 import logging
 import math
 import os
 import re
 import shutil
 import subprocess
+import tempfile
+import time
+from collections import Counter, defaultdict, namedtuple
+from contextlib import ExitStack
 from subprocess import CalledProcessError
-from multiprocessing import Manager, freeze_support
+from multiprocessing import freeze_support
 from shlex import quote
 from functools import partial
+from pathlib import Path
 
-from p_tqdm import p_umap
 import pandas as pd
 
-from thexb.UTIL_checks import check_fasta
+from thexb.UTIL_file_reader import write_treeviewer_file
+from thexb.UTIL_iqtree_cache import IQTreeCache, cache_size_to_bytes
+from thexb.UTIL_iqtree_models import choose_model, is_model_selection, load_models, model_regions, modelfinder_task, region_signature, sample_windows, save_models
+from thexb.UTIL_run_manifest import DROPPED, VALID, RunManifest, WindowRecord, drop_report_lines, is_dropped, manifest_path, previously_dropped, window_files
+from thexb.UTIL_scheduler import TaskResult, WindowTask, describe_error, run_tasks_serially, run_tool, schedule_threaded_tasks, stream_chromosomes
+from thexb.UTIL_window_archive import extracted_windows, is_window_archive
+
+# Windows are costed by their number of cells (taxa x sites). With IQT_CORES = AUTO
+# a window gets one thread per THREAD_CELLS cells, up to MAX_AUTO_THREADS.
+THREAD_CELLS = 250000
+MAX_AUTO_THREADS = 8
+# Predicted run time = seconds per cell x cells / threads ** PARALLEL_EFFICIENCY.
+# Seconds per cell is calibrated from each run's actual run times (COST_MODEL_NAME).
+PARALLEL_EFFICIENCY = 0.75
+DEFAULT_SECONDS_PER_CELL = 0.0002
+COST_MODEL_NAME = "iqtree_cost_model.json"
+
+# Windows run by one IQ-TREE process (per-locus trees, -S) - scheduled like a WindowTask
+IQTreeBatch = namedtuple("IQTreeBatch", ["tasks", "cost", "threads"])
 
 ############################### Set up logger #################################
 logger = logging.getLogger(__name__)
@@ -111,7 +134,7 @@ def create_TreeViewer_input(filtered_outdir, treeViewer_filename):
     treeviewer_df.sort_values(by=["Chromosome", "Window"], inplace=True)
     # Add blank TopologyID column
     treeviewer_df["TopologyID"] = [pd.NA] * len(treeviewer_df)
-    treeviewer_df.to_excel(treeViewer_filename, index=False)
+    write_treeviewer_file(treeviewer_df, treeViewer_filename)
     return
 
 
@@ -130,19 +153,300 @@ def check_iqtree_install(IQTREE_PATH):
     return
 
 
-############################### Main Function ################################
-def run_iqtree(
-    chromosome,
-    filtered_outdir,
+def window_shape(f):
+    """Return (taxa, sites) of a window file - sites are counted from the first sequence"""
+    taxa = 0
+    sites = 0
+    with open(f) as fh:
+        for line in fh:
+            if line.startswith(">"):
+                taxa += 1
+            elif taxa == 1:
+                sites += len(line.strip())
+    return taxa, sites
+
+
+def allocate_threads(cells, IQT_CORES, core_budget):
+    """Threads to run a window with - IQT_CORES for every window, or by window size when AUTO"""
+    if IQT_CORES != "AUTO":
+        return max(1, min(int(IQT_CORES), core_budget))
+    return max(1, min(math.ceil(cells / THREAD_CELLS), MAX_AUTO_THREADS, core_budget))
+
+
+def predicted_seconds(task, SECONDS_PER_CELL):
+    """Expected IQ-TREE run time of a window (WindowTask)"""
+    return SECONDS_PER_CELL * task.cost / ((task.threads or 1) ** PARALLEL_EFFICIENCY)
+
+
+def _cost_model_key(IQT_MODEL, IQT_BOOTSTRAP):
+    return f"{IQT_MODEL}|{IQT_BOOTSTRAP}"
+
+
+def load_seconds_per_cell(WORKING_DIR, IQT_MODEL, IQT_BOOTSTRAP):
+    """Return the calibrated seconds per cell of a model + bootstrap setting, or None"""
+    try:
+        cost_model = json.loads((WORKING_DIR / COST_MODEL_NAME).read_text())
+    except (FileNotFoundError, ValueError):
+        return None
+    return cost_model.get(_cost_model_key(IQT_MODEL, IQT_BOOTSTRAP))
+
+
+def calibrate_seconds_per_cell(results):
+    """Median seconds per cell (at one thread) of windows IQ-TREE ran once, or None"""
+    ratios = sorted(
+        r.seconds * ((r.task.threads or 1) ** PARALLEL_EFFICIENCY) / r.task.cost
+        for r in results if (r.error is None) and (r.attempts == 1) and r.task.cost
+    )
+    if not ratios:
+        return None
+    return ratios[len(ratios) // 2]
+
+
+def save_seconds_per_cell(WORKING_DIR, IQT_MODEL, IQT_BOOTSTRAP, SECONDS_PER_CELL):
+    path = WORKING_DIR / COST_MODEL_NAME
+    try:
+        cost_model = json.loads(path.read_text())
+    except (FileNotFoundError, ValueError):
+        cost_model = dict()
+    cost_model[_cost_model_key(IQT_MODEL, IQT_BOOTSTRAP)] = SECONDS_PER_CELL
+    path.write_text(json.dumps(cost_model, indent=2))
+    return
+
+
+def iqtree_window_task(task, IQT_MODEL, IQT_BOOTSTRAP, IQT_CORES, IQTREE_PATH, IQT_CACHE=None):
+    """Run one window (WindowTask) through IQ-TREE with task.threads threads and task.model
+    (IQT_CORES and IQT_MODEL when not set). Returns the window's .contree file, which is added
+    to IQT_CACHE when one is given."""
+    f = task.window
+    output_prefix = task.outdir / f.stem
+    threads = IQT_CORES if task.threads is None else task.threads
+    model = IQT_MODEL if task.model is None else task.model
+    run_tool(
+        [
+            f"{IQTREE_PATH} -nt {threads} -s {quote(f.as_posix())} -m {quote(model)} -bb {IQT_BOOTSTRAP} -pre {output_prefix} --quiet"
+        ],
+        stderr=subprocess.PIPE,
+    )
+    contree = task.outdir / f"{f.stem}.contree"
+    if IQT_CACHE is not None:
+        IQT_CACHE.put(IQT_CACHE.key(f, task.model), contree)
+    return contree
+
+
+def write_batch_partition(batch, batch_dir):
+    """Copy a batch's windows to batch_dir + write a partition file with one locus per window"""
+    charsets = list()
+    for n, task in enumerate(batch.tasks, start=1):
+        shutil.copyfile(task.window, batch_dir / f"locus{n}.fasta")
+        charsets.append(f"    charset locus{n} = locus{n}.fasta: *;\n")
+    partition = batch_dir / "loci.nex"
+    with open(partition, "w") as oh:
+        oh.write("#nexus\nbegin sets;\n" + "".join(charsets) + "end;\n")
+    return partition
+
+
+def read_batch_trees(contree):
+    """Return the per-locus consensus trees of an IQ-TREE -S run, in partition order"""
+    with open(contree) as fh:
+        return [line.strip() for line in fh if line.strip()]
+
+
+def iqtree_batch_task(batch, IQT_MODEL, IQT_BOOTSTRAP, IQT_CORES, IQTREE_PATH, IQT_CACHE=None):
+    """
+    Run a batch of windows (IQTreeBatch) through one IQ-TREE process with per-locus
+    trees (-S), then split the per-locus UFBoot consensus trees (loci.contree) into
+    each window's .contree file. If the batch fails or does not return a consensus
+    tree for every window, the error is logged and its windows are run one at a time
+    so one bad window does not drop the batch. Returns a TaskResult for every window.
+    """
+    start_time = time.perf_counter()
+    threads = IQT_CORES if batch.threads is None else batch.threads
+    # Batches only hold windows with the same model
+    model = IQT_MODEL if batch.tasks[0].model is None else batch.tasks[0].model
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        batch_dir = Path(tmp_dir)
+        partition = write_batch_partition(batch, batch_dir)
+        try:
+            run_tool(
+                [
+                    f"{IQTREE_PATH} -nt {threads} -S {quote(partition.as_posix())} -m {quote(model)} -bb {IQT_BOOTSTRAP} -pre {quote((batch_dir / 'loci').as_posix())} --quiet"
+                ],
+                stderr=subprocess.PIPE,
+            )
+            trees = read_batch_trees(batch_dir / "loci.contree")
+            if len(trees) != len(batch.tasks):
+                raise ValueError(f"IQ-TREE returned {len(trees)} trees for {len(batch.tasks)} windows")
+        except Exception as e:
+            logger.warning(
+                f"IQ-TREE batch failed ({describe_error(e)}) - running its {len(batch.tasks)} windows one at a time: "
+                + ", ".join(t.window.name for t in batch.tasks)
+            )
+            trees = None
+    if trees is None:
+        results = list()
+        for task in batch.tasks:
+            window_start = time.perf_counter()
+            try:
+                contree = iqtree_window_task(task, IQT_MODEL, IQT_BOOTSTRAP, IQT_CORES, IQTREE_PATH, IQT_CACHE)
+                results.append(TaskResult(task, contree, None, 1, time.perf_counter() - window_start))
+            except Exception as e:
+                results.append(TaskResult(task, None, describe_error(e), 1, time.perf_counter() - window_start))
+        return results
+    # Split the batch's run time between its windows by their size
+    seconds = time.perf_counter() - start_time
+    results = list()
+    for task, tree in zip(batch.tasks, trees):
+        contree = task.outdir / f"{task.window.stem}.contree"
+        with open(contree, "w") as oh:
+            oh.write(f"{tree}\n")
+        if IQT_CACHE is not None:
+            IQT_CACHE.put(IQT_CACHE.key(task.window, task.model), contree)
+        results.append(TaskResult(task, contree, None, 1, seconds * task.cost / (batch.cost or 1)))
+    return results
+
+
+def make_batches(tasks, IQT_BATCH_SIZE, IQT_CORES, core_budget):
+    """Group tasks with the same model into batches of IQT_BATCH_SIZE windows of similar size (largest first)"""
+    by_model = defaultdict(list)
+    for task in sorted(tasks, key=lambda t: t.cost, reverse=True):
+        by_model[task.model].append(task)
+    batches = list()
+    for model_tasks in by_model.values():
+        for i in range(0, len(model_tasks), IQT_BATCH_SIZE):
+            batch_tasks = model_tasks[i:i + IQT_BATCH_SIZE]
+            cost = sum(t.cost for t in batch_tasks)
+            batches.append(IQTreeBatch(batch_tasks, cost, allocate_threads(cost, IQT_CORES, core_budget)))
+    return batches
+
+
+def run_batched(run_batches, tasks, IQT_BATCH_SIZE, IQT_CORES, core_budget):
+    """
+    Run tasks in batches with run_batches (a function returning a TaskResult per
+    batch). Yields a TaskResult for every task - windows of a batch that failed
+    get the batch's error.
+    """
+    for r in run_batches(make_batches(tasks, IQT_BATCH_SIZE, IQT_CORES, core_budget)):
+        if r.error is None:
+            yield from r.result
+            continue
+        for task in r.task.tasks:
+            yield TaskResult(task, None, r.error, r.attempts, r.seconds * task.cost / (r.task.cost or 1))
+
+
+def run_with_cache(run_tasks, tasks, IQT_CACHE=None):
+    """
+    Run tasks with run_tasks (a function returning TaskResults), reusing trees from
+    IQT_CACHE. Windows already in the cache are not run and windows with identical
+    alignments are only run once. Yields a TaskResult for every task - attempts is 0
+    for windows whose tree was reused.
+    """
+    if IQT_CACHE is None:
+        yield from run_tasks(tasks)
+        return
+    task_keys = dict()
+    duplicates = defaultdict(list)
+    to_run = list()
+    for task in tasks:
+        key = IQT_CACHE.key(task.window, task.model)
+        contree = task.outdir / f"{task.window.stem}.contree"
+        if IQT_CACHE.get(key, contree):
+            yield TaskResult(task, contree, None, 0, 0.0)
+        elif key in duplicates:
+            duplicates[key].append(task)
+        else:
+            duplicates[key] = list()
+            task_keys[task] = key
+            to_run.append(task)
+    for r in run_tasks(to_run):
+        yield r
+        # Windows with the same alignment get a copy of the tree (or the same error)
+        for task in duplicates.pop(task_keys[r.task]):
+            contree = task.outdir / f"{task.window.stem}.contree"
+            if r.error is None:
+                shutil.copyfile(r.result, contree)
+                yield TaskResult(task, contree, None, 0, 0.0)
+            else:
+                yield TaskResult(task, None, r.error, 0, 0.0)
+
+
+def select_region_models(
+    tasks,
+    WORKING_DIR,
     IQT_MODEL,
-    IQT_BOOTSTRAP,
     IQT_CORES,
     IQTREE_PATH,
-    return_dict,
+    IQT_MODEL_SAMPLE,
+    IQT_MODEL_REGION,
+    core_budget,
+    TASK_TIMEOUT=None,
+    TASK_RETRIES=0,
 ):
-    """For each file in a given chromosome directory, run it through IQ-TREE with provided parameters"""
-    chrom_files = [f for f in chromosome.iterdir() if check_fasta(f)]
-    dropped_files = [f for f in chromosome.iterdir() if "-DROPPED" in f.name]
+    """
+    Run ModelFinder on IQT_MODEL_SAMPLE windows of each region of IQT_MODEL_REGION windows
+    (see UTIL_iqtree_models) and give every window of a region the model chosen most often.
+    Regions whose windows and sampled alignments match a region of a previous run (same
+    region signature) reuse its stored model. Returns the tasks with their model set -
+    regions where ModelFinder failed keep IQT_MODEL.
+    """
+    stored = load_models(WORKING_DIR, IQT_MODEL, IQT_MODEL_SAMPLE, IQT_MODEL_REGION)
+    chrom_tasks = defaultdict(list)
+    for task in tasks:
+        chrom_tasks[task.chromosome].append(task)
+    regions = [region for t in chrom_tasks.values() for region in model_regions(t, IQT_MODEL_REGION)]
+    signatures = [region_signature(region, IQT_MODEL_SAMPLE) for region in regions]
+    to_sample = [region for region, signature in zip(regions, signatures) if signature not in stored]
+    sampled = [w for region in to_sample for w in sample_windows(region, IQT_MODEL_SAMPLE)]
+    best_models = dict()
+    for r in schedule_threaded_tasks(
+        partial(modelfinder_task, IQT_MODEL=IQT_MODEL, IQT_CORES=IQT_CORES, IQTREE_PATH=IQTREE_PATH),
+        sampled,
+        core_budget=core_budget,
+        TIMEOUT=TASK_TIMEOUT,
+        RETRIES=TASK_RETRIES,
+    ):
+        if r.error is None:
+            best_models[r.task] = r.result
+        else:
+            logger.debug(f"ModelFinder failed on {r.task.window.name} - {r.error}")
+    chosen = dict()
+    for region, signature in zip(regions, signatures):
+        if signature in stored:
+            chosen[signature] = stored[signature]
+        else:
+            chosen[signature] = choose_model(best_models.get(w) for w in sample_windows(region, IQT_MODEL_SAMPLE))
+    # Regions where ModelFinder failed are sampled again by the next run
+    save_models(WORKING_DIR, IQT_MODEL, IQT_MODEL_SAMPLE, IQT_MODEL_REGION, {k: v for k, v in chosen.items() if v is not None})
+    logger.info(f"ModelFinder run on {len(sampled):,} sampled windows ({len(regions) - len(to_sample):,} of {len(regions):,} regions reused stored models)")
+    assigned = list()
+    for region, signature in zip(regions, signatures):
+        model = chosen[signature]
+        chrom = region[0].chromosome
+        if model is None:
+            logger.info(f"{chrom} | {region[0].window.stem} - {region[-1].window.stem} | ModelFinder failed on every sampled window - using {IQT_MODEL}")
+        else:
+            logger.info(f"{chrom} | {region[0].window.stem} - {region[-1].window.stem} | Model: {model}")
+        assigned += [t._replace(model=model) for t in region]
+    return assigned
+
+
+def write_no_tree(f, chrom_dir):
+    """Write a -DROPPED.contree file holding "NoTree" for window f"""
+    filestem = f.name.strip("-DROPPED.fasta")
+    tree_cf = chrom_dir / f"{filestem}-DROPPED.contree"
+    with open(tree_cf, "w") as oh:
+        oh.write("NoTree")
+    return tree_cf
+
+
+def collect_iqtree_windows(chromosome, filtered_outdir, MANIFEST=None, source=None):
+    """Write "NoTree" files for a chromosome's windows dropped by previous stages + return
+    a task for every other window, the previously dropped count and their manifest records.
+    source is the archive the windows were extracted to chromosome from (None for window
+    directories)."""
+    chrom_files = window_files(MANIFEST, chromosome.name, chromosome)
+    # Window status comes from the manifest rows of the stage that wrote the input (or file names without one)
+    dropped = previously_dropped(MANIFEST, chromosome.name, chromosome if source is None else source)
+    dropped_files = [f for f in chrom_files if is_dropped(f.name, dropped)]
     chrom_dir = filtered_outdir / chromosome.name
     chrom_dir.mkdir(parents=True, exist_ok=True)
 
@@ -151,52 +455,57 @@ def run_iqtree(
     else:
         all_dropped = False
 
-    skipped_files = list()
     dropped_total = 0
+    records = list()
+    tasks = list()
+    for f in sorted(chrom_files, key=lambda f: f.name):
+        if is_dropped(f.name, dropped):
+            if not all_dropped:
+                dropped_total += 1
+            tree_cf = write_no_tree(f, chrom_dir)
+            records.append(WindowRecord(f.name, DROPPED, "Dropped by a previous stage", tree_cf.as_posix(), 0.0))
+            continue
+        taxa, sites = window_shape(f)
+        tasks.append(WindowTask(chromosome.name, f, chrom_dir, taxa * sites))
+    return chrom_files, dropped_total, records, tasks
 
-    for f in chrom_files:
-        if all_dropped:
-            filestem = f.name.strip("-DROPPED.fasta")
-            tree_cf = chrom_dir / f"{filestem}-DROPPED.contree"
-            with open(tree_cf, "w") as oh:
-                oh.write("NoTree")
-                continue
-        elif "-DROPPED" in f.name:
-            dropped_total += 1
-            filestem = f.name.strip("-DROPPED.fasta")
-            tree_cf = chrom_dir / f"{filestem}-DROPPED.contree"
-            with open(tree_cf, "w") as oh:
-                oh.write("NoTree")
-                continue
-        else:
-            # Run IQ-TREE
-            try:
-                output_prefix = filtered_outdir / chromosome.name / f.stem
-                subprocess.run(
-                    [
-                        f"{IQTREE_PATH} -nt {IQT_CORES} -s {quote(f.as_posix())} -m {quote(IQT_MODEL)} -bb {IQT_BOOTSTRAP} -pre {output_prefix} --quiet"
-                    ],
-                    stderr=subprocess.PIPE,
-                    shell=True,
-                    check=True,
-                )
-                continue
-            except CalledProcessError as e:
-                skipped_files.append(
-                    {"file": f, "error": f'"{e.stderr.strip().decode("utf-8")}"'}
-                )
-                filestem = f.name.strip("-DROPPED.fasta")
-                tree_cf = chrom_dir / f"{filestem}-DROPPED.contree"
-                with open(tree_cf, "w") as oh:
-                    oh.write("NoTree")
-                    continue
+
+def finish_iqtree_chromosome(chrom_name, chrom_files, dropped_total, records, results, MANIFEST=None, SECONDS_PER_CELL=None):
+    """Write "NoTree" files for windows IQ-TREE failed on + record a chromosome's finished
+    windows (TaskResult) in the run manifest. Returns the chromosome's log info."""
+    skipped_files = list()
+    reused_total = 0
+    predicted_total = 0.0
+    actual_total = 0.0
+    for r in sorted(results, key=lambda r: r.task.window.name):
+        f = r.task.window
+        if r.attempts and SECONDS_PER_CELL is not None:
+            predicted = predicted_seconds(r.task, SECONDS_PER_CELL)
+            predicted_total += predicted
+            actual_total += r.seconds
+            logger.debug(f"{f.name} | Sites x taxa: {r.task.cost:,} | Threads: {r.task.threads} | Predicted: {predicted:.1f}s | Actual: {r.seconds:.1f}s")
+        if r.error is None:
+            reused_total += (r.attempts == 0)
+            records.append(WindowRecord(f.name, VALID, None, r.result.as_posix(), r.seconds))
+            continue
+        skipped_files.append(
+            {"file": f, "error": f'"{r.error}"'}
+        )
+        tree_cf = write_no_tree(f, r.task.outdir)
+        records.append(WindowRecord(f.name, DROPPED, r.error, tree_cf.as_posix(), r.seconds))
+
+    if MANIFEST is not None:
+        with RunManifest(MANIFEST) as manifest:
+            manifest.record("iqtree", chrom_name, records)
 
     # Collect log info
     log_info = [
-        f"========== {chromosome.name} ==========",
+        f"========== {chrom_name} ==========",
         f"Total windows in chromosome: {len(chrom_files)}",
         f"Total previously dropped windows: {dropped_total}",
         f"Total windows dropped by IQ-TREE: {len(skipped_files)}",
+        f"Total trees reused from cache or identical windows: {reused_total}",
+        f"IQ-TREE run time (predicted / actual): {predicted_total:.1f}s / {actual_total:.1f}s",
         "----------------------------------------",
         [
             f'*Window Dropped* | File: {i["file"].name} | Reason: {i["error"]}'
@@ -204,10 +513,75 @@ def run_iqtree(
         ],
         f"=======================================",
     ]
-    return_dict[chromosome] = log_info
+    return log_info
+
+
+def run_iqtree(
+    chromosome,
+    filtered_outdir,
+    IQT_MODEL,
+    IQT_BOOTSTRAP,
+    IQT_CORES,
+    IQTREE_PATH,
+    return_dict,
+    MANIFEST=None,
+    IQT_CACHE=None,
+    source=None,
+):
+    """For each file in a given chromosome directory, run it through IQ-TREE with provided
+    parameters in the current process. Window status is recorded in the run manifest when
+    one is given and trees are reused from IQT_CACHE when one is given. source is the
+    archive chromosome was extracted from (None for window directories)."""
+    if is_window_archive(chromosome):
+        # IQ-TREE needs window files - run on windows extracted to a temporary directory
+        with extracted_windows(chromosome) as window_dir:
+            return run_iqtree(
+                window_dir,
+                filtered_outdir,
+                IQT_MODEL,
+                IQT_BOOTSTRAP,
+                IQT_CORES,
+                IQTREE_PATH,
+                return_dict,
+                MANIFEST,
+                IQT_CACHE,
+                chromosome,
+            )
+    chrom_files, dropped_total, records, tasks = collect_iqtree_windows(chromosome, filtered_outdir, MANIFEST, source)
+    run_tasks = partial(
+        run_tasks_serially,
+        partial(
+            iqtree_window_task,
+            IQT_MODEL=IQT_MODEL,
+            IQT_BOOTSTRAP=IQT_BOOTSTRAP,
+            IQT_CORES=IQT_CORES,
+            IQTREE_PATH=IQTREE_PATH,
+            IQT_CACHE=IQT_CACHE,
+        ),
+    )
+    results = list(run_with_cache(run_tasks, tasks, IQT_CACHE))
+    return_dict[chromosome.name] = finish_iqtree_chromosome(
+        chromosome.name, chrom_files, dropped_total, records, results, MANIFEST
+    )
     return return_dict
 
 
+def log_iqtree_chromosome(log_info):
+    for i in log_info:
+        if type(i) == str:
+            logger.info(i)
+        elif type(i) == dict:
+            for n in i.keys():
+                logger.info(f"-- {n}: {i[n]}")
+                continue
+        elif type(i) == list:
+            for f in i:
+                logger.info(f)
+                continue
+    return
+
+
+############################### Main Function ################################
 def iq_tree(
     filtered_indir,
     filtered_outdir,
@@ -219,37 +593,35 @@ def iq_tree(
     IQTREE_PATH,
     MULTIPROCESS,
     LOG_LEVEL,
+    TASK_TIMEOUT=None,
+    TASK_RETRIES=0,
+    IQT_CACHE_DIR=None,
+    IQT_CACHE_MAX_MB=None,
+    IQT_BATCH_SIZE=1,
+    IQT_MODEL_SAMPLE=0,
+    IQT_MODEL_REGION=0,
 ):
-    """Iterate through each trimal filetered chromosome directory and filter windows based on missingness."""
+    """Iterate through each trimal filetered chromosome directory and filter windows based on missingness.
+    The windows of every chromosome are run as one task queue (see UTIL_scheduler) and each
+    chromosome is logged as soon as its last window is finished. Trees are reused from the
+    IQ-TREE cache (see UTIL_iqtree_cache) when IQT_CACHE_DIR is given. With IQT_BATCH_SIZE > 1,
+    windows are run IQT_BATCH_SIZE at a time by one IQ-TREE process (see iqtree_batch_task).
+    With IQT_MODEL_SAMPLE > 0 and a model selection IQT_MODEL (i.e., MFP), ModelFinder is only
+    run on a sample of windows per chromosome region (see select_region_models)."""
     set_logger_level(WORKING_DIR, LOG_LEVEL)  # Setup log file level
     freeze_support()  # For Windows support
     check_iqtree_install(IQTREE_PATH)
-    # Set cpu count for multiprocessing
+    # Set the core budget - IQ-TREE runs use up to MULTIPROCESS cores in total
     if type(MULTIPROCESS) == int:
-        try:
-            if int(MULTIPROCESS) > os.cpu_count():
-                print(
-                    f"Requested more CPU's than available on system. Reducing from {int(MULTIPROCESS)} to {os.cpu_count()}"
-                )
-                cpu_count = os.cpu_count()
-            elif IQT_CORES == "AUTO":
-                cpu_count = MULTIPROCESS
-                pass
-            elif int(MULTIPROCESS) < int(IQT_CORES):
-                cpu_count = 1
-                pass
-            else:
-                cpu_count = math.floor(int(MULTIPROCESS) / int(IQT_CORES))
-                pass
-        except ValueError:
-            logger.info(
-                (
-                    f"'{IQT_CORES}' appears to be an invalid response. Valid responses include - [AUTO, integers 1-n]"
-                )
+        if int(MULTIPROCESS) > os.cpu_count():
+            print(
+                f"Requested more CPU's than available on system. Reducing from {int(MULTIPROCESS)} to {os.cpu_count()}"
             )
-            exit()
+            core_budget = os.cpu_count()
+        else:
+            core_budget = int(MULTIPROCESS)
     elif MULTIPROCESS == "all":
-        cpu_count = os.cpu_count()
+        core_budget = os.cpu_count()
     else:
         logger.info(
             (
@@ -257,40 +629,107 @@ def iq_tree(
             )
         )
         return
+    if IQT_CORES != "AUTO":
+        try:
+            int(IQT_CORES)
+        except ValueError:
+            logger.info(
+                (
+                    f"'{IQT_CORES}' appears to be an invalid response. Valid responses include - [AUTO, integers 1-n]"
+                )
+            )
+            exit()
     # Collect Chromosome firs
-    chrom_dirs = sorted([f for f in filtered_indir.iterdir() if f.is_dir()])
-    # Run all files through IQ-Tree
-    manager = Manager()
-    return_dict = manager.dict()
-    p_umap(
-        partial(
-            run_iqtree,
-            filtered_outdir=filtered_outdir,
+    chrom_dirs = sorted([f for f in filtered_indir.iterdir() if f.is_dir() or is_window_archive(f)])
+    MANIFEST = manifest_path(WORKING_DIR)
+    IQT_CACHE = None
+    if IQT_CACHE_DIR is not None:
+        max_bytes = cache_size_to_bytes(IQT_CACHE_MAX_MB) if IQT_CACHE_MAX_MB is not None else None
+        IQT_CACHE = IQTreeCache.for_run(IQT_CACHE_DIR, IQT_MODEL, IQT_BOOTSTRAP, IQTREE_PATH, max_bytes, IQT_BATCH_SIZE > 1)
+        if IQT_CACHE is None:
+            logger.warning("Could not read the IQ-TREE version - running without the IQ-TREE cache")
+    # Run all files through IQ-Tree - archives are extracted to temporary directories
+    with ExitStack() as stack:
+        iqtree_chroms = dict()
+        tasks = list()
+        for c in chrom_dirs:
+            window_dir = stack.enter_context(extracted_windows(c)) if is_window_archive(c) else c
+            chrom_files, dropped_total, records, chrom_tasks = collect_iqtree_windows(
+                window_dir, filtered_outdir, MANIFEST, c if is_window_archive(c) else None
+            )
+            iqtree_chroms[window_dir.name] = (chrom_files, dropped_total, records)
+            tasks += [t._replace(threads=allocate_threads(t.cost, IQT_CORES, core_budget)) for t in chrom_tasks]
+        if IQT_MODEL_SAMPLE and is_model_selection(IQT_MODEL):
+            tasks = select_region_models(
+                tasks,
+                WORKING_DIR,
+                IQT_MODEL,
+                IQT_CORES,
+                IQTREE_PATH,
+                IQT_MODEL_SAMPLE,
+                IQT_MODEL_REGION,
+                core_budget,
+                TASK_TIMEOUT,
+                TASK_RETRIES,
+            )
+        elif IQT_MODEL_SAMPLE:
+            logger.info(f"'{IQT_MODEL}' does not run ModelFinder - every window uses it")
+        SECONDS_PER_CELL = load_seconds_per_cell(WORKING_DIR, IQT_MODEL, IQT_BOOTSTRAP)
+        if SECONDS_PER_CELL is None:
+            SECONDS_PER_CELL = DEFAULT_SECONDS_PER_CELL
+        threads_used = Counter(t.threads for t in tasks)
+        logger.info(f"Running {len(tasks):,} windows on {core_budget} cores - threads per window: " + ", ".join(f"{n} ({threads_used[n]:,} windows)" for n in sorted(threads_used)))
+        logger.info(f"Predicted IQ-TREE run time: {sum(predicted_seconds(t, SECONDS_PER_CELL) for t in tasks):,.1f}s (seconds per cell: {SECONDS_PER_CELL:.3g})")
+        iqtree_settings = dict(
             IQT_MODEL=IQT_MODEL,
             IQT_BOOTSTRAP=IQT_BOOTSTRAP,
             IQT_CORES=IQT_CORES,
             IQTREE_PATH=IQTREE_PATH,
-            return_dict=return_dict,
-        ),
-        chrom_dirs,
-        **{"num_cpus": cpu_count},
-    )
+            IQT_CACHE=IQT_CACHE,
+        )
+        if IQT_BATCH_SIZE > 1:
+            run_tasks = partial(
+                run_batched,
+                partial(
+                    schedule_threaded_tasks,
+                    partial(iqtree_batch_task, **iqtree_settings),
+                    core_budget=core_budget,
+                    TIMEOUT=TASK_TIMEOUT * IQT_BATCH_SIZE if TASK_TIMEOUT is not None else None,
+                    RETRIES=TASK_RETRIES,
+                ),
+                IQT_BATCH_SIZE=IQT_BATCH_SIZE,
+                IQT_CORES=IQT_CORES,
+                core_budget=core_budget,
+            )
+        else:
+            run_tasks = partial(
+                schedule_threaded_tasks,
+                partial(iqtree_window_task, **iqtree_settings),
+                core_budget=core_budget,
+                TIMEOUT=TASK_TIMEOUT,
+                RETRIES=TASK_RETRIES,
+            )
+        results = run_with_cache(run_tasks, tasks, IQT_CACHE)
+        all_results = list()
+        # Log output information as each chromosome finishes
+        for chrom_name, chrom_results in stream_chromosomes(results, tasks, iqtree_chroms.keys()):
+            chrom_files, dropped_total, records = iqtree_chroms[chrom_name]
+            log_info = finish_iqtree_chromosome(chrom_name, chrom_files, dropped_total, records, chrom_results, MANIFEST, SECONDS_PER_CELL)
+            log_iqtree_chromosome(log_info)
+            all_results += chrom_results
+    # Calibrate the cost model from this run's actual run times
+    calibrated = calibrate_seconds_per_cell(all_results)
+    if calibrated is not None:
+        save_seconds_per_cell(WORKING_DIR, IQT_MODEL, IQT_BOOTSTRAP, calibrated)
+        logger.info(f"IQ-TREE cost model calibrated - seconds per cell: {SECONDS_PER_CELL:.3g} -> {calibrated:.3g}")
     # Update all .treefile removing heterotachy info and secondary tree's
     update_tree_files(filtered_outdir)
     # Create initial input file for Tree Viewer
     create_TreeViewer_input(filtered_outdir, treeViewer_filename)
-    # Log output information
-    for c in return_dict.keys():
-        log_info = return_dict[c]
-        for i in log_info:
-            if type(i) == str:
-                logger.info(i)
-            elif type(i) == dict:
-                for n in i.keys():
-                    logger.info(f"-- {n}: {i[n]}")
-                    continue
-            elif type(i) == list:
-                for f in i:
-                    logger.info(f)
-                    continue
+    for line in drop_report_lines(MANIFEST, "iqtree"):
+        logger.info(line)
+    if IQT_CACHE is not None:
+        removed = IQT_CACHE.evict()
+        if removed:
+            logger.info(f"Removed {removed:,} least recently used trees from the IQ-TREE cache")
     return
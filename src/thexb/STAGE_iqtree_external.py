@@ -5,6 +5,9 @@ from ete3 import Tree
 from ete3.parser.newick import NewickError
 import pandas as pd
 
+from thexb.UTIL_file_reader import write_treeviewer_file
+from thexb.UTIL_tree_arrays import map_trees
+
 ############################### Set up logger #################################
 logger = logging.getLogger(__name__)
 
@@ -46,63 +49,67 @@ def update_df(treeviewer_df, chrom, end, tree):
     return treeviewer_df
 
 
-def create_TreeViewer_input(EXTERNAL_PATH, treeviewer_filename):
+def read_contree(f):
+    """Return the tree on the first line of a .contree file, or None if the file is empty"""
+    try:
+        return open(f).readlines()[0].strip()
+    except IndexError:
+        return None
+
+
+def write_tree(raw_tree):
+    """Rewrite a raw tree with ete3. Returns (tree, error) - tree is "NoTree" when error is set"""
+    if raw_tree == "NoTree":
+        return raw_tree, None
+    elif raw_tree is None:
+        return "NoTree", "Empty file"
+    try:
+        return Tree(remove_heterotachy_info(raw_tree)).write(), None
+    except NewickError:
+        return "NoTree", "NewickError"
+
+
+def create_TreeViewer_input(EXTERNAL_PATH, treeviewer_filename, cpu_count=1):
     treeviewer_df = pd.DataFrame(columns=['Chromosome', 'Window', 'NewickTree', 'TopologyID'])
     chrom_dirs = [c for c in EXTERNAL_PATH.iterdir() if c.is_dir()]
     run_type = "single-dir" if len(chrom_dirs) == 0 else "sub-dirs"
+    # Collect (chrom, end, file, raw tree) of each window - trees are parsed in bulk below
+    windows = []
     if run_type == "sub-dirs":
         for chrom in chrom_dirs:
             chrom_files = [f for f in chrom.iterdir() if f.suffix in ['.contree']]
             for f in chrom_files:
+                chrom = f.stem.strip('-DROPPED').split("_")[0]
+                end = f.stem.strip('-DROPPED').split("_")[-1]
                 if "-DROPPED" in f.name:
-                    treeviewer_df = update_df(treeviewer_df, chrom, end, 'NoTree')
-                    continue
-                try:
-                    chrom = f.stem.strip('-DROPPED').split("_")[0]
-                    end = f.stem.strip('-DROPPED').split("_")[-1]
-                    raw_tree = open(f).readlines()[0].strip()
-                    tree = Tree(remove_heterotachy_info(raw_tree))
-                    treeviewer_df = update_df(treeviewer_df, chrom, end, tree.write())
-                    continue
-                except IndexError:
-                    logger.info(f"File failed - Empty file: {f.name}")
-                    treeviewer_df = update_df(treeviewer_df, chrom, end, 'NoTree')
-                    continue
-                except NewickError:
-                    logger.info(f"File failed - NewickError: {f.name}")
-                    treeviewer_df = update_df(treeviewer_df, chrom, end, 'NoTree')
+                    windows.append((chrom, end, f, 'NoTree'))
                     continue
+                windows.append((chrom, end, f, read_contree(f)))
     elif run_type == "single-dir":
         chrom_files = [f for f in EXTERNAL_PATH.iterdir() if f.suffix in ['.contree']]
         for f in chrom_files:
+            chrom = f.stem.strip('-DROPPED').split("_")[0]
+            end = f.stem.strip('-DROPPED').split("_")[-1]
             if "-DROPPED" in f.name:
-                treeviewer_df = update_df(treeviewer_df, chrom, end, 'NoTree')
-                continue
-            try:
-                chrom = f.stem.strip('-DROPPED').split("_")[0]
-                end = f.stem.strip('-DROPPED').split("_")[-1]
-                raw_tree = open(f).readlines()[0].strip()
-                tree = Tree(remove_heterotachy_info(raw_tree))
-                treeviewer_df = update_df(treeviewer_df, chrom, end, tree.write())
-                continue
-            except IndexError:
-                logger.info(f"File failed - Empty file: {f.name}")
-                treeviewer_df = update_df(treeviewer_df, chrom, end, 'NoTree')
-                continue
-            except NewickError:
-                logger.info(f"File failed - NewickError: {f.name}")
-                treeviewer_df = update_df(treeviewer_df, chrom, end, 'NoTree')
+                windows.append((chrom, end, f, 'NoTree'))
                 continue
+            windows.append((chrom, end, f, read_contree(f)))
+    # Parse trees across cpu_count processes
+    trees = map_trees(write_tree, [w[3] for w in windows], cpu_count)
+    for (chrom, end, f, _), (tree, error) in zip(windows, trees):
+        if error is not None:
+            logger.info(f"File failed - {error}: {f.name}")
+        treeviewer_df = update_df(treeviewer_df, chrom, end, tree)
     treeviewer_df['TopologyID'] = [None]*len(treeviewer_df)
     treeviewer_df.sort_values(by=['Chromosome', "Window"], inplace=True)
-    treeviewer_df.to_excel(treeviewer_filename, index=False)
+    write_treeviewer_file(treeviewer_df, treeviewer_filename)
     logger.info(f"TreeViewer file written to: {treeviewer_filename}")
     return
 
 
 ############################### Main Function ################################
-def iq_tree_external(EXTERNAL_PATH, treeviewer_filename, WORKING_DIR, LOG_LEVEL):
+def iq_tree_external(EXTERNAL_PATH, treeviewer_filename, WORKING_DIR, LOG_LEVEL, cpu_count=1):
     set_logger_level(WORKING_DIR, LOG_LEVEL)
-    create_TreeViewer_input(EXTERNAL_PATH, treeviewer_filename)
+    create_TreeViewer_input(EXTERNAL_PATH, treeviewer_filename, cpu_count)
     return
 
@@ -9,14 +9,19 @@ entity.
 # Native imports
 import logging
 import os
+import tempfile
 import textwrap
+import time
 from multiprocessing import freeze_support
 from functools import partial
+from pathlib import Path
 # Dependencies
-from pyfaidx import Fasta
 from p_tqdm import p_umap
 # THEx imports
+from thexb.UTIL_alignment_store import build_alignment_store, decode_sites, open_alignment_store
 from thexb.UTIL_checks import check_fasta
+from thexb.UTIL_run_manifest import VALID, RunManifest, WindowRecord, manifest_path
+from thexb.UTIL_window_archive import WindowArchiveWriter, archive_path
 
 ############################### Set up logger #################################
 logger = logging.getLogger(__name__)
@@ -35,45 +40,71 @@ def get_seq(sample_seq_dict, header, start_pos, end_pos):
     return textwrap.wrap("".join(list(sample_seq_dict[str(header)][start_pos:end_pos])), 80)
 
 
-def parse_chromosome_into_windows(f, WORKING_DIR, WINDOW_SIZE_INT):
-    """Split each chromosome file (or just file) into n-bp windows"""
+def wrap_seq(seq, width=80):
+    """Split sequence into fixed-width lines"""
+    return [seq[i:i + width] for i in range(0, len(seq), width)]
+
+
+def format_window(samples, lengths, matrix, start_pos, end_pos):
+    """Return the fasta text of one window for every sample that reaches it"""
+    records = []
+    for header, seq_len, row in zip(samples, lengths, matrix):
+        # Each sample is split into (seq_len // window size + 1) windows
+        if start_pos > seq_len:
+            continue
+        seq = wrap_seq(decode_sites(row[start_pos:min(end_pos, seq_len)]))
+        records.append(">{}\n{}\n".format(header, "\n".join(seq)))
+    return "".join(records)
+
+
+def parse_chromosome_into_windows(f, WORKING_DIR, WINDOW_SIZE_INT, WINDOW_ARCHIVE=False, MANIFEST=None):
+    """
+    Split each chromosome file (or just file) into n-bp windows. The
+    chromosome is loaded once into an alignment store and each window file
+    is written once with every sample's slice of the window. With
+    WINDOW_ARCHIVE the windows are packed into one archive per chromosome
+    (see UTIL_window_archive) instead of one file per window. Windows are
+    recorded in the run manifest when one is given.
+    """
     chromosome = str(f.stem).replace(".fasta", "").replace(".fa", "").replace(".fna", "").replace(".fas", "")
     try:
-        with Fasta(f.as_posix()) as fasta_file:
-            headers = fasta_file.keys()
-            windowed_outdir = WORKING_DIR / 'windowed_fastas' / f"{chromosome}"
-            windowed_outdir.mkdir(parents=True, exist_ok=True)
-            flag = True
-            for header in list(headers):
-                try:
-                    sample_seq_dict = {str(header): list(fasta_file[str(header)][:].seq)}
-                except KeyError:
-                    break
-                number_of_out_seqs = (len(sample_seq_dict[str(header)]) // WINDOW_SIZE_INT + 1)
-                start_pos = 0
-                end_pos = WINDOW_SIZE_INT
-                for _ in range(number_of_out_seqs):
-                    clean_chromosome_name = chromosome.replace("_", "-")
-                    current_file_path = windowed_outdir / f"{clean_chromosome_name}_{(start_pos + 1)}_{end_pos}.fasta"
-                    if flag:
-                        if current_file_path.is_file():
-                            os.remove(current_file_path)
-                        else:
-                            pass
-                    with open(current_file_path, 'a') as current_file: 
-                        seq = get_seq(sample_seq_dict, header, start_pos, end_pos)
-                        current_file.write(">{}\n".format(header))
-                        current_file.write("{}\n".format("\n".join(seq)))
-                        start_pos += WINDOW_SIZE_INT
-                        end_pos += WINDOW_SIZE_INT
-                flag = False
+        with tempfile.TemporaryDirectory(dir=WORKING_DIR) as store_dir:
+            store = build_alignment_store(f, Path(store_dir) / f"{chromosome}.npy")
+            matrix = open_alignment_store(store)
+            if WINDOW_ARCHIVE:
+                (WORKING_DIR / 'windowed_fastas').mkdir(parents=True, exist_ok=True)
+                writer = WindowArchiveWriter(archive_path(WORKING_DIR / 'windowed_fastas', chromosome))
+            else:
+                windowed_outdir = WORKING_DIR / 'windowed_fastas' / f"{chromosome}"
+                windowed_outdir.mkdir(parents=True, exist_ok=True)
+            clean_chromosome_name = chromosome.replace("_", "-")
+            number_of_out_seqs = (max(store.lengths, default=-1) // WINDOW_SIZE_INT + 1)
+            records = []
+            for start_pos in range(0, number_of_out_seqs * WINDOW_SIZE_INT, WINDOW_SIZE_INT):
+                window_start_time = time.perf_counter()
+                end_pos = start_pos + WINDOW_SIZE_INT
+                window_name = f"{clean_chromosome_name}_{(start_pos + 1)}_{end_pos}.fasta"
+                window = format_window(store.samples, store.lengths, matrix, start_pos, end_pos)
+                if WINDOW_ARCHIVE:
+                    writer.add(window_name, window)
+                    output = writer.path
+                else:
+                    output = windowed_outdir / window_name
+                    with open(output, 'w') as current_file:
+                        current_file.write(window)
+                records.append(WindowRecord(window_name, VALID, None, output.as_posix(), time.perf_counter() - window_start_time))
+            if WINDOW_ARCHIVE:
+                writer.close()
+            if MANIFEST is not None:
+                with RunManifest(MANIFEST) as manifest:
+                    manifest.record("minifastas", chromosome, records)
     except:
         logger.warning(f"Run failed with file {chromosome}")
     return
 
 
 ############################### Main Function ################################
-def fasta_windower(MULTI_ALIGNMENT_DIR, WORKING_DIR, WINDOW_SIZE_STR, WINDOW_SIZE_INT, MULTIPROCESS, LOG_LEVEL):
+def fasta_windower(MULTI_ALIGNMENT_DIR, WORKING_DIR, WINDOW_SIZE_STR, WINDOW_SIZE_INT, WINDOW_ARCHIVE, MULTIPROCESS, LOG_LEVEL):
     logger = set_logger(WORKING_DIR, LOG_LEVEL)
     freeze_support()
     # Check if MULTI_ALIGNMENT_DIR is a file or dir
@@ -93,7 +124,7 @@ def fasta_windower(MULTI_ALIGNMENT_DIR, WORKING_DIR, WINDOW_SIZE_STR, WINDOW_SIZ
     elif MULTIPROCESS == 'all':
         cpu_count = os.cpu_count()
     # Run chromosomes in parallel
-    p_umap(partial(parse_chromosome_into_windows, WORKING_DIR=WORKING_DIR, WINDOW_SIZE_INT=WINDOW_SIZE_INT), chrom_files, **{"num_cpus": cpu_count})
+    p_umap(partial(parse_chromosome_into_windows, WORKING_DIR=WORKING_DIR, WINDOW_SIZE_INT=WINDOW_SIZE_INT, WINDOW_ARCHIVE=WINDOW_ARCHIVE, MANIFEST=manifest_path(WORKING_DIR)), chrom_files, **{"num_cpus": cpu_count})
     return
 
 
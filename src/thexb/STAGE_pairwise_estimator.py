@@ -4,20 +4,27 @@ Author: Andrew Harris
 Goal: Randomly choose trees from each chromosome and calculate average coverage and p-distance
 per-sample and report back. 
 
+Windows are drawn uniformly without replacement in batches. After each batch,
+bootstrap confidence intervals of the suggested parameters are calculated and
+sampling stops once they are narrower than PW_EST_CI_WIDTH (or once
+PW_EST_PERCENT_CHROM of the windows have been sampled).
+
 Need to add: Return a set of parameter values that may work for the data tested
 """
 import logging
 import math
 import os
-from pathlib import Path
+from collections import namedtuple
+from functools import lru_cache
+from multiprocessing import Pool
 from pprint import pformat
-import random
-import shutil
 import statistics
+import warnings
 
-from pyfaidx import Fasta
+import numpy as np
 
-from thexb.UTIL_checks import check_fasta
+from thexb.UTIL_run_manifest import is_dropped, manifest_path, previously_dropped, window_files
+from thexb.UTIL_window_archive import ArchivedWindow, WindowArchive, is_window_archive, parse_fasta_text
 
 ############################### Set up logger #################################
 logger = logging.getLogger(__name__)
@@ -31,82 +38,100 @@ def set_logger_level(WORKING_DIR, LOG_LEVEL):
     logger.setLevel(LOG_LEVEL)
     return logger
 
+# Bases counted as valid coverage (soft masked bases are not counted)
+VALID_BASE_CODES = np.frombuffer(b"ATGC", dtype=np.uint8)
+# Sequential sampling - windows are drawn in batches until the confidence intervals
+# of the suggested parameters are narrower than PW_EST_CI_WIDTH
+PWE_BATCH_SIZE = 50
+PWE_MIN_WINDOWS = 100
+PWE_BOOTSTRAPS = 200
+PWE_CONFIDENCE = 0.95
+PARAMETER_NAMES = ["max_pDistance_cutoff", "Zscore", "pairwise_coverage_cutoff"]
+
+# Per-sample coverage + p-distance to the reference of one window ({sample: value}).
+# pdistance is None when the reference is not in the window.
+WindowStatistics = namedtuple("WindowStatistics", ["coverage", "pdistance"])
+
 ############################## Helper Functions ###############################
-def count_valid_bases(seq):
-    """Counts valid bases in sequence. Soft masked bases valid"""
-    valid_bases = ['A', 'T', 'G', 'C']
-    valid_base_count = 0
-    for base in seq:
-        if base not in valid_bases:
-            continue
-        else:
-            valid_base_count += 1
-            continue
-    return valid_base_count
+@lru_cache(maxsize=16)
+def _open_archive(path):
+    """Keep archives open in a worker across the windows read from them"""
+    return WindowArchive(path)
+
+
+def read_window(f):
+    """Return {sample: sequence} of a window file or an ArchivedWindow"""
+    if isinstance(f, ArchivedWindow):
+        return _open_archive(f.archive).records(f.name)
+    return parse_fasta_text(f.read_text())
+
+
+def window_statistics(f, PW_REF):
+    """
+    Calculate the coverage and p-distance of every sample in a window from a
+    single read of the file. Returns WindowStatistics, or None when the window
+    has an empty or unaligned sequence.
+    """
+    seqs = read_window(f)
+    samples = list(seqs.keys())
+    lengths = np.array([len(seq) for seq in seqs.values()])
+    if (not samples) or (lengths.min() == 0):
+        return None
+    codes = np.frombuffer("".join(seqs.values()).encode("ascii"), dtype=np.uint8)
+    # Valid bases per sequence - each sequence is a segment of codes
+    offsets = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    valid_bases = np.add.reduceat(np.isin(codes, VALID_BASE_CODES).astype(np.int64), offsets)
+    coverage = dict(zip(samples, (valid_bases / lengths).tolist()))
+    if PW_REF not in seqs:
+        return WindowStatistics(coverage, None)
+    if len(set(lengths.tolist())) != 1:
+        return None
+    seq_len = int(lengths[0])
+    matrix = codes.reshape(len(samples), seq_len)
+    # Count number of incorrect pairings
+    mismatches = np.count_nonzero(matrix != matrix[samples.index(PW_REF)], axis=1)
+    pdistance = {s: m / seq_len for s, m in zip(samples, mismatches.tolist()) if s != PW_REF}
+    return WindowStatistics(coverage, pdistance)
+
+
+def _window_statistics_task(args):
+    f, PW_REF = args
+    return window_statistics(f, PW_REF)
+
+
+def mean_and_median(values):
+    """Return the average + median of each sample's values ({sample: [values]})"""
+    per_sample_mean = dict()
+    per_sample_median = dict()
+    for s in values.keys():
+        per_sample_mean[s] = round(statistics.mean(values[s]), 4)
+        per_sample_median[s] = round(statistics.median(values[s]), 4)
+    return per_sample_mean, per_sample_median
+
+
+def collect_values(window_stats, field):
+    """Collect each sample's values of a WindowStatistics field across windows"""
+    values = dict()
+    for stats in window_stats:
+        for sample, value in getattr(stats, field).items():
+            values.setdefault(sample, []).append(value)
+    return values
 
 
 def coverage_and_median(random_windows):
     """ Calculate the average coverage per-sample """
-    per_sample_cov_list = dict()
-    for f in random_windows:
-        with Fasta(f.as_posix()) as fh:
-            headers = [k for k in fh.keys()]
-            for sample in headers:
-                seq = fh[sample][:].seq
-                valid_bases = count_valid_bases(seq)
-                seq_coverage = valid_bases / len(seq)
-                try:
-                    per_sample_cov_list[sample].append(seq_coverage)
-                except KeyError:
-                    per_sample_cov_list[sample] = [seq_coverage]
-                continue  
-    # Calculate avergae coverage per-sample
-    per_sample_cov = dict()
-    per_sample_median = dict()
-    for s in per_sample_cov_list.keys():
-        per_sample_cov[s] = round(statistics.mean(per_sample_cov_list[s]), 4)
-        per_sample_median[s] = round(statistics.median(per_sample_cov_list[s]), 4)
-    return per_sample_cov, per_sample_median
+    window_stats = [window_statistics(f, None) for f in random_windows]
+    return mean_and_median(collect_values([w for w in window_stats if w is not None], "coverage"))
 
 
 def p_distance(random_windows, PW_REF):
     """ Calculate the average p-distance per-sample """
-    collective_pdistance = dict()
-    for f in random_windows:
-        with Fasta(f.as_posix()) as fh:
-            headers = [k for k in fh.keys()]
-            try:
-                assert PW_REF in headers
-            except AssertionError:
-                logger.error(f"Provided reference, {PW_REF}, was not found in file headers. Please check reference or input file and rerun")
-                exit()
-            headers.pop(headers.index(PW_REF))
-            ref_seq = fh[PW_REF][:].seq
-            for sample in headers:
-                sample_mismatch_count = 0
-                sample_seq = fh[sample][:].seq
-                assert len(sample_seq) == len(ref_seq)
-                # Count number of incorrect pairings
-                for rb, sb, in zip(ref_seq, sample_seq):
-                    try:
-                        assert rb == sb
-                        continue
-                    except AssertionError:
-                        sample_mismatch_count += 1
-                        continue
-                sample_pdistance = sample_mismatch_count / len(sample_seq)
-                try:
-                    collective_pdistance[sample].append(sample_pdistance)
-                except KeyError:
-                    collective_pdistance[sample] = [sample_pdistance]
-                continue
-    avg_pdistance = dict()
-    per_sample_median = dict()
-    for s in collective_pdistance.keys():
-        avg_pdistance[s] = round(statistics.mean(collective_pdistance[s]), 4)
-        per_sample_median[s] = round(statistics.median(collective_pdistance[s]), 4)
-        continue
-    return avg_pdistance, per_sample_median
+    window_stats = [window_statistics(f, PW_REF) for f in random_windows]
+    window_stats = [w for w in window_stats if w is not None]
+    if any(w.pdistance is None for w in window_stats):
+        logger.error(f"Provided reference, {PW_REF}, was not found in file headers. Please check reference or input file and rerun")
+        exit()
+    return mean_and_median(collect_values(window_stats, "pdistance"))
 
 
 def return_suggested_parameters(avg_coverage, p_distance_median):
@@ -119,46 +144,149 @@ def return_suggested_parameters(avg_coverage, p_distance_median):
     suggested_pdist = round((max_pdist * 1.1), 4)
 
     median_pdist = statistics.median([d for d in p_distance_median.values()])
-    std_pdist = statistics.stdev([d for d in p_distance_median.values()])
 
     # Z-score rounded up to nearest whole number
     try:
+        std_pdist = statistics.stdev([d for d in p_distance_median.values()])
         zscore = math.ceil((max_pdist - median_pdist) / std_pdist)
-    except ZeroDivisionError:
+    except (ZeroDivisionError, statistics.StatisticsError):
         zscore = 1
     return suggested_pdist, zscore, suggest_cov
 
+
+def _sample_matrix(window_stats, field):
+    """(windows x samples) array of a WindowStatistics field - NaN where a window has no value for a sample"""
+    samples = sorted({s for w in window_stats for s in getattr(w, field)})
+    matrix = np.full((len(window_stats), len(samples)), np.nan)
+    for row, w in enumerate(window_stats):
+        for col, s in enumerate(samples):
+            matrix[row, col] = getattr(w, field).get(s, np.nan)
+    return samples, matrix
+
+
+def bootstrap_intervals(window_stats, rng, num_bootstraps=PWE_BOOTSTRAPS, confidence=PWE_CONFIDENCE):
+    """
+    Bootstrap confidence intervals (resampling the sampled windows) of the
+    suggested parameters. Returns [(low, high)] in the order of
+    return_suggested_parameters(), or None when no resample has p-distances.
+    """
+    cov_samples, coverage = _sample_matrix(window_stats, "coverage")
+    pdist_samples, pdistance = _sample_matrix(window_stats, "pdistance")
+    replicates = []
+    with warnings.catch_warnings():
+        # Samples missing from every resampled window give NaN and are left out
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        for _ in range(num_bootstraps):
+            idx = rng.integers(0, len(window_stats), len(window_stats))
+            cov = np.nanmean(coverage[idx], axis=0)
+            pdist = np.nanmedian(pdistance[idx], axis=0)
+            avg_coverage = {s: c for s, c in zip(cov_samples, cov.tolist()) if not math.isnan(c)}
+            pdist_median = {s: d for s, d in zip(pdist_samples, pdist.tolist()) if not math.isnan(d)}
+            if avg_coverage and pdist_median:
+                replicates.append(return_suggested_parameters(avg_coverage, pdist_median))
+    if not replicates:
+        return None
+    # Interval ends are replicate values, so the Z-score interval stays whole numbers
+    tail = int(((1 - confidence) / 2) * len(replicates))
+    intervals = []
+    for values in zip(*replicates):
+        values = sorted(values)
+        intervals.append((values[tail], values[len(values) - 1 - tail]))
+    return intervals
+
+
+def intervals_are_stable(intervals, PW_EST_CI_WIDTH):
+    """Intervals are stable when the p-distance + coverage cutoffs are within PW_EST_CI_WIDTH and the Z-score is fixed"""
+    if intervals is None:
+        return False
+    (pdist_low, pdist_high), (zscore_low, zscore_high), (cov_low, cov_high) = intervals
+    return ((pdist_high - pdist_low) <= PW_EST_CI_WIDTH) and ((cov_high - cov_low) <= PW_EST_CI_WIDTH) and (zscore_low == zscore_high)
+
+
+def format_intervals(intervals):
+    if intervals is None:
+        return "not available"
+    return ", ".join(f"{name} [{low}, {high}]" for name, (low, high) in zip(PARAMETER_NAMES, intervals))
+
+
+def sequential_sample(windows, PW_REF, max_windows, PW_EST_CI_WIDTH, cpu_count):
+    """
+    Draw windows uniformly at random without replacement, PWE_BATCH_SIZE at
+    a time, until the confidence intervals of the suggested parameters are
+    stable or max_windows have been sampled. Each batch of windows is read
+    across a process pool. Returns (window statistics, intervals, number of
+    windows skipped, stopped early?)
+    """
+    rng = np.random.default_rng()
+    order = [windows[i] for i in rng.permutation(len(windows))[:max_windows]]
+    window_stats = []
+    skipped = 0
+    intervals = None
+    with Pool(processes=cpu_count) as process_pool:
+        for batch_start in range(0, len(order), PWE_BATCH_SIZE):
+            batch = order[batch_start:batch_start + PWE_BATCH_SIZE]
+            for stats in process_pool.imap_unordered(_window_statistics_task, [(f, PW_REF) for f in batch]):
+                if stats is None:
+                    skipped += 1
+                    continue
+                if stats.pdistance is None:
+                    return None, None, skipped, False
+                window_stats.append(stats)
+            if (len(window_stats) < PWE_MIN_WINDOWS) and (batch_start + PWE_BATCH_SIZE < len(order)):
+                continue
+            if not any(w.pdistance for w in window_stats):
+                continue
+            intervals = bootstrap_intervals(window_stats, rng)
+            logger.info(f"{len(window_stats):,} windows sampled - {int(PWE_CONFIDENCE * 100)}% CI: {format_intervals(intervals)}")
+            if intervals_are_stable(intervals, PW_EST_CI_WIDTH):
+                return window_stats, intervals, skipped, True
+    return window_stats, intervals, skipped, False
+
 ############################### Main Function ################################
-def pairwise_estimator(filtered_indir, PW_REF, PW_EST_PERCENT_CHROM, WORKING_DIR, LOG_LEVEL):
-    """Uses n-randomly chosen windows to calculate average p-distance and average coverage"""
+def pairwise_estimator(filtered_indir, PW_REF, PW_EST_PERCENT_CHROM, WORKING_DIR, LOG_LEVEL, PW_EST_CI_WIDTH=0.01, cpu_count=os.cpu_count()):
+    """Samples random windows until estimates of the suggested parameters are stable and
+    reports average p-distance and average coverage"""
     set_logger_level(WORKING_DIR, LOG_LEVEL)
 
-    chrom_dirs = [d for d in filtered_indir.iterdir() if d.is_dir()]
-    all_random_chrom_files = []
+    chrom_dirs = [d for d in filtered_indir.iterdir() if d.is_dir() or is_window_archive(d)]
+    all_windows = []
+    max_windows = 0
 
-    # Collect random files from each chromosome
+    # Collect windows from each chromosome - at most PW_EST_PERCENT_CHROM of each chromosome's windows are sampled
     for chrom in sorted(chrom_dirs):
-        # logger.info(f"Collecting {PW_EST_PERCENT_CHROM} random files from Chromosome {chrom.stem}")
-        # List windows from dir + select random windows
-        
-        windows = [f for f in chrom.iterdir() if check_fasta(f) & ("-DROPPED" not in f.name)]
-        logger.info(f"Collecting {int(len(windows) * PW_EST_PERCENT_CHROM)} windows from Chromosome {chrom.stem}")
-        random_file_nums = [random.randint(0, int(len(windows) * PW_EST_PERCENT_CHROM)) for _ in range(int(len(windows) * PW_EST_PERCENT_CHROM))]
-        try:
-            random_chrom_windows = [windows[i] for i in random_file_nums]
-            all_random_chrom_files += random_chrom_windows
-        except IndexError:
-            logger.info(f"Error encountered. Possibly too few files to run. Check input parameters and rerun.")
+        if is_window_archive(chrom):
+            with WindowArchive(chrom) as archive:
+                dropped = previously_dropped(manifest_path(WORKING_DIR), archive.chromosome, chrom)
+                windows = [ArchivedWindow(chrom, n) for n in archive.names() if not is_dropped(n, dropped)]
+        else:
+            dropped = previously_dropped(manifest_path(WORKING_DIR), chrom.name, chrom)
+            windows = [f for f in window_files(manifest_path(WORKING_DIR), chrom.name, chrom) if not is_dropped(f.name, dropped)]
+        logger.info(f"Chromosome {chrom.stem}: {len(windows):,} windows, up to {int(len(windows) * PW_EST_PERCENT_CHROM):,} sampled")
+        all_windows += windows
+        max_windows += int(len(windows) * PW_EST_PERCENT_CHROM)
         continue
     # Ensure there are windows collected
     try:
-        assert len(all_random_chrom_files) > 0
+        assert max_windows > 0
     except AssertionError:
         logger.error("*** No files were collected. Increase percentage of chromosome sampled and rerun ***")
         return
-    logger.info(f"Number of random windows: {len(all_random_chrom_files):,}\n")
+    logger.info(f"Sampling up to {max_windows:,} of {len(all_windows):,} windows - stopping when {int(PWE_CONFIDENCE * 100)}% confidence intervals are narrower than {PW_EST_CI_WIDTH}\n")
+    window_stats, intervals, skipped, stopped_early = sequential_sample(all_windows, PW_REF, max_windows, PW_EST_CI_WIDTH, cpu_count)
+    if window_stats is None:
+        logger.error(f"Provided reference, {PW_REF}, was not found in file headers. Please check reference or input file and rerun")
+        return
+    if skipped:
+        logger.warning(f"{skipped:,} windows with empty or unaligned sequences were skipped")
+    if not any(w.pdistance for w in window_stats):
+        logger.error("*** No windows with samples other than the reference were sampled ***")
+        return
+    if stopped_early:
+        logger.info(f"Estimates stable after {len(window_stats):,} windows\n")
+    else:
+        logger.info(f"Sampled {len(window_stats):,} windows - increase percentage of chromosome sampled for tighter estimates\n")
     # Calculate average + median coverage per sample + log
-    avg_coverage, cov_median = coverage_and_median(all_random_chrom_files)
+    avg_coverage, cov_median = mean_and_median(collect_values(window_stats, "coverage"))
     logger.info("Average Coverage:")
     logger.info("-----------------")
     logger.info(pformat(avg_coverage))
@@ -168,7 +296,7 @@ def pairwise_estimator(filtered_indir, PW_REF, PW_EST_PERCENT_CHROM, WORKING_DIR
     logger.info(pformat(cov_median))
     logger.info("-----------------\n")
     # Calculate average p-distance per sample + log
-    avg_p_distance, pdist_median = p_distance(all_random_chrom_files, PW_REF)
+    avg_p_distance, pdist_median = mean_and_median(collect_values(window_stats, "pdistance"))
     logger.info("Average p-distance:")
     logger.info("-----------------")
     logger.info(pformat(avg_p_distance))
@@ -188,6 +316,8 @@ def pairwise_estimator(filtered_indir, PW_REF, PW_EST_PERCENT_CHROM, WORKING_DIR
     logger.info(f"Zscore = {zscore}")
     logger.info(f"pairwise_coverage_cutoff = {suggest_cov}")
     logger.info("-----------------")
+    if intervals is not None:
+        logger.info(f"{int(PWE_CONFIDENCE * 100)}% confidence intervals: {format_intervals(intervals)}")
     return
 
 
@@ -6,15 +6,21 @@ and updated to Python3
 import logging
 import math
 import os
-import textwrap
-from multiprocessing import Manager
-from functools import partial
+import tempfile
+from collections import namedtuple
+from contextlib import ExitStack
+from functools import lru_cache, partial
+from pathlib import Path
 
-from p_tqdm import p_umap
+import numpy as np
 from pyfaidx import Fasta
 from tqdm.auto import tqdm
 
-from thexb.UTIL_checks import check_fasta
+from thexb.UTIL_alignment_store import load_code_matrix
+from thexb.UTIL_encoding import CodeMatrix, encode_char, is_gap, is_letter
+from thexb.UTIL_run_manifest import DROPPED, VALID, RunManifest, WindowRecord, drop_report_lines, is_dropped, manifest_path, previously_dropped, window_files
+from thexb.UTIL_scheduler import WindowTask, run_tasks_serially, schedule_tasks, stream_chromosomes
+from thexb.UTIL_window_archive import WindowArchive, archive_path, is_window_archive, pack_window_dir
 
 ############################### Set up logger #################################
 logger = logging.getLogger(__name__)
@@ -29,6 +35,9 @@ def set_logger_level(WORKING_DIR, LOG_LEVEL):
     return logger
 
 
+NEWLINE_CODE = ord("\n")
+
+
 ############################## Helper Functions ###############################
 def WriteOUT(outfile, output):
     OUT = open(outfile, 'w')
@@ -36,12 +45,19 @@ def WriteOUT(outfile, output):
     OUT.close()
 
 
-def FormatDictionaryOfNucleotideSeqsToFasta(d, Ns):
-    o=[]
-    for k in Ns:
-        seq_wrapped = '\n'.join(textwrap.wrap(d[k], width=80, break_on_hyphens=False))
-        o.append(f">{k}\n{seq_wrapped}")
-    return "\n".join(o)
+def FormatMatrixOfNucleotideSeqsToFasta(samples, matrix, width=80):
+    """Formats the rows of an alignment matrix (CodeMatrix) as fasta, wrapping sequences every width sites.
+    Each row's newlines are inserted with one array assignment instead of wrapping strings."""
+    records = []
+    for i, (n, seq_len) in enumerate(zip(samples, matrix.lengths)):
+        row = matrix.decode_row(i)
+        num_lines = -(-seq_len // width)
+        wrapped = np.empty(max(seq_len + num_lines - 1, 0), dtype=np.uint8)
+        newlines = (np.arange(len(wrapped)) % (width + 1)) == width
+        wrapped[newlines] = NEWLINE_CODE
+        wrapped[~newlines] = row
+        records.append(f">{n}\n{wrapped.tobytes().decode('ascii')}")
+    return "\n".join(records)
 
 
 def Return1IfValueIsGreaterThanCutoffForAllInDictionary(perccov, PCcutoff, countshit):
@@ -57,50 +73,6 @@ def Return1IfValueIsGreaterThanCutoffForAllInDictionary(perccov, PCcutoff, count
     return boolean
 
 
-def CalculatePercentAACoverageForEachSequenceInDictionary(newseqs, lenseqs, PW_MISSING_CHAR):
-    """Calculates percent coverage for full-length window and returns a dictionary of coverage per newseq"""
-    perccov = {}
-    for n in newseqs.keys():
-        num_valid_bases = 0.0
-        for char in newseqs[n]:
-            if char != '-' and char != PW_MISSING_CHAR and char.isalpha():
-                num_valid_bases += 1.0
-        try:
-            perccov[n] = float(num_valid_bases/lenseqs)
-        except ZeroDivisionError:
-            logger.error(f"No sequence found - check input and restart run.")
-            exit()
-    return perccov
-
-
-def MaskAlignedSeqsUsingStartAndEndCoordinates(seqs, start, end, PW_MISSING_CHAR, PW_WINDOW_SIZE ,lenseqs):
-    """Masks regions were p-distance """
-    for n in seqs.keys():
-        try:
-            start[n]
-        except:
-            pass
-        else:
-            for s,e in zip(start[n], end[n]):
-                mask = ''
-                for char in seqs[n][s-1:e]:
-                    if char == '-':
-                        mask += char
-                    else:
-                        mask += PW_MISSING_CHAR
-                seqs[n] = seqs[n][:s-1] + mask + seqs[n][e:]
-    return seqs
-
-
-def RecordValueIfGreaterThanTwoStandardDevsAwayFromMean(median, stddev, PW_ZSCORE, PW_PDIST_CUTOFF, pdist, i, PW_WINDOW_SIZE, start, end):
-    for n in pdist.keys():
-        # value must be significantly different according to PW_ZSCORE and also greater than p-distance cutoff.
-        if pdist[n] > (median+(PW_ZSCORE*stddev)) and pdist[n] > PW_PDIST_CUTOFF:
-            start[n] = start.get(n, []) + [i+1]
-            end[n] = end.get(n, []) + [i+PW_WINDOW_SIZE]
-    return start, end
-
-
 def MakeNewReducedListAndExcludeKeyValues(d, PW_EXCLUDE_LIST):
     """Removes samples in exclusion list from windows (i.e. reference sample)"""
     newdict = {}
@@ -159,41 +131,145 @@ def CalculatePairwiseDeletionDistanceForAlignedSeqsComparedToRefSeq(seqs, PW_REF
     return pdist, xlist
 
 
+def _window_sums(indicator, starts, ends):
+    """Sum of a per-site indicator array over every [start, end) sub-window"""
+    cumulative = np.zeros(len(indicator) + 1, dtype=np.int64)
+    np.cumsum(indicator, out=cumulative[1:])
+    return cumulative[ends] - cumulative[starts]
+
+
+def _sequential_sum(rows):
+    """Sum rows in order - matches sum() of a list so results are identical to the per-window path"""
+    total = np.zeros(rows.shape[1])
+    for row in rows:
+        total = total + row
+    return total
+
+
+def _seqs_to_matrix(seqs):
+    """Return (samples, matrix) of {sample: sequence} - matrix is a CodeMatrix that keeps each site's case"""
+    samples = list(seqs.keys())
+    matrix = CodeMatrix.from_sequences(seqs.values(), [len(seqs[n]) for n in samples], keep_case=True)
+    return samples, matrix
+
+
+def SubWindowPairwiseDeletionDistances(matrix, ref, starts, PW_WINDOW_SIZE, PW_MISSING_CHAR):
+    """Calculates the p-distance of every row of an alignment matrix (CodeMatrix) to row ref for every
+    sub-window at once. Per-site mismatch/missing/called indicators are summed over each
+    sub-window with a cumulative sum, giving the same values as running
+    CalculatePairwiseDeletionDistanceForAlignedSeqsComparedToRefSeq on each sub-window.
+    Returns a (samples x sub-windows) array
+    """
+    ref_codes = matrix.row(ref)
+    # Codes are case-insensitive, so only an upper-case missing character can match b.upper()
+    missing_code = encode_char(PW_MISSING_CHAR) if len(PW_MISSING_CHAR) == 1 and PW_MISSING_CHAR == PW_MISSING_CHAR.upper() else None
+    pdist = np.empty((len(matrix), len(starts)))
+    for n, seq_len in enumerate(matrix.lengths):
+        # b is query base, r is reference base - sites past the shorter sequence are not compared
+        length = min(seq_len, len(ref_codes))
+        b = matrix.row(n)[:length]
+        gap = is_gap(b)
+        missing = ~gap & (b == missing_code)
+        called = ~gap & ~missing
+        mismatch = called & (b != ref_codes[:length])
+        sub_starts = np.minimum(starts, length)
+        sub_ends = np.minimum(starts + PW_WINDOW_SIZE, length)
+        countmissing = _window_sums(missing, sub_starts, sub_ends)
+        countmismatch = _window_sums(mismatch, sub_starts, sub_ends)
+        denominator = _window_sums(called, sub_starts, sub_ends)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            values = countmismatch + countmissing / denominator
+        pdist[n] = np.where(denominator != 0, values, 0.0000001) # initiate very small Non-zero frequency value
+    return pdist
+
+
+def FindOutlierSubWindows(samples, matrix, lenseqs, PW_WINDOW_SIZE, PW_STEP, PW_MISSING_CHAR, PW_REF, PW_ZSCORE, PW_PDIST_CUTOFF, PW_EXCLUDE_LIST):
+    """Splits an alignment matrix (CodeMatrix) into sub windows, calculates p-distance, removes samples from
+    exlusion list + records where a sub-window has a p-dist greater than X stdevs from mean.
+    Every sub-window is calculated at once with array operations.
+    Returns the sub-window starts and a (samples x sub-windows) boolean array of sub-windows to mask
+    """
+    # NOTE: Check to ensure reference sample is in file
+    # Required for calculating p-distance
+    if PW_REF in list(samples) == False:
+        return "NoReference"
+    starts = np.arange(0, lenseqs, PW_STEP)
+    flags = np.zeros((len(samples), len(starts)), dtype=bool)
+    if not len(starts):
+        return starts, flags
+    ref = dict(zip(samples, range(len(samples))))[PW_REF]
+    pdist = SubWindowPairwiseDeletionDistances(matrix, ref, starts, PW_WINDOW_SIZE, PW_MISSING_CHAR)
+    # Puts single taxa in list, otherwise does nothing
+    xlist = list(PW_EXCLUDE_LIST) if type(PW_EXCLUDE_LIST) == str else PW_EXCLUDE_LIST
+    keep = np.array([n not in xlist for n in samples], dtype=bool)
+
+    # Skip windows that have 1 or 0 samples
+    if keep.sum() <= 1:
+        logger.debug(f"No valid data: {len(starts)} sub-windows")
+        return starts, flags
+    values = pdist[keep]
+    # we use median instead of mean because less influence from outliers
+    sorts = np.sort(values, axis=0)
+    length = len(sorts)
+    if length % 2 == 0:
+        median = (sorts[int(length / 2)] + sorts[int(length / 2 - 1)]) / 2.0
+    else:
+        median = sorts[int(length / 2)]
+    # Sample standard deviation (Bessel's correction)
+    mn = (_sequential_sum(values) * 1.0) / length
+    variance = _sequential_sum((values - mn)**2) / (length - 1)
+    stddev = np.sqrt(variance)
+    # value must be significantly different according to PW_ZSCORE and also greater than p-distance cutoff.
+    flags[keep] = (values > (median + (PW_ZSCORE * stddev))) & (values > PW_PDIST_CUTOFF)
+    return starts, flags
+
+
+def MaskAlignedMatrixAndCalculatePercentCoverage(matrix, lenseqs, starts, flags, PW_WINDOW_SIZE, PW_MISSING_CHAR):
+    """Masks the flagged sub-windows of each row of a CodeMatrix in place (gaps are kept) and calculates
+    the percent coverage (valid bases / lenseqs) of each masked row in the same pass"""
+    if lenseqs == 0:
+        logger.error(f"No sequence found - check input and restart run.")
+        exit()
+    missing_code = encode_char(PW_MISSING_CHAR)
+    missing_lower = PW_MISSING_CHAR.islower()
+    perccov = np.empty(len(matrix))
+    for n, (row_flags, seq_len) in enumerate(zip(flags, matrix.lengths)):
+        codes = matrix.row(n)
+        lower = matrix.lower_row(n)
+        if row_flags.any():
+            # +1/-1 at the start/end of each flagged sub-window -> sites covered by any of them
+            cover = np.zeros(seq_len + 1, dtype=np.int64)
+            np.add.at(cover, np.minimum(starts[row_flags], seq_len), 1)
+            np.add.at(cover, np.minimum(starts[row_flags] + PW_WINDOW_SIZE, seq_len), -1)
+            masked = (np.cumsum(cover[:-1]) > 0) & ~is_gap(codes)
+            codes[masked] = missing_code
+            lower[masked] = missing_lower
+            matrix.set_row(n, codes, lower)
+        # Valid bases are letters other than the missing character (case-sensitive)
+        missing = (codes == missing_code) & (lower == missing_lower)
+        num_valid_bases = np.count_nonzero(is_letter(codes) & ~missing)
+        perccov[n] = float(num_valid_bases / lenseqs)
+    return perccov
+
+
 def SplitAlignedSeqsIntoWindows(seqs, lenseqs, PW_WINDOW_SIZE, PW_STEP, PW_MISSING_CHAR, PW_REF, PW_ZSCORE, PW_PDIST_CUTOFF, PW_EXCLUDE_LIST):
     """Splits sequences into sub windows, calculates p-distance, removes samples from exlusion list,
     records if sub-window has a p-dist greater than X stdevs from mean, 
     then masks the sequences where p-distance is too high for a given taxa
     """
-    start = {} # if window pdist is > cutoff record start and end positions of alignment for indiv
-    end = {}
-    num_invalid = 0
-
-    # NOTE: Check to ensure reference sample is in file
-    # Required for calculating p-distance
-    if PW_REF in list(seqs.keys()) == False:
-        return "NoReference"
-    for i in range(0, lenseqs, PW_STEP):
-        window = {}
-        for n in seqs.keys(): # cut one window for all aligned sequences in seqs.
-            window[n] = seqs[n][i:(i+PW_WINDOW_SIZE)]
-        pdist, xlist = CalculatePairwiseDeletionDistanceForAlignedSeqsComparedToRefSeq(window, PW_REF, PW_EXCLUDE_LIST, PW_MISSING_CHAR)
-        redpdist = MakeNewReducedListAndExcludeKeyValues(pdist, xlist)
-
-        # Skip windows that have 1 or 0 samples
-        if len(redpdist.values()) <= 1:
-            logger.debug(f"No valid data: {num_invalid}")
-            num_invalid += 1
-            continue
-        # mean = Mean(redpdist.values())  # NOT USED
-        median = Median(redpdist.values())
-        stddev = StandardDeviation(redpdist.values())
-        # we use median instead of mean because less influence from outliers
-        start, end = RecordValueIfGreaterThanTwoStandardDevsAwayFromMean(median, stddev, PW_ZSCORE, PW_PDIST_CUTOFF, redpdist, i, PW_WINDOW_SIZE, start, end)
-    
+    samples, matrix = _seqs_to_matrix(seqs)
+    outliers = FindOutlierSubWindows(samples, matrix, lenseqs, PW_WINDOW_SIZE, PW_STEP, PW_MISSING_CHAR, PW_REF, PW_ZSCORE, PW_PDIST_CUTOFF, PW_EXCLUDE_LIST)
+    if outliers == "NoReference":
+        return outliers
+    starts, flags = outliers
+    if not flags.any():
+        return seqs
+    MaskAlignedMatrixAndCalculatePercentCoverage(matrix, lenseqs, starts, flags, PW_WINDOW_SIZE, PW_MISSING_CHAR)
     # FORMAT: newseqs = {"sample1": "ATCT...ACCG", "sample2": "ATCT...ACCG"}
     # NOTE: Sequences returned are back to full window length (i.e., 100kb)
-    newseqs = MaskAlignedSeqsUsingStartAndEndCoordinates(seqs, start, end, PW_MISSING_CHAR, PW_WINDOW_SIZE, lenseqs)
-    return newseqs
+    for i, n in enumerate(samples):
+        seqs[n] = matrix.decode_row(i).tobytes().decode("ascii")
+    return seqs
 
 
 def _divide_chunks(l, n):
@@ -202,101 +278,176 @@ def _divide_chunks(l, n):
         yield l[i:i + n]
 
 
-def _make_seq_dict(fh):
-    seqs = dict()
-    seq_len = 0
-    for s in fh.keys():
-        seqs[s] = fh[s][:].seq
-        seq_len = len(fh[s][:].seq)
-    return seqs, seq_len
+def _make_seq_matrix(fh):
+    """Read every sample once through the alignment store loader"""
+    samples, matrix = load_code_matrix(fh, keep_case=True)
+    seq_len = matrix.lengths[-1] if len(matrix) else 0
+    return samples, matrix, seq_len
 
 
-def run_pw_per_chromosome(
-    chrom,
-    filtered_outdir,
+def _read_window(f, archive=None):
+    """Return the samples, alignment matrix (CodeMatrix) + sequence length of a window
+    file, or of a window in archive"""
+    if archive is None:
+        with Fasta(f.as_posix()) as fh:
+            return _make_seq_matrix(fh)
+    samples, matrix = _seqs_to_matrix(archive.records(f.name))
+    seq_len = matrix.lengths[-1] if len(matrix) else 0
+    return samples, matrix, seq_len
+
+
+COVERAGE_REASON = "Failed to meet coverage threshold"
+NO_REFERENCE_REASON = "Reference sample not found in alignment"
+NO_CONTENT_REASON = "No sequence content"
+PREVIOUS_STAGE_REASON = "Dropped by a previous stage"
+
+# Windows of a chromosome - tasks are the windows not dropped by a previous stage
+PWChromosome = namedtuple("PWChromosome", ["name", "files", "init_dropped", "tasks", "outdir", "archive"])
+
+
+@lru_cache(maxsize=16)
+def _open_archive(path, mtime):
+    """Keep archives open in a worker across the tasks that read them"""
+    return WindowArchive(path)
+
+
+def collect_pw_windows(chrom, outdir, MANIFEST=None):
+    """Collect the windows of a chromosome directory (or archive) + make a task for each
+    window not dropped by a previous stage. Windows dropped by a previous stage are
+    written out as empty files here."""
+    if is_window_archive(chrom):
+        with WindowArchive(chrom) as archive:
+            chrom_name = archive.chromosome
+            files = [Path(name) for name in archive.names()]
+            costs = {name: length for name, (_, length) in archive.index.items()}
+        source = chrom
+    else:
+        chrom_name = chrom.name
+        files = window_files(MANIFEST, chrom_name, chrom)
+        costs = {f.name: f.stat().st_size for f in files}
+        source = None
+    # Window status comes from the manifest rows of the stage that wrote chrom (or file names without one)
+    dropped = previously_dropped(MANIFEST, chrom_name, chrom)
+    filtered_chrom_outdir = outdir / chrom_name
+    filtered_chrom_outdir.mkdir(parents=True, exist_ok=True)
+    init_dropped_files = [f for f in files if is_dropped(f.name, dropped)]
+    for f in init_dropped_files:
+        WriteOUT(filtered_chrom_outdir / f.name, "")
+    tasks = [
+        WindowTask(chrom_name, f, filtered_chrom_outdir, costs[f.name], source)
+        for f in files if not is_dropped(f.name, dropped)
+    ]
+    return PWChromosome(chrom_name, files, init_dropped_files, tasks, filtered_chrom_outdir, source)
+
+
+def filter_window_task(
+    task,
     PW_WINDOW_SIZE,
     PW_STEP,
     PW_PDIST_CUTOFF,
     PW_REF,
-    PW_MIN_SEQ_LEN,
     PW_PC_CUTOFF,
     PW_ZSCORE,
     PW_EXCLUDE_LIST,
     PW_MISSING_CHAR,
-    return_dict,
 ):
-    dropped_files = list()
-    files = [f for f in chrom.iterdir() if check_fasta(f)]
-    init_dropped_files = [f.stem for f in files if '-DROPPED' in f.name]
-    init_valid_files = [f.stem for f in files if '-DROPPED' not in f.name]
-    filtered_chrom_outdir = filtered_outdir / f'{chrom.name}'
-    filtered_chrom_outdir.mkdir(parents=True, exist_ok=True)
-
+    """Run one window (WindowTask) through the pairwise filter + write its output.
+    Returns the output file name, the reason it was dropped (None when valid) and the
+    samples below the coverage cutoff."""
+    f = task.window
+    archive = None if task.source is None else _open_archive(task.source, task.source.stat().st_mtime_ns)
     countshit = dict()
-    countperccovcutoff=0
-    countemptyalignments=0
-    countmissingref=0
-    log_info=list()
-    for f in files:
-        if "-DROPPED" in str(f.stem):
-            output_fn = filtered_chrom_outdir / f.name
-            with open(output_fn, 'w') as oh:
-                oh.write("")
-                continue
-
-        with Fasta(f.as_posix()) as fh:
-            try:
-                assert(len(fh.keys()) > 0)
-                seqs, lenseqs = _make_seq_dict(fh)
-                newseqs = SplitAlignedSeqsIntoWindows(
-                    seqs,
-                    lenseqs,
-                    PW_WINDOW_SIZE,
-                    PW_STEP,
-                    PW_MISSING_CHAR,
-                    PW_REF,
-                    PW_ZSCORE,
-                    PW_PDIST_CUTOFF,
-                    PW_EXCLUDE_LIST,
-                )
-                if newseqs == "NoReference":  # If newseqs is empty
-                    outfile = filtered_chrom_outdir / f"{f.stem}-DROPPED.fasta"
-                    dropped_files.append(f'*Window Dropped* | File: {outfile.name} | Reason: Reference sample not found in alignment ')
-                    WriteOUT(outfile, "")
-                    raise Exception
-                if lenseqs == 0:
-                    raise AssertionError
-                perccov = CalculatePercentAACoverageForEachSequenceInDictionary(newseqs, lenseqs, PW_MISSING_CHAR)
-                # If any window has a percov < PW_PC_CUTOFF then the entire window is rejected
-                boolean = Return1IfValueIsGreaterThanCutoffForAllInDictionary(perccov, PW_PC_CUTOFF, countshit)
-                if boolean == 1:
-                    output = FormatDictionaryOfNucleotideSeqsToFasta(newseqs, seqs.keys())
-                    outfile = filtered_chrom_outdir / f"{f.name}"
-                    WriteOUT(outfile, output)
-                elif boolean == 0:
-                    outfile = filtered_chrom_outdir / f"{f.stem}-DROPPED.fasta"
-                    dropped_files.append(f'*Window Dropped* | File: {outfile.name} | Reason: Failed to meet coverage threshold')
-                    WriteOUT(outfile, "")
-                    countperccovcutoff += 1
-            except AssertionError:
-                logger.debug(f"{f.name} has no information -- Ignoring")
-                outfile = filtered_chrom_outdir / f"{f.stem}-DROPPED.fasta"
-                dropped_files.append(f'*Window Dropped* | File: {outfile.name} | Reason: No sequence content ')
-                WriteOUT(outfile, "")
-                countemptyalignments += 1
-            # except Exception as e:
-            #     print(e)
-            #     logger.debug(f"{f.name} does not contain reference sample -- Skipping file")
-            #     countmissingref += 1
-
-    num_valid_files_remaining = len([i for i in filtered_chrom_outdir.iterdir() if "-DROPPED" not in i.name])
+    dropped_name = f"{f.stem}-DROPPED.fasta"
+    try:
+        samples, matrix, lenseqs = _read_window(f, archive)
+        assert(len(samples) > 0)
+        outliers = FindOutlierSubWindows(
+            samples,
+            matrix,
+            lenseqs,
+            PW_WINDOW_SIZE,
+            PW_STEP,
+            PW_MISSING_CHAR,
+            PW_REF,
+            PW_ZSCORE,
+            PW_PDIST_CUTOFF,
+            PW_EXCLUDE_LIST,
+        )
+        if outliers == "NoReference":  # If newseqs is empty
+            WriteOUT(task.outdir / dropped_name, "")
+            return dropped_name, NO_REFERENCE_REASON, countshit
+        if lenseqs == 0:
+            raise AssertionError
+        starts, flags = outliers
+        # Masks the alignment + calculates coverage in one pass over each sequence
+        coverage = MaskAlignedMatrixAndCalculatePercentCoverage(matrix, lenseqs, starts, flags, PW_WINDOW_SIZE, PW_MISSING_CHAR)
+        perccov = dict(zip(samples, coverage))
+        # If any window has a percov < PW_PC_CUTOFF then the entire window is rejected
+        boolean = Return1IfValueIsGreaterThanCutoffForAllInDictionary(perccov, PW_PC_CUTOFF, countshit)
+        if boolean == 1:
+            output = FormatMatrixOfNucleotideSeqsToFasta(samples, matrix)
+            WriteOUT(task.outdir / f.name, output)
+            return f.name, None, countshit
+        WriteOUT(task.outdir / dropped_name, "")
+        return dropped_name, COVERAGE_REASON, countshit
+    except AssertionError:
+        logger.debug(f"{f.name} has no information -- Ignoring")
+        WriteOUT(task.outdir / dropped_name, "")
+        return dropped_name, NO_CONTENT_REASON, countshit
+
+
+def finish_pw_chromosome(pw_chrom, results, filtered_outdir, MANIFEST=None):
+    """Summarise a chromosome's finished windows (TaskResult), record them in the run
+    manifest + pack them into an archive when the input was archived. Returns the
+    chromosome's log info."""
+    output = archive_path(filtered_outdir, pw_chrom.name) if pw_chrom.archive else None
+
+    def location(name):
+        return (pw_chrom.outdir / name).as_posix() if output is None else output.as_posix()
+
+    records = [
+        WindowRecord(f.name, DROPPED, PREVIOUS_STAGE_REASON, location(f.name), 0.0)
+        for f in pw_chrom.init_dropped
+    ]
+    countshit = dict()
+    dropped_files = list()
+    countperccovcutoff = 0
+    countemptyalignments = 0
+    countmissingref = 0
+    for r in sorted(results, key=lambda r: r.task.window.name):
+        f = r.task.window
+        if r.error is not None:
+            outname = f"{f.stem}-DROPPED.fasta"
+            (pw_chrom.outdir / f.name).unlink(missing_ok=True)
+            WriteOUT(pw_chrom.outdir / outname, "")
+            reason = f"Pairwise filter failed after {r.attempts} attempt(s): {r.error}"
+        else:
+            outname, reason, window_countshit = r.result
+            for n, c in window_countshit.items():
+                countshit[n] = countshit.get(n, 0) + c
+        if reason == COVERAGE_REASON:
+            countperccovcutoff += 1
+        elif reason == NO_CONTENT_REASON:
+            countemptyalignments += 1
+        elif reason == NO_REFERENCE_REASON:
+            countmissingref += 1
+        if reason is not None:
+            dropped_files.append(f'*Window Dropped* | File: {outname} | Reason: {reason}')
+        status = VALID if reason is None else DROPPED
+        records.append(WindowRecord(outname, status, reason, location(outname), r.seconds))
+    if output is not None:
+        pack_window_dir(pw_chrom.outdir, output)
+    if MANIFEST is not None:
+        with RunManifest(MANIFEST) as manifest:
+            manifest.record("pairwise_filter", pw_chrom.name, records)
+    num_valid_files_remaining = len([r for r in records if r.status == VALID])
     log_info = [
         [
             "====================================",
-            f"Chromosome: {chrom.stem}",
-            f"Total windows in chromosome: {len(files)}",
-            f"Total windows dropped from previous steps: {len(init_dropped_files)}",
-            f"Total valid windows at start of run: {len(init_valid_files)}",
+            f"Chromosome: {pw_chrom.name}",
+            f"Total windows in chromosome: {len(pw_chrom.files)}",
+            f"Total windows dropped from previous steps: {len(pw_chrom.init_dropped)}",
+            f"Total valid windows at start of run: {len(pw_chrom.files) - len(pw_chrom.init_dropped)}",
             f"Total valid windows remaining after pairwise filter: {num_valid_files_remaining}",
             f"Total windows dropped by pairwise coverage cutoff: {countperccovcutoff}",
             f"Total windows dropped by missing reference sample: {countmissingref}",
@@ -312,11 +463,77 @@ def run_pw_per_chromosome(
             "====================================",
         ],
     ]
-    return_dict[chrom.name] = log_info
+    return log_info
+
+
+def run_pw_per_chromosome(
+    chrom,
+    filtered_outdir,
+    PW_WINDOW_SIZE,
+    PW_STEP,
+    PW_PDIST_CUTOFF,
+    PW_REF,
+    PW_MIN_SEQ_LEN,
+    PW_PC_CUTOFF,
+    PW_ZSCORE,
+    PW_EXCLUDE_LIST,
+    PW_MISSING_CHAR,
+    return_dict,
+    MANIFEST=None,
+):
+    """Run a single chromosome's windows through the pairwise filter in the current process.
+    Archived windows are read from (and written to) an archive."""
+    with tempfile.TemporaryDirectory() as tmp_outdir:
+        outdir = Path(tmp_outdir) if is_window_archive(chrom) else filtered_outdir
+        pw_chrom = collect_pw_windows(chrom, outdir, MANIFEST)
+        results = run_tasks_serially(
+            partial(
+                filter_window_task,
+                PW_WINDOW_SIZE=PW_WINDOW_SIZE,
+                PW_STEP=PW_STEP,
+                PW_PDIST_CUTOFF=PW_PDIST_CUTOFF,
+                PW_REF=PW_REF,
+                PW_PC_CUTOFF=PW_PC_CUTOFF,
+                PW_ZSCORE=PW_ZSCORE,
+                PW_EXCLUDE_LIST=PW_EXCLUDE_LIST,
+                PW_MISSING_CHAR=PW_MISSING_CHAR,
+            ),
+            pw_chrom.tasks,
+        )
+        return_dict[pw_chrom.name] = finish_pw_chromosome(pw_chrom, results, filtered_outdir, MANIFEST)
     return return_dict
 
 
 ############################### Main Function ################################
+def log_pw_chromosome(log_info):
+    for i in log_info[0]:
+        if type(i) == str:
+            logger.info(i)
+        elif type(i) == dict:
+            for n in i.keys():
+                logger.info(f'- {n}: {i[n]}')
+                pass
+        elif type(i) == list:
+            for f in i:
+                logger.info(f"- {f.name}")
+                pass
+    for i in log_info[1]:
+        if type(i) == str:
+            logger.info(i)
+        elif type(i) == dict:
+            for n in i.keys():
+                logger.info(f'- {n}: {i[n]}')
+                pass
+        elif type(i) == list:
+            for f in i:
+                logger.info(f"{f}")
+                pass
+        else:
+            print(i)
+    return
+
+
+
 def pairwise_filter(
     filtered_indir,
     filtered_outdir,
@@ -332,7 +549,11 @@ def pairwise_filter(
     PW_MISSING_CHAR,
     MULTIPROCESS,
     LOG_LEVEL,
+    TASK_TIMEOUT=None,
+    TASK_RETRIES=0,
 ):
+    """The windows of every chromosome are run as one task queue (see UTIL_scheduler)
+    and each chromosome is logged as soon as its last window is filtered."""
     set_logger_level(WORKING_DIR, LOG_LEVEL)  # Setup log file level
     # Set cpu count for multiprocessing
     if type(MULTIPROCESS) == int:
@@ -345,54 +566,39 @@ def pairwise_filter(
     elif MULTIPROCESS == 'all':
         cpu_count = os.cpu_count()
     # Collect chromosome information + run
-    chrom_dirs = [f for f in filtered_indir.iterdir() if f.is_dir()]
-    manager = Manager()
-    return_dict = manager.dict()
-    p_umap(
-        partial(
-            run_pw_per_chromosome,
-            filtered_outdir=filtered_outdir,
-            PW_WINDOW_SIZE=PW_WINDOW_SIZE,
-            PW_STEP=PW_STEP,
-            PW_PDIST_CUTOFF=PW_PDIST_CUTOFF,
-            PW_REF=PW_REF,
-            PW_MIN_SEQ_LEN=PW_MIN_SEQ_LEN,
-            PW_PC_CUTOFF=PW_PC_CUTOFF,
-            PW_ZSCORE=PW_ZSCORE,
-            PW_EXCLUDE_LIST=PW_EXCLUDE_LIST,
-            PW_MISSING_CHAR=PW_MISSING_CHAR,
-            return_dict=return_dict,
-        ),
-        chrom_dirs,
-        **{"num_cpus": cpu_count},
-    )
-    # Log output information
-    for c in return_dict.keys():
-        log_info = return_dict[c]
-        for i in log_info[0]:
-            if type(i) == str:
-                logger.info(i)
-            elif type(i) == dict:
-                for n in i.keys():
-                    logger.info(f'- {n}: {i[n]}')
-                    pass
-            elif type(i) == list:
-                for f in i:
-                    logger.info(f"- {f.name}")
-                    pass
-        for i in log_info[1]:
-            if type(i) == str:
-                logger.info(i)
-            elif type(i) == dict:
-                for n in i.keys():
-                    logger.info(f'- {n}: {i[n]}')
-                    pass
-            elif type(i) == list:
-                for f in i:
-                    logger.info(f"{f}")
-                    pass
-            else:
-                print(i)
-
-
+    chrom_dirs = [f for f in filtered_indir.iterdir() if f.is_dir() or is_window_archive(f)]
+    MANIFEST = manifest_path(WORKING_DIR)
+    filtered_outdir.mkdir(parents=True, exist_ok=True)
+    with ExitStack() as stack:
+        # Archived chromosomes are written to a temporary directory + packed when finished
+        pw_chroms = dict()
+        tasks = list()
+        for c in chrom_dirs:
+            outdir = Path(stack.enter_context(tempfile.TemporaryDirectory())) if is_window_archive(c) else filtered_outdir
+            pw_chrom = collect_pw_windows(c, outdir, MANIFEST)
+            pw_chroms[pw_chrom.name] = pw_chrom
+            tasks += pw_chrom.tasks
+        results = schedule_tasks(
+            partial(
+                filter_window_task,
+                PW_WINDOW_SIZE=PW_WINDOW_SIZE,
+                PW_STEP=PW_STEP,
+                PW_PDIST_CUTOFF=PW_PDIST_CUTOFF,
+                PW_REF=PW_REF,
+                PW_PC_CUTOFF=PW_PC_CUTOFF,
+                PW_ZSCORE=PW_ZSCORE,
+                PW_EXCLUDE_LIST=PW_EXCLUDE_LIST,
+                PW_MISSING_CHAR=PW_MISSING_CHAR,
+            ),
+            tasks,
+            cpu_count,
+            TASK_TIMEOUT,
+            TASK_RETRIES,
+        )
+        # Log output information as each chromosome finishes
+        for chrom_name, chrom_results in stream_chromosomes(results, tasks, pw_chroms.keys()):
+            log_info = finish_pw_chromosome(pw_chroms[chrom_name], chrom_results, filtered_outdir, MANIFEST)
+            log_pw_chromosome(log_info)
+    for line in drop_report_lines(MANIFEST, "pairwise_filter"):
+        logger.info(line)
     return None
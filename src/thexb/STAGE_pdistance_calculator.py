@@ -1,6 +1,12 @@
+import itertools
 import logging
+import math
 import os
-from multiprocessing import Pool, Value
+import tempfile
+import threading
+import zlib
+from multiprocessing import Lock, Pool, Value
+from pathlib import Path
 from time import time
 
 from Bio import AlignIO
@@ -8,13 +14,21 @@ from Bio.Phylo.TreeConstruction import DistanceCalculator
 from pyfaidx import Fasta
 import pandas as pd
 import numpy as np
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
 
+from thexb.UTIL_alignment_store import AlignmentStoreHandle, LazyAlignmentStore, alignment_lengths, open_alignment_store, open_lazy_alignment_store, store_code_matrix
 from thexb.UTIL_checks import check_fasta
+from thexb.UTIL_encoding import PAD, encode, is_missing, is_present
 ################################ Important Info ################################
 """
 Input:
     - Single file or a directory containing multiple files.
     - Window size to calculate p-distance in
+    - Optional step size for overlapping sliding windows (default: window size)
     - Threshold of missing data to drop window calculation (default: 0.75)
 
     File name format: ChromosomeName.fasta
@@ -35,7 +49,22 @@ Do not need to provide .fai file, pyfaidx will create one if cannot be found.
 Functionality:
     - Calculate p-distance in windows
     - Return nan for window where a sample has more than (provided threshold) missing data (i.e., >0.75)
+    - All-vs-all mode (--pdistance-matrix) calculates p-distance for every sample pair
+      in every window and outputs Chromosome, Window, SampleA, SampleB, Value
+    - Results are written to the output file as each file's chunks complete
+    - Optional Parquet output (--pdist-parquet, requires pyarrow) written alongside the TSV
 """
+# Upper bound on alignment cells (samples x sites) loaded per chunk and
+# target number of chunks per core used to balance work across the pool
+PDIST_CHUNK_CELLS = 100_000_000
+PDIST_CHUNKS_PER_CPU = 4
+# Number of files per core queued ahead of the output writer - bounds both
+# the alignment stores on disk and the finished results waiting to be written
+PDIST_FILES_PER_CPU = 2
+# Maximum number of output rows built into a dataframe per write
+PDIST_WRITE_ROWS = 1_000_000
+# Alignment store build locks of a pool worker (see _init_store_locks)
+STORE_LOCKS = None
 ############################### Set up logger #################################
 logger = logging.getLogger(__name__)
 def set_logger_level(WORKING_DIR, LOG_LEVEL):
@@ -52,44 +81,144 @@ def set_logger_level(WORKING_DIR, LOG_LEVEL):
     return logger
 
 ############################## Helper Functions ###############################
-def generate_windows(seq_len, WINDOW_SIZE_INT):
+def generate_windows(seq_len, WINDOW_SIZE_INT, PDIST_STEP_INT=None):
     """
-    Generate non-overlapping sliding windows
+    Generate sliding windows. Windows are non-overlapping unless a step
+    smaller than the window size is provided.
     """
+    if not PDIST_STEP_INT:
+        PDIST_STEP_INT = WINDOW_SIZE_INT
     windows = [
-        (s, e) for s, e in zip(
-            range(1, seq_len, WINDOW_SIZE_INT),
-            range(WINDOW_SIZE_INT, seq_len+WINDOW_SIZE_INT, WINDOW_SIZE_INT)
-        )
+        (s, min(s + WINDOW_SIZE_INT - 1, seq_len)) for s in range(1, seq_len, PDIST_STEP_INT)
     ]
     # Change last window end position to length of sequence - required for pyfaidx
     windows = windows[:-1] + [(windows[-1][0], seq_len)]
     return windows
 
 
-def make_init_df(chromosome, queries, windows, REFERENCE):
+def load_alignment_matrix(alignment, samples, start, end):
+    """
+    Load the [start:end] region of each sample into a (samples x sites)
+    matrix of nucleotide codes (see UTIL_encoding). Sequences that end
+    before the region does are padded with PAD so those sites are never
+    counted.
+    """
+    matrix = np.full((len(samples), end - start), PAD, dtype=np.uint8)
+    for n, sample in enumerate(samples):
+        seq = encode(str(alignment[sample][start:end]))[:end - start]
+        matrix[n, :len(seq)] = seq
+    return matrix
+
+
+def read_alignment_region(f, samples, start, end):
+    """
+    Return the [start:end] region of samples as an encoded uint8 matrix.
+    f is either a fasta file or the handle of an encoded alignment store
+    (built, or lazily built by the first chunk to read it) with samples as
+    its row order, in which case only the bytes holding the region are read
+    from the store.
+    """
+    if isinstance(f, AlignmentStoreHandle):
+        return store_code_matrix(open_alignment_store(f), f.lengths).region(start, end)
+    if isinstance(f, LazyAlignmentStore):
+        return store_code_matrix(open_lazy_alignment_store(f, store_lock(f)), f.lengths).region(start, end)
+    with Fasta(f) as alignment:
+        return load_alignment_matrix(alignment, samples, start, end)
+
+
+def _init_store_locks(locks):
+    """Pool initializer - share the alignment store build locks with each worker"""
+    global STORE_LOCKS
+    STORE_LOCKS = locks
+
+
+def store_lock(store):
+    """Return the build lock of a lazy store - stores share the pool's locks by path"""
+    return STORE_LOCKS[zlib.crc32(Path(store.path).name.encode()) % len(STORE_LOCKS)]
+
+
+def window_bounds(windows):
+    """
+    Return window start and end arrays. Windows are sliced as [Start:End]
+    (the same slice pairwise_pi was given by pyfaidx), so End - Start is the
+    window length used as the denominator.
+    """
+    starts = np.array([w[0] for w in windows], dtype=np.int64)
+    ends = np.array([w[1] for w in windows], dtype=np.int64)
+    return starts, ends
+
+
+def site_prefix_sums(site_array):
     """
-    Generate initial dataframe with all data except p-distance values
+    Cumulative per-site counts of an indicator array (or the rows of a 2D
+    array) with a leading 0, so any [start, end) window sums to
+    prefix[end] - prefix[start].
     """
-    # +1 is for reference
-    chromosome_list = [chromosome]*(len(windows)*(len(queries)+1))
-    start_positions_list = [w[0] for w in windows]*(len(queries)+1)
-    end_positions_list = [w[1] for w in windows]*(len(queries)+1)
-    windows_list = [w[0] for w in windows]*(len(queries)+1)
-    sample_list = []
+    dtype = np.int32 if site_array.shape[-1] < np.iinfo(np.int32).max else np.int64
+    prefix = np.zeros(site_array.shape[:-1] + (site_array.shape[-1] + 1,), dtype=dtype)
+    np.cumsum(site_array, axis=-1, out=prefix[..., 1:])
+    return prefix
 
-    for q in queries:
-        sample_list = sample_list + [q]*len(windows)
 
-    sample_list = sample_list + [REFERENCE]*len(windows)
+def window_sums(site_array, starts, ends):
+    """
+    Sum a per-site indicator array (or the rows of a 2D array) over every
+    [start, end) window. Each window costs O(1) from the prefix sums, so
+    overlapping windows cost the same as tiled ones.
+    """
+    prefix = site_prefix_sums(site_array)
+    return (prefix[..., ends] - prefix[..., starts]).astype(np.int64)
+
 
+def window_site_counts(ref_seq, query_seq, starts, ends, PDIST_MISSING_CHAR):
+    """
+    Return per-window (variable, invariable, missing) site counts between
+    two encoded sequences. Same rules as pairwise_pi - a site is missing when
+    either base is the missing character, otherwise it is (in)variable.
+    query_seq can be a (samples x sites) matrix to compare several samples
+    against ref_seq in one batch.
+    """
+    present = is_present(ref_seq) & is_present(query_seq)
+    # Sequences are compared upper-case, so a lower-case missing character never matches
+    if len(PDIST_MISSING_CHAR) == 1 and PDIST_MISSING_CHAR == PDIST_MISSING_CHAR.upper():
+        missing = (is_missing(ref_seq, PDIST_MISSING_CHAR) | is_missing(query_seq, PDIST_MISSING_CHAR)) & present
+    else:
+        missing = np.zeros(np.broadcast(ref_seq, query_seq).shape, dtype=bool)
+    valid = present & ~missing
+    variable = valid & (ref_seq != query_seq)
+    variable_counts = window_sums(variable, starts, ends)
+    valid_counts = window_sums(valid, starts, ends)
+    missing_counts = window_sums(missing, starts, ends)
+    return variable_counts, valid_counts - variable_counts, missing_counts
+
+
+def window_pdistance(variable, invariable, missing, lengths, PDIST_THRESHOLD, PDIST_IGNORE_N):
+    """
+    Vectorized version of pairwise_pi's return logic. Windows that would
+    return pd.NA are returned as NaN.
+    """
+    valid = variable + invariable
+    with np.errstate(divide="ignore", invalid="ignore"):
+        if not PDIST_IGNORE_N:
+            values = (variable + missing) / lengths
+        else:
+            values = variable / valid
+        values[(missing / lengths) >= PDIST_THRESHOLD] = np.nan
+    values[valid == 0] = np.nan
+    return values
+
+
+def make_pdistance_df(chromosome, samples, windows, values):
+    """
+    Build the output dataframe in one step. Rows are ordered by sample, then
+    window, with the reference last.
+    """
+    starts, _ = window_bounds(windows)
     return pd.DataFrame({
-        "Chromosome": chromosome_list,
-        "Start": start_positions_list,
-        "End": end_positions_list,
-        "Window": windows_list,
-        "Sample": sample_list,
-        "Value": [pd.NA]*(len(windows)*(len(queries)+1)),
+        "Chromosome": np.full(values.size, chromosome, dtype=object),
+        "Window": np.tile(starts, len(samples)),
+        "Sample": np.repeat(np.array(samples, dtype=object), len(windows)),
+        "Value": values.ravel(),
     })
 
 
@@ -128,41 +257,164 @@ def pairwise_pi(seq1, seq2, PDIST_MISSING_CHAR, PDIST_IGNORE_N, PDIST_THRESHOLD)
         return variable_sites/(invariable_sites + variable_sites)
 
 
-def process_file(f, WINDOW_SIZE_INT, PDIST_MISSING_CHAR, PDIST_THRESHOLD, REFERENCE, PDIST_IGNORE_N, PDIST_REF_SUFFIX):
+def get_chromosome_name(f):
+    return str(f.stem).replace(".fasta", "").replace(".fa", "").replace(".fna", "").replace(".fas", "")
+
+
+def read_alignment_info(f, REFERENCE):
     """
-    Load fasta file and calculate p-distance for file. Return resulting dataframe.   
+    Return the chromosome name, sample order (reference last) and reference
+    length of a fasta file. When REFERENCE is None (all-vs-all mode) samples
+    are returned in file order with the longest sequence length.
+    Builds the .fai index if it is not present.
     """
-    chromosome = str(f.stem).replace(".fasta", "").replace(".fa", "").replace(".fna", "").replace(".fas", "")
-    # Load each chromosome file
+    chromosome = get_chromosome_name(f)
     with Fasta(f) as alignment:
+        if REFERENCE is None:
+            samples = [i for i in alignment.keys()]
+            seq_len = max([len(alignment[i]) for i in samples])
+            return chromosome, samples, seq_len
         queries = [i for i in alignment.keys() if i != REFERENCE]
-        logger.debug(f"{f.name} alignment loaded, starting p-distance calculation")
-        # Generate windows
-        windows = generate_windows(len(alignment[REFERENCE][:].seq), WINDOW_SIZE_INT)
-        # Log file information
-        logger.info("========================")
-        logger.info(f"File: {f.name}")
-        logger.info(f"Number of windows: {len(windows)}")
-        logger.info(f"Samples to test: {queries}")
-        # Make pandas df to save results
-        df = make_init_df(chromosome, queries, windows, REFERENCE)
-        # Calculate p-distance - version 1 (testing)
-        for n, row in enumerate(df.to_dict('records')):
-            s1 = time()
-            df.at[n, "Value"] = pairwise_pi(
-                alignment[REFERENCE][row['Start']:row['End']].seq,
-                alignment[row['Sample']][row['Start']:row['End']].seq,
-                PDIST_MISSING_CHAR,
-                PDIST_IGNORE_N,
-                PDIST_THRESHOLD,
-            )
-            logger.debug(f"{n:,}/{len(df):,} windows complete for {chromosome} :: Time:{time()- s1:.2} seconds :: DF Memory: {df.memory_usage(deep=True).sum():,}") if n%10 == 0 else None
-            continue
-        if PDIST_REF_SUFFIX:
-            df['Sample'] = df['Sample'].apply(lambda x: f'{x}_reference' if x == REFERENCE else x)
-        df.drop(columns=['Start', 'End'], inplace=True)
+        seq_len = len(alignment[REFERENCE])
+    return chromosome, queries + [REFERENCE], seq_len
+
+
+def get_sample_pairs(samples):
+    """Return every unordered sample pair in file order"""
+    return list(itertools.combinations(samples, 2))
+
+
+def divide_windows_into_chunks(windows, n):
+    """Divides windows into contiguous chunks of n windows"""
+    for i in range(0, len(windows), n):
+        yield windows[i:i + n]
+
+
+def process_chunk(f, samples, windows, PDIST_MISSING_CHAR, PDIST_THRESHOLD, PDIST_IGNORE_N):
+    """
+    Calculate p-distance for a contiguous run of windows. Only the region
+    covered by the windows is read from f (a fasta file or alignment store). Returns a (samples x windows) array
+    of p-distance values, compared against the last sample (reference).
+    """
+    offset = windows[0][0]
+    matrix = read_alignment_region(f, samples, offset, windows[-1][1])
+    starts, ends = window_bounds(windows)
+    lengths = ends - starts
+    values = np.empty((len(samples), len(windows)), dtype=np.float64)
+    for n in range(len(samples)):
+        variable, invariable, missing = window_site_counts(matrix[-1], matrix[n], starts - offset, ends - offset, PDIST_MISSING_CHAR)
+        values[n] = window_pdistance(variable, invariable, missing, lengths, PDIST_THRESHOLD, PDIST_IGNORE_N)
+    return values
+
+
+def process_matrix_chunk(f, samples, windows, PDIST_MISSING_CHAR, PDIST_THRESHOLD, PDIST_IGNORE_N):
+    """
+    Calculate the all-vs-all p-distance matrix for a contiguous run of
+    windows. Each sample is compared against every later sample in one
+    batched comparison. Returns a (pairs x windows) array ordered as
+    get_sample_pairs(samples).
+    """
+    offset = windows[0][0]
+    matrix = read_alignment_region(f, samples, offset, windows[-1][1])
+    starts, ends = window_bounds(windows)
+    values = [np.empty((0, len(windows)), dtype=np.float64)]
+    for n in range(len(samples) - 1):
+        # Window length is taken from the first sample of the pair, as in pairwise_pi
+        lengths = window_sums(is_present(matrix[n]), starts - offset, ends - offset)
+        variable, invariable, missing = window_site_counts(matrix[n], matrix[n + 1:], starts - offset, ends - offset, PDIST_MISSING_CHAR)
+        values.append(window_pdistance(variable, invariable, missing, lengths, PDIST_THRESHOLD, PDIST_IGNORE_N))
+    return np.vstack(values)
+
+
+def iter_file_tasks(file_tasks, file_slots):
+    """
+    Yield the chunk tasks of each file in order, taking a file slot before
+    a file's first chunk. The slot is released when the file's results are
+    written, so no more files than slots are queued ahead of the writer.
+    """
+    for tasks in file_tasks:
+        file_slots.acquire()
+        yield from tasks
+
+
+def _process_chunk_task(task):
+    """Pool.imap_unordered helper - returns the task key with its results"""
+    key, engine, args = task
+    return key, engine(*args)
+
+
+def make_pdistance_matrix_df(chromosome, pairs, windows, values):
+    """
+    Build the long format all-vs-all output dataframe. Rows are ordered by
+    sample pair, then window.
+    """
+    starts, _ = window_bounds(windows)
+    return pd.DataFrame({
+        "Chromosome": np.full(values.size, chromosome, dtype=object),
+        "Window": np.tile(starts, len(pairs)),
+        "SampleA": np.repeat(np.array([p[0] for p in pairs], dtype=object), len(windows)),
+        "SampleB": np.repeat(np.array([p[1] for p in pairs], dtype=object), len(windows)),
+        "Value": values.ravel(),
+    })
+
+
+def get_row_labels(samples, REFERENCE, PDIST_REF_SUFFIX):
+    """Return the sample (or sample pair) that labels each row of a file's results"""
+    if REFERENCE is None:
+        return get_sample_pairs(samples)
+    if PDIST_REF_SUFFIX:
+        return [f'{x}_reference' if x == REFERENCE else x for x in samples]
+    return samples
+
+
+def finalize_file_df(chromosome, labels, windows, values, REFERENCE):
+    """Build the output dataframe for a set of result rows"""
+    if REFERENCE is None:
+        return make_pdistance_matrix_df(chromosome, labels, windows, values)
+    return make_pdistance_df(chromosome, labels, windows, values)
+
+
+def iter_file_dfs(chromosome, labels, windows, values, REFERENCE):
+    """
+    Yield a file's output dataframe in blocks of whole rows so that no more
+    than PDIST_WRITE_ROWS output rows are held in memory at once.
+    """
+    rows_per_block = max(1, PDIST_WRITE_ROWS // len(windows))
+    for i in range(0, len(labels), rows_per_block):
+        yield finalize_file_df(
+            chromosome,
+            labels[i:i+rows_per_block],
+            windows,
+            values[i:i+rows_per_block],
+            REFERENCE,
+        )
+
+
+def write_df_block(df, tsv_handle, parquet_writer, parquet_outfile, write_header):
+    """
+    Append a block of results to the TSV output and, when a Parquet output
+    file is given, to the Parquet output. The Parquet writer is opened on
+    the first block and returned so it can be reused for the next block.
+    """
+    df.to_csv(tsv_handle, sep='\t', index=False, header=write_header)
+    if parquet_outfile is None:
+        return parquet_writer
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    if parquet_writer is None:
+        parquet_writer = pq.ParquetWriter(parquet_outfile, table.schema)
+    parquet_writer.write_table(table.cast(parquet_writer.schema))
+    return parquet_writer
+
+
+def process_file(f, WINDOW_SIZE_INT, PDIST_MISSING_CHAR, PDIST_THRESHOLD, REFERENCE, PDIST_IGNORE_N, PDIST_REF_SUFFIX):
+    """
+    Load fasta file and calculate p-distance for file. Return resulting dataframe.   
+    """
+    chromosome, samples, seq_len = read_alignment_info(f, REFERENCE)
+    windows = generate_windows(seq_len, WINDOW_SIZE_INT)
+    values = process_chunk(f, samples, windows, PDIST_MISSING_CHAR, PDIST_THRESHOLD, PDIST_IGNORE_N)
     logger.debug(f"-- Completed {f.name} --")
-    return df
+    return finalize_file_df(chromosome, get_row_labels(samples, REFERENCE, PDIST_REF_SUFFIX), windows, values, REFERENCE)
 
 ############################### Main Function ################################
 def pdistance_calculator(
@@ -174,8 +426,11 @@ def pdistance_calculator(
     REFERENCE,
     WORKING_DIR,
     WINDOW_SIZE_INT,
+    PDIST_STEP_INT,
     PDIST_IGNORE_N,
     PDIST_REF_SUFFIX,
+    PDIST_MATRIX,
+    PDIST_PARQUET,
     MULTIPROCESS,
     LOG_LEVEL,
 ):
@@ -193,17 +448,91 @@ def pdistance_calculator(
         pass
     elif INPUT.is_dir():
         files = [f for f in INPUT.iterdir() if check_fasta(f)]
-    # Create the pool
-    process_pool = Pool(processes=cpu_count)
-    # Start processes in the pool
-    dfs = process_pool.starmap(process_file, [(f, WINDOW_SIZE_INT, PDIST_MISSING_CHAR, PDIST_THRESHOLD, REFERENCE, PDIST_IGNORE_N, PDIST_REF_SUFFIX) for f in files])
-    # Concat dataframes to one dataframe
-    try:
-        pdist_df = pd.concat(dfs, ignore_index=True)
-    except ValueError:
-        pass
+    # Parquet output requires pyarrow
+    if PDIST_PARQUET and pa is None:
+        logger.error("Parquet output requires pyarrow, install it with 'conda install pyarrow' or 'pip install pyarrow'")
+        raise ImportError("pyarrow is required for --pdist-parquet")
+    # All-vs-all mode has no reference sample
+    if PDIST_MATRIX:
+        REFERENCE = None
+        engine = process_matrix_chunk
+    else:
+        engine = process_chunk
+    # Collect file information + split each file's windows into chunks
+    file_info = []
+    for f in files:
+        chromosome, samples, seq_len = read_alignment_info(f, REFERENCE)
+        windows = generate_windows(seq_len, WINDOW_SIZE_INT, PDIST_STEP_INT)
+        file_info.append([chromosome, samples, windows])
+        # Log file information
+        logger.info("========================")
+        logger.info(f"File: {f.name}")
+        logger.info(f"Number of windows: {len(windows)}")
+        if PDIST_MATRIX:
+            logger.info(f"Sample pairs to test: {len(get_sample_pairs(samples))}")
+        else:
+            logger.info(f"Samples to test: {samples[:-1]}")
+    total_windows = sum([len(i[2]) for i in file_info])
+    target_chunk_size = math.ceil(total_windows / (cpu_count * PDIST_CHUNKS_PER_CPU))
+    step = PDIST_STEP_INT if PDIST_STEP_INT else WINDOW_SIZE_INT
+    for file_idx, (chromosome, samples, windows) in enumerate(file_info):
+        # A chunk of n windows spans about (n * step) + window size sites
+        chunk_size = max(1, min(target_chunk_size, (PDIST_CHUNK_CELLS // len(samples) - WINDOW_SIZE_INT) // step))
+        file_info[file_idx].append(chunk_size)
+    logger.info("========================")
+    # Run chunks from all files in the same pool and write each file's
+    # results (in input order) as soon as all of its chunks are complete
     outfile = pdistance_output_dir / PDIST_FILENAME
-    pdist_df.reset_index(drop=True, inplace=True)
-    pdist_df.to_csv(outfile, sep='\t', index=False)
-    return 
-
+    parquet_outfile = outfile.with_suffix('.parquet') if PDIST_PARQUET else None
+    parquet_writer = None
+    chunk_results = {}
+    remaining_chunks = [math.ceil(len(i[2]) / i[3]) for i in file_info]
+    next_file_idx = 0
+    write_header = True
+    # Each file is loaded once into an encoded alignment store by the first
+    # chunk that reads it and deleted once all of its chunks are complete.
+    # Chunks are queued in file order and at most PDIST_FILES_PER_CPU files
+    # per core are queued ahead of the writer, so a slow file can not leave an
+    # unbounded number of finished files (or their stores) waiting on it.
+    store_locks = [Lock() for _ in range(cpu_count)]
+    file_slots = threading.Semaphore(cpu_count * PDIST_FILES_PER_CPU)
+    with tempfile.TemporaryDirectory(dir=pdistance_output_dir) as store_dir, \
+            open(outfile, 'w', newline='') as tsv_handle, \
+            Pool(processes=cpu_count, initializer=_init_store_locks, initargs=(store_locks,)) as process_pool:
+        stores = [LazyAlignmentStore(f, Path(store_dir) / f"{file_idx}.npy", file_info[file_idx][1], alignment_lengths(f, file_info[file_idx][1]), True) for file_idx, f in enumerate(files)]
+        file_tasks = []
+        for file_idx, (chromosome, samples, windows, chunk_size) in enumerate(file_info):
+            file_tasks.append([
+                ((file_idx, chunk_idx), engine, (stores[file_idx], samples, chunk, PDIST_MISSING_CHAR, PDIST_THRESHOLD, PDIST_IGNORE_N))
+                for chunk_idx, chunk in enumerate(divide_windows_into_chunks(windows, chunk_size))
+            ])
+        num_tasks = sum(len(tasks) for tasks in file_tasks)
+        logger.info(f"Running {num_tasks:,} chunks on {cpu_count} cores")
+        tasks = iter_file_tasks(file_tasks, file_slots)
+        try:
+            for n, ((file_idx, chunk_idx), values) in enumerate(process_pool.imap_unordered(_process_chunk_task, tasks), start=1):
+                chunk_results[(file_idx, chunk_idx)] = values
+                remaining_chunks[file_idx] -= 1
+                if remaining_chunks[file_idx] == 0:
+                    stores[file_idx].path.unlink(missing_ok=True)
+                logger.debug(f"{n:,}/{num_tasks:,} chunks complete")
+                while next_file_idx < len(files) and remaining_chunks[next_file_idx] == 0:
+                    f = files[next_file_idx]
+                    chromosome, samples, windows, chunk_size = file_info[next_file_idx]
+                    # Merge chunk results in window order
+                    num_chunks = math.ceil(len(windows) / chunk_size)
+                    values = np.hstack([chunk_results.pop((next_file_idx, i)) for i in range(num_chunks)])
+                    labels = get_row_labels(samples, REFERENCE, PDIST_REF_SUFFIX)
+                    for df in iter_file_dfs(chromosome, labels, windows, values, REFERENCE):
+                        parquet_writer = write_df_block(df, tsv_handle, parquet_writer, parquet_outfile, write_header)
+                        write_header = False
+                    logger.debug(f"-- Completed {f.name} --")
+                    next_file_idx += 1
+                    file_slots.release()
+        finally:
+            # Wake the task feeder if the pool is stopped before all files are queued
+            for _ in files:
+                file_slots.release()
+    if parquet_writer is not None:
+        parquet_writer.close()
+    return
@@ -7,6 +7,8 @@ import os
 from pathlib import Path
 import pandas as pd
 
+from thexb.UTIL_file_reader import read_treeviewer_file, write_treeviewer_file
+
 ############################### Set up logger #################################
 logger = logging.getLogger(__name__)
 
@@ -98,11 +100,11 @@ def phybin(PHYBIN_EXT_PATH, TREEVIEWER_FN, WORKING_DIR, LOG_LEVEL):
     set_logger_level(WORKING_DIR, LOG_LEVEL)  # Setup log file level
     # Step 1: Organize data into pandas DataFrame
     phyBinDF = organize_phybin_data(PHYBIN_EXT_PATH)
-    # Step 2: Load in Tree Viewer excel file
-    tv_excel = pd.read_excel(TREEVIEWER_FN, engine='openpyxl')
+    # Step 2: Load in Tree Viewer file
+    tv_excel = read_treeviewer_file(TREEVIEWER_FN)
     # Step 3: Add Bin data to TopologyID
     mergedDF = merge_phybin_data(phyBinDF, tv_excel)
     # Step 4: Output updated Tree Viewer file
-    outFileName = WORKING_DIR / f"{TREEVIEWER_FN.stem}_FINAL.xlsx"
-    mergedDF.to_excel(outFileName, index=False)
+    outFileName = WORKING_DIR / f"{TREEVIEWER_FN.stem}_FINAL{TREEVIEWER_FN.suffix}"
+    write_treeviewer_file(mergedDF, outFileName)
     return
\ No newline at end of file
@@ -6,8 +6,9 @@ import logging
 import os
 
 import pandas as pd
-from ete3 import Tree
-from tqdm import tqdm
+
+from thexb.UTIL_file_reader import read_treeviewer_file, write_treeviewer_file
+from thexb.UTIL_topology_hash import bin_topologies, cluster_topologies
 
 
 ############################### Set up logger #################################
@@ -51,67 +52,20 @@ def tv_header_validation(df):
         return False
 
 
-############################### Main Function ################################
-def topobinner(
-    TREEVIEWER_FN, UPDATED_TV_FILENAME, TOPOBIN_ROOTED, WORKING_DIR, LOG_LEVEL
-):
-    logger = set_logger_level(WORKING_DIR, LOG_LEVEL)  # Setup log file level
-    # Load in Tree Viewer excel file
-    df = pd.read_excel(TREEVIEWER_FN)
-    df = df.astype({"TopologyID": "object"})
-    df = df.reset_index(drop=True)
-    # Validate headers
-    header_check = tv_header_validation(df)
-    if not header_check:
-        raise AssertionError(
-            "Input file headers are not valid, please ensure required headers are correct."
-        )
+def topobin_trees(df, TOPOBIN_ROOTED, cpu_count=1, TOPOBIN_MAX_RF=0):
+    """Set the TopologyID column of a Tree Viewer DataFrame in place. Returns the
+    topology overview (TopologyID, Count, Rank) DataFrame."""
     trees = df["NewickTree"]
-    topologies = dict()
-    logger.info(f"{len(trees):,} trees to run")
+    logging.getLogger(__name__).info(f"{len(trees):,} trees to run")
     # Set root boolean value
-    TOPOBIN_ROOTED == False if TOPOBIN_ROOTED == "Y" else True
-    # Bin Trees
-    tqdm_text = "{}".format("topobinner").zfill(3)
-    with tqdm(total=len(trees), desc=tqdm_text) as pbar:
-        for n, t in enumerate(trees):
-            if t == "NoTree":
-                pbar.update(1)
-                continue
-            elif len(topologies.keys()) == 0:
-                topologies[n] = {"count": 1, "idx": [n]}
-                pbar.update(1)
-                continue
-            else:
-                new_topology = True
-                for idx in topologies.keys():
-                    if df.at[idx, "NewickTree"] == "NoTree":
-                        continue
-                    t1 = Tree(remove_heterotachy_info(t))
-                    t2 = Tree(remove_heterotachy_info(df.at[idx, "NewickTree"]))
-                    comparison = t1.compare(t2, unrooted=TOPOBIN_ROOTED)
-                    rf = comparison["rf"]
-                    if rf == 0:
-                        topologies[idx]["count"] += 1
-                        topologies[idx]["idx"].append(n)
-                        new_topology = False
-                        break
-                    else:
-                        continue
-                if new_topology:
-                    topologies[n] = {"count": 1, "idx": [n]}
-                    pbar.update(1)
-                    continue
-                else:
-                    pbar.update(1)
-                    continue
-    # Sort topologies dictionary by 'count'
-    topologies = {
-        k: v
-        for k, v in sorted(
-            topologies.items(), key=lambda item: item[1]["count"], reverse=True
-        )
-    }
+    rooted = TOPOBIN_ROOTED == "Y"
+    # Bin Trees - trees are parsed across cpu_count processes and binned by
+    # their topology signature (see UTIL_topology_hash)
+    trees = [remove_heterotachy_info(t) for t in trees]
+    if TOPOBIN_MAX_RF:
+        topologies = cluster_topologies(trees, TOPOBIN_MAX_RF, rooted=rooted, cpu_count=cpu_count)
+    else:
+        topologies = bin_topologies(trees, rooted=rooted, cpu_count=cpu_count)
     # Set zfill number
     if len(topologies.keys()) < 100:
         zfillnum = 3
@@ -137,7 +91,26 @@ def topobinner(
             df.at[i, "TopologyID"] = "Tree" + "{}".format(topoCount).zfill(zfillnum)
             continue
         topoCount += 1
+    return overview_df
+
+
+############################### Main Function ################################
+def topobinner(
+    TREEVIEWER_FN, UPDATED_TV_FILENAME, TOPOBIN_ROOTED, WORKING_DIR, LOG_LEVEL, cpu_count=1, TOPOBIN_MAX_RF=0
+):
+    logger = set_logger_level(WORKING_DIR, LOG_LEVEL)  # Setup log file level
+    # Load in Tree Viewer file
+    df = read_treeviewer_file(TREEVIEWER_FN)
+    df = df.astype({"TopologyID": "object"})
+    df = df.reset_index(drop=True)
+    # Validate headers
+    header_check = tv_header_validation(df)
+    if not header_check:
+        raise AssertionError(
+            "Input file headers are not valid, please ensure required headers are correct."
+        )
+    overview_df = topobin_trees(df, TOPOBIN_ROOTED, cpu_count, TOPOBIN_MAX_RF)
     # Output updated Tree Viewer file
-    df.to_excel(UPDATED_TV_FILENAME, index=False)
+    write_treeviewer_file(df, UPDATED_TV_FILENAME)
     logger.info(f"\n{overview_df}")
     return
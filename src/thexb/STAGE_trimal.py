@@ -6,14 +6,21 @@ import logging
 import os
 import subprocess
 import statistics as stats
+import tempfile
+from collections import namedtuple
+from contextlib import ExitStack
 from functools import partial
-from multiprocessing import freeze_support, Manager
+from pathlib import Path
+from multiprocessing import freeze_support
 from shlex import quote
 
-from pyfaidx import Fasta
-from p_tqdm import p_umap
+from thexb.UTIL_gap_trimmer import compare_trimmed_windows, trim_window
+from thexb.UTIL_run_manifest import DROPPED, VALID, RunManifest, WindowRecord, drop_report_lines, manifest_path, window_files
+from thexb.UTIL_scheduler import run_tasks_serially, run_tool, schedule_tasks, stream_chromosomes, window_tasks
+from thexb.UTIL_window_archive import archive_path, extracted_windows, is_window_archive, pack_window_dir, parse_fasta_text
 
-from thexb.UTIL_checks import check_fasta
+# Summary of a trimmed window - collected once per window after trimming
+TrimmedWindow = namedtuple("TrimmedWindow", ["path", "num_samples", "min_length"])
 
 ############################### Set up logger #################################
 logger = logging.getLogger(__name__)
@@ -34,85 +41,75 @@ def set_logger_level(WORKING_DIR, LOG_LEVEL):
 
 
 ############################## Helper Functions ###############################
-def minimum_seq_length_check(filtered_files, TRIMAL_MIN_LENGTH):
-    """Removes file from filtered output directory if output file contains sequence of lengths
-    less than TRIMAL_MIN_LENGTH."""
+def read_trimmed_window(outfile):
+    """Read a trimmed window once + return its summary, or None when trimming produced no output"""
+    if not outfile.is_file():
+        return None
+    records = parse_fasta_text(outfile.read_text())
+    lengths = [len(seq) for seq in records.values()]
+    return TrimmedWindow(outfile, len(records), min(lengths, default=None))
+
+
+def drop_window(window):
+    """Rename a trimmed window file with "-DROPPED" at end"""
+    drop_fn = window.path.parents[0] / f"{window.path.stem}-DROPPED.fasta"
+    os.rename(window.path, drop_fn)
+    return
+
+
+def minimum_seq_length_check(trimmed_windows, TRIMAL_MIN_LENGTH, drop_reasons=None):
+    """Drops windows (name: TrimmedWindow) that contain sequence of lengths less than
+    TRIMAL_MIN_LENGTH. Dropped windows are removed from trimmed_windows and their
+    names + reasons are added to drop_reasons."""
     log_info = list()
     # Ensure sequences meet minimum length
-    for f in filtered_files:
-        if "-DROPPED" in f.name:
+    for name, window in list(trimmed_windows.items()):
+        if "-DROPPED" in name:
             continue
-        # Load Fasta file
-        with Fasta(f.as_posix()) as filtered_fasta:
-            filtered_headers = [k for k in filtered_fasta.keys()]
-            # Iterate through headers and drop if header is missing
-            for k in filtered_headers:
-                if len(filtered_fasta[k][:].seq) < TRIMAL_MIN_LENGTH:
-                    # Remove old index fai file
-                    fai_fn = f"{f}.fai"
-                    try:
-                        os.remove(fai_fn)
-                    except FileNotFoundError:
-                        pass
-                    # Rename file with "-DROPPED" at end
-                    drop_fn = f.parents[0] / f"{f.stem}-DROPPED.fasta"
-                    os.rename(f, drop_fn)
-                    log_info.append(
-                        f"*Window Dropped* | File: {f.name} | Reason: Sequence does not meet minimum length of {TRIMAL_MIN_LENGTH}"
-                    )
-                    break
+        elif (window.min_length is not None) and (window.min_length < TRIMAL_MIN_LENGTH):
+            drop_window(window)
+            del trimmed_windows[name]
+            reason = f"Sequence does not meet minimum length of {TRIMAL_MIN_LENGTH}"
+            log_info.append(
+                f"*Window Dropped* | File: {name} | Reason: {reason}"
+            )
+            if drop_reasons is not None:
+                drop_reasons[name] = reason
     return log_info
 
 
-def missing_sample_check(filtered_files, TRIMAL_DROP_WINDOWS):
-    """Ensure all samples are present in the alignment, if not drop file + log"""
+def missing_sample_check(trimmed_windows, TRIMAL_DROP_WINDOWS, drop_reasons=None):
+    """Ensure all samples are present in the alignment, if not drop window + log.
+    The expected sample count is the median sample count of all windows."""
     if not TRIMAL_DROP_WINDOWS:
         print("NO DROP")
         return [], 0
     else:
         log_info = list()
         num_missing = 0
-        count = list()
-        n = 0
-        for f in filtered_files:
-            if "-DROPPED" in f.name:
-                continue
-            elif n > 1000:
-                break
-            # Load Fasta file
-            with Fasta(f.as_posix()) as filtered_fasta:
-                filtered_headers = [k for k in filtered_fasta.keys()]
-                count.append(len(filtered_headers))
-                n += 1
-                continue
+        count = [w.num_samples for n, w in trimmed_windows.items() if "-DROPPED" not in n]
         expected_sample_count = 0 if not count else stats.median(count)
-        # Ensure sequences meet minimum length
-        for f in filtered_files:
-            if "-DROPPED" in f.name:
+        for name, window in list(trimmed_windows.items()):
+            if "-DROPPED" in name:
                 continue
-            else:
-                # Load Fasta file
-                with Fasta(f.as_posix()) as filtered_fasta:
-                    filtered_headers = [k for k in filtered_fasta.keys()]
-                    if len(filtered_headers) != expected_sample_count:
-                        # Remove old index fai file
-                        fai_fn = f"{f}.fai"
-                        os.remove(fai_fn)
-                        # Rename file with "-DROPPED" at end
-                        drop_fn = f.parents[0] / f"{f.stem}-DROPPED.fasta"
-                        os.rename(f, drop_fn)
-                        log_info.append(
-                            f"*Window Dropped* | File: {f.name} | Reason: Samples missing from alignment + DropWindows=True"
-                        )
-                        num_missing += 1
-                        continue
-                    else:
-                        continue
+            elif window.num_samples != expected_sample_count:
+                drop_window(window)
+                del trimmed_windows[name]
+                reason = "Samples missing from alignment + DropWindows=True"
+                log_info.append(
+                    f"*Window Dropped* | File: {name} | Reason: {reason}"
+                )
+                if drop_reasons is not None:
+                    drop_reasons[name] = reason
+                num_missing += 1
         return log_info, num_missing
 
 
+EMPTY_SEQ_REASON = "All alignment sequence was removed by Trimal"
+
+
 def empty_seq_log(f):
-    return f"*Window Dropped* | File: {f} | Reason: All alignment sequence was removed by Trimal"
+    return f"*Window Dropped* | File: {f} | Reason: {EMPTY_SEQ_REASON}"
 
 
 def write_empty_files(empty_files, filtered_chrom_outdir):
@@ -129,58 +126,100 @@ def write_empty_files(empty_files, filtered_chrom_outdir):
     return
 
 
-def run_trimal_per_chrom(
-    chrom,
-    filtered_outdir,
-    TRIMAL_THRESH,
+def trim_window_task(task, TRIMAL_THRESH, TRIMAL_PATH, TRIMAL_ENGINE):
+    """Run one window (WindowTask) through Trimal or the native trimmer. Returns the
+    TrimmedWindow (None when no output) + the Trimal/native difference when validating."""
+    f = task.window
+    file_output_name = task.outdir / f"{f.name}"
+    if TRIMAL_ENGINE == "native":
+        trimmed = trim_window(f, file_output_name, TRIMAL_THRESH)
+        if trimmed is None:
+            return None, None
+        return TrimmedWindow(file_output_name, len(trimmed.samples), trimmed.matrix.shape[1]), None
+    run_tool(
+        [
+            f"{TRIMAL_PATH} -fasta -in {quote(f.as_posix())} -out {quote(file_output_name.as_posix())} -gapthreshold {TRIMAL_THRESH}"
+        ],
+        stderr=subprocess.DEVNULL,
+    )
+    difference = None
+    if TRIMAL_ENGINE == "validate":
+        with tempfile.TemporaryDirectory() as native_outdir:
+            native_file = Path(native_outdir) / f.name
+            trim_window(f, native_file, TRIMAL_THRESH)
+            difference = compare_trimmed_windows(file_output_name, native_file)
+    return read_trimmed_window(file_output_name), difference
+
+
+def summarize_trimal_chrom(
+    chrom_name,
+    results,
     TRIMAL_MIN_LENGTH,
     TRIMAL_DROP_WINDOWS,
-    TRIMAL_PATH,
-    return_dict,
+    MANIFEST=None,
 ):
-    """Main call of Trimal function that takes a chromosome and runs each windowed file through Trimal"""
-    files = [f for f in chrom.iterdir() if check_fasta(f)]
+    """Run the post-trim checks of a chromosome's finished windows (TaskResult) +
+    record them in the run manifest. Returns the chromosome's log info."""
+    results = sorted(results, key=lambda r: r.task.window.name)
+    files = [r.task.window for r in results]
+    filtered_chrom_outdir = results[0].task.outdir if results else None
     init_file_count = len(files)
-    # Make output chromosome directory
-    filtered_chrom_outdir = filtered_outdir / f"{chrom.name}"
-    filtered_chrom_outdir.mkdir(parents=True, exist_ok=True)
-    # Run each window through Trimal
-    for f in files:
-        file_output_name = filtered_chrom_outdir / f"{f.name}"
-        subprocess.run(
-            [
-                f"{TRIMAL_PATH} -fasta -in {quote(f.as_posix())} -out {quote(file_output_name.as_posix())} -gapthreshold {TRIMAL_THRESH}"
-            ],
-            shell=True,
-            check=True,
-            stderr=subprocess.DEVNULL,
-        )
-        continue
+    run_times = {r.task.window.name: r.seconds for r in results}
+    trimmed_windows = dict()
+    failed_windows = dict()
+    validation_logs = list()
+    for r in results:
+        name = r.task.window.name
+        if r.error is not None:
+            failed_windows[name] = r
+            continue
+        trimmed, difference = r.result
+        if trimmed is not None:
+            trimmed_windows[name] = trimmed
+        if difference is not None:
+            validation_logs.append(
+                f"*Trimmer Mismatch* | File: {name} | Reason: {difference}"
+            )
+    # Identify files with no remaining sequence
+    empty_files = [f for f in files if (f.name not in trimmed_windows) and (f.name not in failed_windows)]
     # Filter out files with sequence lengths below TRIMAL_MIN_LENGTH
-    filtered_files = [f for f in filtered_chrom_outdir.iterdir() if check_fasta(f)]
-    seq_len_log_info = minimum_seq_length_check(filtered_files, TRIMAL_MIN_LENGTH)
+    drop_reasons = dict()
+    seq_len_log_info = minimum_seq_length_check(trimmed_windows, TRIMAL_MIN_LENGTH, drop_reasons)
     # Filter out files with missing samples if TRIMAL_DROP_WINDOWS == True
-    filtered_files = [f for f in filtered_chrom_outdir.iterdir() if check_fasta(f)]
     missing_sample_log_info, num_dropped = missing_sample_check(
-        filtered_files, TRIMAL_DROP_WINDOWS
+        trimmed_windows, TRIMAL_DROP_WINDOWS, drop_reasons
     )
-    # Recollect filtered files
-    filtered_files = [f for f in filtered_chrom_outdir.iterdir() if check_fasta(f)]
-    # Identify files with no remaining sequence
-    empty_files = [f for f in files if f.name not in [i.name for i in filtered_files]]
-    write_empty_files(empty_files, filtered_chrom_outdir)
-    # Generate log messages for empty sequences
+    # Windows Trimal failed on are dropped
+    for name, r in failed_windows.items():
+        (filtered_chrom_outdir / name).unlink(missing_ok=True)
+        drop_reasons[name] = f"Trimal failed after {r.attempts} attempt(s): {r.error}"
+    write_empty_files(empty_files + [r.task.window for r in failed_windows.values()], filtered_chrom_outdir)
+    # Generate log messages for empty sequences + failed windows
     empty_seq_logs = [empty_seq_log(f.name) for f in empty_files]
+    empty_seq_logs += [
+        f"*Window Dropped* | File: {n} | Reason: {drop_reasons[n]}" for n in failed_windows
+    ]
+    for f in empty_files:
+        drop_reasons[f.name] = EMPTY_SEQ_REASON
+    # Record window status in the run manifest
+    if MANIFEST is not None:
+        records = []
+        for f in files:
+            if f.name in drop_reasons:
+                output = filtered_chrom_outdir / f"{f.stem}-DROPPED.fasta"
+                records.append(WindowRecord(f.name, DROPPED, drop_reasons[f.name], output.as_posix(), run_times[f.name]))
+            else:
+                output = filtered_chrom_outdir / f.name
+                records.append(WindowRecord(f.name, VALID, None, output.as_posix(), run_times[f.name]))
+        with RunManifest(MANIFEST) as manifest:
+            manifest.record("trimal", chrom_name, records)
     # Calculate remaining files
-    final_valid_file_count = init_file_count - (
-        len(seq_len_log_info) + len(empty_files)
-    )
     final_fail_seq_len_file_count = len(seq_len_log_info)
-    final_dropped_file_count = len(empty_files)
+    final_dropped_file_count = len(empty_files) + len(failed_windows)
     final_valid_file_count = init_file_count - (
-        len(seq_len_log_info) + len(empty_files)
+        len(seq_len_log_info) + final_dropped_file_count
     )
-    return_dict[chrom] = (
+    return (
         seq_len_log_info,
         missing_sample_log_info,
         num_dropped,
@@ -189,6 +228,61 @@ def run_trimal_per_chrom(
         final_fail_seq_len_file_count,
         final_dropped_file_count,
         empty_seq_logs,
+        validation_logs,
+    )
+
+
+def pack_trimal_archive(chrom_name, chrom_outdir, output, MANIFEST=None):
+    """Pack a chromosome's trimmed windows into an archive + point the manifest at it"""
+    pack_window_dir(chrom_outdir, output)
+    if MANIFEST is not None:
+        with RunManifest(MANIFEST) as manifest:
+            manifest.set_output("trimal", chrom_name, output.as_posix())
+    return
+
+
+def run_trimal_per_chrom(
+    chrom,
+    filtered_outdir,
+    TRIMAL_THRESH,
+    TRIMAL_MIN_LENGTH,
+    TRIMAL_DROP_WINDOWS,
+    TRIMAL_PATH,
+    return_dict,
+    MANIFEST=None,
+    TRIMAL_ENGINE="trimal",
+):
+    """Run a single chromosome's windows through Trimal in the current process.
+    TRIMAL_ENGINE selects external Trimal ("trimal"), the native gap trimmer ("native") or
+    external Trimal with each window diffed against the native trimmer ("validate").
+    Window status is recorded in the run manifest when one is given."""
+    if is_window_archive(chrom):
+        # Run the extracted windows through Trimal + pack the output into an archive
+        with extracted_windows(chrom) as window_dir, tempfile.TemporaryDirectory() as tmp_outdir:
+            run_trimal_per_chrom(
+                window_dir,
+                Path(tmp_outdir),
+                TRIMAL_THRESH,
+                TRIMAL_MIN_LENGTH,
+                TRIMAL_DROP_WINDOWS,
+                TRIMAL_PATH,
+                return_dict,
+                MANIFEST,
+                TRIMAL_ENGINE,
+            )
+            output = archive_path(filtered_outdir, window_dir.name)
+            pack_trimal_archive(window_dir.name, Path(tmp_outdir) / window_dir.name, output, MANIFEST)
+        return return_dict
+    # Make output chromosome directory
+    filtered_chrom_outdir = filtered_outdir / f"{chrom.name}"
+    filtered_chrom_outdir.mkdir(parents=True, exist_ok=True)
+    tasks = window_tasks(chrom.name, chrom, filtered_chrom_outdir, window_files(MANIFEST, chrom.name, chrom))
+    results = run_tasks_serially(
+        partial(trim_window_task, TRIMAL_THRESH=TRIMAL_THRESH, TRIMAL_PATH=TRIMAL_PATH, TRIMAL_ENGINE=TRIMAL_ENGINE),
+        tasks,
+    )
+    return_dict[chrom.name] = summarize_trimal_chrom(
+        chrom.name, results, TRIMAL_MIN_LENGTH, TRIMAL_DROP_WINDOWS, MANIFEST
     )
     return return_dict
 
@@ -223,6 +317,42 @@ def get_cpu_count(MULTIPROCESS):
 
 
 ############################### Main Function ################################
+def log_trimal_chrom(chrom_name, log_info, TRIMAL_ENGINE):
+    (
+        seq_len_log_info,
+        missing_sample_log_info,
+        num_dropped,
+        init_file_count,
+        final_valid_file_count,
+        final_fail_seq_len_file_count,
+        final_dropped_file_count,
+        empty_seq_logs,
+        validation_logs,
+    ) = log_info
+    logger.info("-------------------")
+    logger.info(f"Sequence: {chrom_name}")
+    logger.info(f"Initial file count: {init_file_count}")
+    logger.info(f"Remaining valid files after Trimal: {final_valid_file_count}")
+    logger.info(
+        f"Failed to minimum sequence length: {final_fail_seq_len_file_count}"
+    )
+    logger.info(f"Windows with missing samples: {num_dropped}")
+    logger.info(f"No sequence remaining in file: {final_dropped_file_count}")
+    logger.info("-------------------")
+    for i in seq_len_log_info:
+        logger.info(i)
+    for i in missing_sample_log_info:
+        logger.info(i)
+    for j in empty_seq_logs:
+        logger.info(j)
+    if TRIMAL_ENGINE == "validate":
+        logger.info(f"Windows where Trimal + native trimmer differ: {len(validation_logs)}")
+        for v in validation_logs:
+            logger.info(v)
+    logger.info(f"=====================================================")
+    return
+
+
 def trimal(
     unfiltered_indir,
     filtered_outdir,
@@ -233,58 +363,56 @@ def trimal(
     TRIMAL_PATH,
     MULTIPROCESS,
     LOG_LEVEL,
+    TRIMAL_ENGINE="trimal",
+    TASK_TIMEOUT=None,
+    TASK_RETRIES=0,
 ):
-    """Entry point for Trimal that parses the input chromosome directories
-    into chunks equal to the number cores asked to be used."""
+    """Entry point for Trimal. The windows of every chromosome are run as one
+    task queue (see UTIL_scheduler) and each chromosome is checked + logged as
+    soon as its last window is trimmed."""
     set_logger_level(WORKING_DIR, LOG_LEVEL)
     freeze_support()
-    check_trimal_install(TRIMAL_PATH)
+    if TRIMAL_ENGINE != "native":
+        check_trimal_install(TRIMAL_PATH)
 
     cpu_count = get_cpu_count(MULTIPROCESS)
-    chrom_dirs = sorted([c for c in unfiltered_indir.iterdir() if c.is_dir()])
-    manager = Manager()
-    return_dict = manager.dict()
-
-    p_umap(
-        partial(
-            run_trimal_per_chrom,
-            filtered_outdir=filtered_outdir,
-            TRIMAL_THRESH=TRIMAL_THRESH,
-            TRIMAL_MIN_LENGTH=TRIMAL_MIN_LENGTH,
-            TRIMAL_DROP_WINDOWS=TRIMAL_DROP_WINDOWS,
-            TRIMAL_PATH=TRIMAL_PATH,
-            return_dict=return_dict,
-        ),
-        chrom_dirs,
-        **{"num_cpus": cpu_count},
-    )
+    chrom_dirs = sorted([c for c in unfiltered_indir.iterdir() if c.is_dir() or is_window_archive(c)])
+    MANIFEST = manifest_path(WORKING_DIR)
+    filtered_outdir.mkdir(parents=True, exist_ok=True)
 
-    for c in return_dict.keys():
-        (
-            seq_len_log_info,
-            missing_sample_log_info,
-            num_dropped,
-            init_file_count,
-            final_valid_file_count,
-            final_fail_seq_len_file_count,
-            final_dropped_file_count,
-            empty_seq_logs,
-        ) = return_dict[c]
-        logger.info("-------------------")
-        logger.info(f"Sequence: {c.name}")
-        logger.info(f"Initial file count: {init_file_count}")
-        logger.info(f"Remaining valid files after Trimal: {final_valid_file_count}")
-        logger.info(
-            f"Failed to minimum sequence length: {final_fail_seq_len_file_count}"
+    with ExitStack() as stack:
+        # Collect the windows of every chromosome - archives are extracted to temporary directories
+        chrom_outdirs = dict()
+        archive_outputs = dict()
+        tasks = list()
+        for c in chrom_dirs:
+            if is_window_archive(c):
+                window_dir = stack.enter_context(extracted_windows(c))
+                tmp_outdir = Path(stack.enter_context(tempfile.TemporaryDirectory()))
+                chrom_name = window_dir.name
+                chrom_outdirs[chrom_name] = tmp_outdir / chrom_name
+                archive_outputs[chrom_name] = archive_path(filtered_outdir, chrom_name)
+            else:
+                window_dir = c
+                chrom_name = c.name
+                chrom_outdirs[chrom_name] = filtered_outdir / chrom_name
+            chrom_outdirs[chrom_name].mkdir(parents=True, exist_ok=True)
+            tasks += window_tasks(chrom_name, window_dir, chrom_outdirs[chrom_name], window_files(MANIFEST, chrom_name, window_dir))
+        # Run all windows + finish each chromosome as its windows complete
+        results = schedule_tasks(
+            partial(trim_window_task, TRIMAL_THRESH=TRIMAL_THRESH, TRIMAL_PATH=TRIMAL_PATH, TRIMAL_ENGINE=TRIMAL_ENGINE),
+            tasks,
+            cpu_count,
+            TASK_TIMEOUT,
+            TASK_RETRIES,
         )
-        logger.info(f"Windows with missing samples: {num_dropped}")
-        logger.info(f"No sequence remaining in file: {final_dropped_file_count}")
-        logger.info("-------------------")
-        for i in seq_len_log_info:
-            logger.info(i)
-        for i in missing_sample_log_info:
-            logger.info(i)
-        for j in empty_seq_logs:
-            logger.info(j)
-        logger.info(f"=====================================================")
+        for chrom_name, chrom_results in stream_chromosomes(results, tasks, chrom_outdirs.keys()):
+            log_info = summarize_trimal_chrom(
+                chrom_name, chrom_results, TRIMAL_MIN_LENGTH, TRIMAL_DROP_WINDOWS, MANIFEST
+            )
+            if chrom_name in archive_outputs:
+                pack_trimal_archive(chrom_name, chrom_outdirs[chrom_name], archive_outputs[chrom_name], MANIFEST)
+            log_trimal_chrom(chrom_name, log_info, TRIMAL_ENGINE)
+    for line in drop_report_lines(MANIFEST, "trimal"):
+        logger.info(line)
     return
@@ -1,20 +1,24 @@
 def config_template():
     file_contents = """[General]
 multi_alignment_dir = input/dir/with/chromosomes/
-TreeViewer_file_name = TreeViewer_input_file.xlsx
+TreeViewer_file_name = TreeViewer_input_file.parquet
 outdir = /example/output/directory
 
 [Fasta Windower]
 # Give as 100bp/kb/mb
 window_size = 100bp
+# Pack windows into one archive per chromosome instead of one file per window
+window_archive = False
 
 [Trimal]
 gap_threshold = 0.9
 minimum_seq_length = 50bp
 drop_windows = True
+engine = trimal
 
 [Pairwise Estimator]
 percent_of_chromosome_to_run = 0.1
+ci_width = 0.01
 
 [Pairwise Filter]
 reference_name = REFERENCE
@@ -31,15 +35,27 @@ missing_char = N
 model = GTR*H4
 bootstrap = 1000
 cores_per_job = AUTO
+# Directory of the IQ-TREE result cache (leave empty for no cache)
+cache_dir =
+cache_max_mb = 1024
+# Windows per IQ-TREE run (IQ-TREE 2 per-locus trees, -S) - 1 runs each window on its own
+batch_size = 1
+# With a model selection option (i.e., model = MFP), run ModelFinder on model_sample windows
+# per region of model_region windows (0 = whole chromosome) - 0 runs ModelFinder in every window
+model_sample = 0
+model_region = 0
 
 [Topobinner]
 rooted_trees = N
+# Cluster topologies within this Robinson-Foulds distance (0 = identical topologies only)
+max_rf = 0
 
 [Logging]
 level = INFO
 
 [Processing]
 multiprocess = 8
+task_retries = 0
     """
     with open("config_template.ini", 'w') as oh:
         oh.write(file_contents)
@@ -1,22 +1,16 @@
-
-import pandas as pd
+from thexb.UTIL_file_reader import read_treeviewer_file, write_treeviewer_file
 
 def parse_treeviewer_per_chromosome(INPUT, WORKING_DIR):
     """Parse whole-genome TreeViewer file by chromosome 
-       and output into new files"""
+       and output into new files of the same file type"""
     # Read in input file
-    if 'csv' in INPUT.suffix:
-        df = pd.read_csv(INPUT)
-    elif 'tsv' in INPUT.suffix:
-        df = pd.read_csv(INPUT, sep='\t')
-    elif 'xls' in INPUT.suffix:
-        df = pd.read_excel(INPUT, engine='openpyxl')
+    df = read_treeviewer_file(INPUT)
     
     # Group data by chromosome
     df_grouped = df.groupby(by='Chromosome')
 
     for chrom, data in df_grouped:
-        output_filename = WORKING_DIR / f"{chrom}_{INPUT.name}.xlsx"
-        data.to_excel(output_filename, index=False)
+        output_filename = WORKING_DIR / f"{chrom}_{INPUT.name}"
+        write_treeviewer_file(data, output_filename)
         continue
     return
\ No newline at end of file
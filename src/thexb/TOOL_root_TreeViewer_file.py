@@ -1,11 +1,13 @@
 import logging
 import os
+from functools import partial
 
+import pandas as pd
 from ete3 import Tree
-from tqdm import tqdm
 
-from thexb.UTIL_file_reader import read_file_to_df
-from thexb.STAGE_topobinner import topobinner
+from thexb.UTIL_file_reader import read_file_to_df, write_treeviewer_file
+from thexb.UTIL_tree_arrays import map_trees
+from thexb.STAGE_topobinner import topobin_trees
 ############################### Set up logger #################################
 logger = logging.getLogger(__name__)
 def set_logger_level(WORKING_DIR, LOG_LEVEL):
@@ -21,59 +23,53 @@ def set_logger_level(WORKING_DIR, LOG_LEVEL):
     logger.setLevel(LOG_LEVEL)
     return logger
 ############################## Helper Functions ###############################
-def output_updated_df(updated_tv_df, INPUT, output_filename):
-    """Output updated dataframe to specified file type"""
-    if 'xls' in INPUT.suffix:
-        updated_tv_df.to_excel(output_filename, index=False)
-    elif "csv" in INPUT.suffix:
-        updated_tv_df.to_csv(output_filename, index=False)
-    elif 'tsv' in INPUT.suffix:
-        updated_tv_df.to_csv(output_filename, sep='\t', index=False)
-    return
+def root_tree(t, TV_OUTGROUP, TV_OUTGROUP_REMOVE):
+    """Root a newick tree with TV_OUTGROUP. Returns (tree, error) - "NoTree" when the
+    outgroup is not monophyletic, or None and (error, tree) when it could not be rooted"""
+    if t == "NoTree":
+        return t, None
+    try:
+        tree = Tree(t)
+        ancestor = tree.get_common_ancestor(TV_OUTGROUP)
+        tree.set_outgroup(ancestor)
+        if (not tree.check_monophyly(TV_OUTGROUP, target_attr="name")[0]) and (not TV_OUTGROUP_REMOVE):
+            return "NoTree", None
+        return tree.write(), None
+    except ValueError as e:
+        return None, (e, tree.write())
 
 
 ############################### Main Function ################################
-def root_TreeViewer_file(INPUT, updated_TV_dir, TV_OUTGROUP, TV_OUTGROUP_REMOVE, WORKING_DIR, LOG_LEVEL):
-    """Takes in a TreeViewer input file and roots the Newick Trees with a provided outgroup"""
+def root_TreeViewer_file(INPUT, updated_TV_dir, TV_OUTGROUP, TV_OUTGROUP_REMOVE, WORKING_DIR, LOG_LEVEL, cpu_count=1):
+    """Takes in a TreeViewer input file and roots the Newick Trees with a provided outgroup.
+    Trees are rooted across cpu_count processes and re-binned in memory before the output is written."""
     set_logger_level(WORKING_DIR, LOG_LEVEL)
     logger.debug(f"Loading {INPUT.name} into memmory")
-    tv_df = read_file_to_df(INPUT)
+    tv_df = read_file_to_df(INPUT).reset_index(drop=True)
     updated_tv_df = tv_df.copy()
     logger.debug(f"Setting new outgroup")
     log_list=[]
-    with tqdm(total=len(updated_tv_df["NewickTree"])) as pbar:
-        for n, t in enumerate(updated_tv_df["NewickTree"]):
-            if t == "NoTree":
-                pbar.update(1)
-                continue
-            else:
-                try:
-                    tree = Tree(t)
-                    ancestor = tree.get_common_ancestor(TV_OUTGROUP)
-                    tree.set_outgroup(ancestor)
-                    if (not tree.check_monophyly(TV_OUTGROUP, target_attr="name")[0]) and (not TV_OUTGROUP_REMOVE):
-                        updated_tv_df.at[n, "NewickTree"] = "NoTree"
-                    else:
-                        updated_tv_df.at[n, "NewickTree"] = tree.write()
-                    pbar.update(1)
-                    continue
-                except ValueError as e:
-                    log_list.append(f"{e} - {tv_df.at[n, 'Chromosome']}_{tv_df.at[n, 'Window']} - {tree.write()}")
-                    continue
-    # Re-bin topologies
-    del updated_tv_df['TopologyID']
-    # updated_tv_df['TopologyID'] = ['']*len(updated_tv_df)
-    updated_tv_df.insert(3, "TopologyID", ['']*len(updated_tv_df))
-    output_filename = updated_TV_dir / f"{INPUT.stem}.rooted_to_{'_'.join(TV_OUTGROUP)}.tmp{INPUT.suffix}"
-    output_updated_df(updated_tv_df, INPUT, output_filename)
-    topobinner(
-        output_filename,
-        updated_TV_dir / f"{INPUT.stem}.rooted_to_{'_'.join(TV_OUTGROUP)}{INPUT.suffix}",
-        True,
-        WORKING_DIR,
-        LOG_LEVEL,
+    # Trees are rooted across cpu_count processes
+    rooted_trees = map_trees(
+        partial(root_tree, TV_OUTGROUP=TV_OUTGROUP, TV_OUTGROUP_REMOVE=TV_OUTGROUP_REMOVE),
+        updated_tv_df["NewickTree"],
+        cpu_count,
     )
-    output_filename.unlink()
+    for n, (tree, error) in enumerate(rooted_trees):
+        if error is not None:
+            e, tree_string = error
+            log_list.append(f"{e} - {tv_df.at[n, 'Chromosome']}_{tv_df.at[n, 'Window']} - {tree_string}")
+            continue
+        updated_tv_df.at[n, "NewickTree"] = tree
+    # Re-bin topologies in memory
+    del updated_tv_df['TopologyID']
+    updated_tv_df.insert(3, "TopologyID", [pd.NA]*len(updated_tv_df))
+    updated_tv_df = updated_tv_df.astype({"TopologyID": "object"}).reset_index(drop=True)
+    # Trees that could not be rooted keep their original root, so bin unrooted
+    overview_df = topobin_trees(updated_tv_df, "N", cpu_count)
+    output_filename = updated_TV_dir / f"{INPUT.stem}.rooted_to_{'_'.join(TV_OUTGROUP)}{INPUT.suffix}"
+    write_treeviewer_file(updated_tv_df, output_filename)
+    logger.info(f"\n{overview_df}")
     for msg in log_list:
         logger.info(msg)
     
@@ -0,0 +1,133 @@
+"""
+Alignment store - holds a multiple-sequence alignment as a (samples x sites)
+uint8 matrix of ASCII codes, or of nucleotide codes (see UTIL_encoding).
+Sequences shorter than the longest sequence are padded with 0 (ASCII) or
+PAD (encoded).
+
+Encoded stores are packed 4 bits per site (see UTIL_encoding.pack) unless a
+sequence holds a character that is not a gap or IUPAC code, and are read as a
+CodeMatrix (see store_code_matrix). ASCII stores keep one byte per site so
+windows are written back out exactly as they were read.
+
+A store is written once to a memory-mapped .npy file. Worker processes open
+it read-only by its handle and take window views of the matrix without
+re-parsing the fasta file or copying sequence data - the pages are shared
+between processes through the OS page cache.
+
+A lazy store is built by the first worker that reads it (see
+open_lazy_alignment_store) so that stores only exist on disk while they are
+in use, rather than every file being written up front.
+"""
+import os
+from collections import namedtuple
+from pathlib import Path
+
+import numpy as np
+from pyfaidx import Fasta
+
+from thexb.UTIL_encoding import PAD, CodeMatrix, encode, pack
+
+# Picklable reference to a store that is passed to worker processes
+AlignmentStoreHandle = namedtuple("AlignmentStoreHandle", ["path", "samples", "lengths"])
+# Picklable reference to a store that is built from source on first use
+LazyAlignmentStore = namedtuple("LazyAlignmentStore", ["source", "path", "samples", "lengths", "encoded"])
+
+
+def fill_alignment_matrix(alignment, samples, matrix, encoded=False, packed=False):
+    """
+    Load each sample of an open pyfaidx Fasta into a row of matrix. Packed
+    rows raise ValueError on a code that does not fit in 4 bits.
+    """
+    width = matrix.shape[1] * 2 if packed else matrix.shape[1]
+    for n, sample in enumerate(samples):
+        seq = np.frombuffer(alignment[sample][:].seq.encode("ascii"), dtype=np.uint8)[:width]
+        if encoded:
+            seq = encode(seq)
+            if packed:
+                seq = pack(seq)
+            else:
+                matrix[n, len(seq):] = PAD
+        matrix[n, :len(seq)] = seq
+    return matrix
+
+
+def load_code_matrix(alignment, samples=None, keep_case=False):
+    """
+    Load an open pyfaidx Fasta into memory as a CodeMatrix, one sample at a
+    time. Returns the sample order and the matrix.
+    """
+    samples = list(alignment.keys()) if samples is None else list(samples)
+    lengths = [len(alignment[s]) for s in samples]
+    seqs = (alignment[s][:].seq for s in samples)
+    return samples, CodeMatrix.from_sequences(seqs, lengths, keep_case)
+
+
+def alignment_lengths(f, samples):
+    """Return the sequence length of each sample of fasta file f"""
+    with Fasta(f.as_posix()) as alignment:
+        return [len(alignment[s]) for s in samples]
+
+
+def _write_store(alignment, samples, store_path, shape, encoded, packed):
+    matrix = np.lib.format.open_memmap(store_path, mode="w+", dtype=np.uint8, shape=shape)
+    try:
+        fill_alignment_matrix(alignment, samples, matrix, encoded, packed)
+        matrix.flush()
+    finally:
+        del matrix
+
+
+def build_alignment_store(f, store_path, samples=None, encoded=False):
+    """
+    Write the samples of fasta file f (all samples in file order by default)
+    to a memory-mapped store at store_path. Sequences are loaded one sample
+    at a time. Encoded stores are packed when every site fits in 4 bits.
+    Returns the store's handle.
+    """
+    with Fasta(f.as_posix()) as alignment:
+        samples = list(alignment.keys()) if samples is None else list(samples)
+        lengths = [len(alignment[s]) for s in samples]
+        # Zero-size files can not be memory-mapped
+        width = max(max(lengths, default=0), 1)
+        # Single-site stores are never packed so a store's width tells whether it is packed
+        if encoded and width > 1:
+            try:
+                _write_store(alignment, samples, store_path, (len(samples), (width + 1) // 2), encoded, True)
+                return AlignmentStoreHandle(store_path, samples, lengths)
+            except ValueError:
+                # A site that is not a gap or IUPAC code - store one code per site
+                pass
+        _write_store(alignment, samples, store_path, (len(samples), width), encoded, False)
+    return AlignmentStoreHandle(store_path, samples, lengths)
+
+
+def open_alignment_store(handle):
+    """Open a store read-only. Slices of the returned matrix are views."""
+    return np.load(handle.path, mmap_mode="r")
+
+
+def store_code_matrix(matrix, lengths):
+    """Read an encoded store's matrix as a CodeMatrix - packed stores are narrower than their longest sequence"""
+    return CodeMatrix(matrix, lengths, matrix.shape[1] != max(max(lengths, default=0), 1))
+
+
+def open_lazy_alignment_store(store, lock):
+    """
+    Open a lazy store read-only, building it from its source fasta first if
+    no process has yet. Stores are written under a temporary name and renamed
+    when complete, so an existing store is opened without taking lock. lock
+    is held while building so each store is written once.
+    """
+    path = Path(store.path)
+    if not path.exists():
+        with lock:
+            if not path.exists():
+                partial = path.with_name(f"{path.name}.partial")
+                build_alignment_store(store.source, partial, store.samples, store.encoded)
+                os.replace(partial, path)
+    return np.load(path, mmap_mode="r")
+
+
+def decode_sites(sites):
+    """Convert an ASCII uint8 row (or slice of a row) back to a string"""
+    return np.ascontiguousarray(sites).tobytes().decode("ascii").rstrip("\x00")
@@ -0,0 +1,237 @@
+"""
+Nucleotide byte codes shared across THExBuilder stages.
+
+Sequences are encoded to one uint8 code per site:
+    - A/C/G/T and the IUPAC ambiguity codes are 4-bit base masks
+      (A=1, C=2, G=4, T=8, R=A|G=5, ..., N=15)
+    - Gaps ('-') are 0
+    - Any other character keeps its upper-case ASCII code (always >= 32 for
+      printable characters), so no two different characters share a code
+    - PAD (255) marks sites past the end of a shorter sequence
+
+Encoding is case-insensitive, so comparing codes is the same as comparing
+upper-cased sequences. Sequences made up only of gaps and IUPAC codes fit in
+4 bits per site and are packed two sites per byte with pack().
+
+CodeMatrix holds an alignment in memory in the packed form (uint8 codes when
+a site does not fit in 4 bits) and is used by the pairwise filter and the
+p-distance alignment stores. It can keep each site's case as a bit mask so
+sequences are written back out as they were read.
+
+The ASCII helpers (ascii_codes, is_ascii_gap) work on unencoded text - the
+native gap trimmer writes windows back out byte for byte.
+"""
+import numpy as np
+
+GAP = 0
+PAD = 255
+ASCII_GAP = ord("-")
+BASE_MASKS = {
+    "A": 1, "C": 2, "G": 4, "T": 8,
+    "M": 3, "R": 5, "W": 9, "S": 6, "Y": 10, "K": 12,
+    "V": 7, "H": 11, "D": 13, "B": 14, "N": 15,
+}
+UNAMBIGUOUS_CODES = np.array([1, 2, 4, 8], dtype=np.uint8)
+
+# Lookup tables indexed by ASCII byte (upper + encode) or code (decode)
+UPPER_TABLE = np.array([ord(chr(b).upper()) if b < 128 else b for b in range(256)], dtype=np.uint8)
+ENCODE_TABLE = UPPER_TABLE.copy()
+DECODE_TABLE = np.arange(256, dtype=np.uint8)
+for base, code in BASE_MASKS.items():
+    ENCODE_TABLE[ord(base)] = code
+    ENCODE_TABLE[ord(base.lower())] = code
+    DECODE_TABLE[code] = ord(base)
+ENCODE_TABLE[ord("-")] = GAP
+DECODE_TABLE[GAP] = ord("-")
+
+
+############################## Encode + Decode ###############################
+def encode(seq):
+    """Encode a str, bytes or uint8 array of ASCII characters"""
+    if isinstance(seq, str):
+        seq = seq.encode("ascii")
+    if isinstance(seq, (bytes, bytearray)):
+        seq = np.frombuffer(seq, dtype=np.uint8)
+    return ENCODE_TABLE[seq]
+
+
+def encode_char(char):
+    """Return the code of a single character"""
+    return int(ENCODE_TABLE[ord(char)])
+
+
+def decode(codes):
+    """Decode to an upper-case string. PAD sites are dropped."""
+    codes = np.asarray(codes)
+    return DECODE_TABLE[codes[codes != PAD]].tobytes().decode("ascii")
+
+
+def pack(codes):
+    """
+    Pack codes into 4 bits per site, two sites per byte (first site in the
+    high nibble), along the last axis. Raises ValueError if a code does not
+    fit in 4 bits.
+    """
+    codes = np.asarray(codes, dtype=np.uint8)
+    if codes.size and codes.max() > 15:
+        raise ValueError("Only gaps and IUPAC nucleotide codes can be packed into 4 bits")
+    if codes.shape[-1] % 2:
+        codes = np.concatenate([codes, np.full(codes.shape[:-1] + (1,), GAP, dtype=np.uint8)], axis=-1)
+    return (codes[..., 0::2] << 4) | codes[..., 1::2]
+
+
+def unpack(packed, length):
+    """Unpack length sites packed with pack(), along the last axis"""
+    packed = np.asarray(packed, dtype=np.uint8)
+    codes = np.empty(packed.shape[:-1] + (packed.shape[-1] * 2,), dtype=np.uint8)
+    codes[..., 0::2] = packed >> 4
+    codes[..., 1::2] = packed & 15
+    return codes[..., :length]
+
+
+def unpack_sites(packed, start, end):
+    """Unpack sites [start:end) - only the bytes holding them are read"""
+    first = start // 2
+    codes = unpack(packed[..., first:(end + 1) // 2], 2 * ((end + 1) // 2 - first))
+    return codes[..., start - 2 * first:end - 2 * first]
+
+
+################################# ASCII Codes ################################
+def ascii_codes(seq):
+    """Return the ASCII codes of a str, case preserved"""
+    return np.frombuffer(seq.encode("ascii"), dtype=np.uint8)
+
+
+def is_ascii_lower(codes):
+    return (codes >= ord("a")) & (codes <= ord("z"))
+
+
+def is_ascii_gap(codes):
+    return codes == ASCII_GAP
+
+
+################################# Predicates #################################
+def is_present(codes):
+    """Sites inside the sequence (not PAD)"""
+    return codes != PAD
+
+
+def is_gap(codes):
+    return codes == GAP
+
+
+def is_missing(codes, missing_char):
+    """Sites encoded as missing_char (i.e., N - case-insensitive)"""
+    return codes == encode_char(missing_char)
+
+
+def is_unambiguous(codes):
+    """Sites that are A, C, G or T"""
+    return np.isin(codes, UNAMBIGUOUS_CODES)
+
+
+def is_nucleotide(codes):
+    """Sites that are A, C, G, T or an IUPAC ambiguity code (N included)"""
+    return (codes > GAP) & (codes < 16)
+
+
+def mismatch(codes1, codes2):
+    """Case-insensitive mismatch between two encoded sequences. Sites past
+    the end of either sequence never mismatch."""
+    return (codes1 != codes2) & is_present(codes1) & is_present(codes2)
+
+
+def is_letter(codes):
+    """Sites that were a letter (str.isalpha() of the original character)"""
+    return is_nucleotide(codes) | ((codes >= ord("A")) & (codes <= ord("Z")))
+
+
+################################# Code Matrix ################################
+class CodeMatrix:
+    """
+    A (samples x sites) alignment of nucleotide codes. Rows are held packed
+    (see pack) while every code fits in 4 bits, otherwise as uint8 codes.
+    lengths is the sequence length of each row - sites past it read as PAD.
+    lower, when given, is a bit mask (np.packbits) of each row's lower-case
+    sites so decoded rows keep their original case.
+    """
+
+    def __init__(self, data, lengths, packed, lower=None):
+        self.data = data
+        self.lengths = list(lengths)
+        self.packed = packed
+        self.lower = lower
+
+    @classmethod
+    def from_sequences(cls, seqs, lengths, keep_case=False):
+        """
+        Encode an iterable of str sequences with known lengths one row at a
+        time, so the alignment is never held as text.
+        """
+        lengths = list(lengths)
+        width = max(lengths, default=0)
+        matrix = cls(np.zeros((len(lengths), (width + 1) // 2), dtype=np.uint8), lengths, True)
+        if keep_case:
+            matrix.lower = np.zeros((len(lengths), (width + 7) // 8), dtype=np.uint8)
+        for n, seq in enumerate(seqs):
+            text = ascii_codes(seq)[:lengths[n]]
+            matrix.set_row(n, encode(text), is_ascii_lower(text) if keep_case else None)
+        return matrix
+
+    def __len__(self):
+        return len(self.lengths)
+
+    @property
+    def width(self):
+        return max(self.lengths, default=0)
+
+    def row(self, n):
+        """Codes of row n (without PAD)"""
+        if self.packed:
+            return unpack(self.data[n], self.lengths[n])
+        return self.data[n, :self.lengths[n]]
+
+    def lower_row(self, n):
+        """Lower-case sites of row n"""
+        return np.unpackbits(self.lower[n], count=self.lengths[n]).astype(bool)
+
+    def region(self, start, end):
+        """Codes of sites [start:end) of every row - sites past a row's length are PAD"""
+        end = min(end, self.width)
+        if not self.packed:
+            return self.data[:, start:end]
+        codes = unpack_sites(self.data, start, end)
+        codes[np.arange(start, end) >= np.array(self.lengths)[:, None]] = PAD
+        return codes
+
+    def set_row(self, n, codes, lower=None):
+        """Replace row n - the matrix is unpacked if a code does not fit in 4 bits"""
+        if self.packed:
+            try:
+                packed = pack(codes)
+            except ValueError:
+                self.unpack()
+            else:
+                self.data[n, :len(packed)] = packed
+        if not self.packed:
+            self.data[n, :len(codes)] = codes
+        if lower is not None:
+            bits = np.packbits(lower)
+            self.lower[n, :len(bits)] = bits
+
+    def unpack(self):
+        """Switch to holding uint8 codes"""
+        if self.packed:
+            codes = unpack(self.data, self.width)
+            for n, length in enumerate(self.lengths):
+                codes[n, length:] = PAD
+            self.data = codes
+            self.packed = False
+
+    def decode_row(self, n):
+        """ASCII codes of row n, in their original case when the case is kept"""
+        text = DECODE_TABLE[self.row(n)]
+        if self.lower is not None:
+            lower = self.lower_row(n)
+            text[lower] = text[lower] + (ord("a") - ord("A"))
+        return text
@@ -1,4 +1,24 @@
+"""
+TreeViewer file I/O - TreeViewer files are read and written by file suffix:
+    .parquet/.feather/.arrow - columnar (requires pyarrow), read memory-mapped,
+                               with Chromosome and TopologyID dictionary-encoded
+    .xlsx                    - Excel (limited to 1,048,576 rows, best kept for export)
+    .csv/.tsv/.txt           - delimited text
+"""
+from pathlib import Path
+
 import pandas as pd
+try:
+    import pyarrow as pa
+    import pyarrow.feather as feather
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+COLUMNAR_SUFFIXES = ('.parquet', '.feather', '.arrow')
+DICTIONARY_COLUMNS = ('Chromosome', 'TopologyID')
+
+
 
 def check_input_columns(cols):
     expected_cols = {
@@ -47,5 +67,95 @@ def read_file_to_df(file):
         open_file.sort_values(by=[cols[0], cols[1]], inplace=True)
         open_file.reset_index(drop=True, inplace=True)
         return open_file
+    elif file.suffix in COLUMNAR_SUFFIXES:
+        open_file = read_treeviewer_file(file)
+        cols = check_input_columns(open_file.columns.to_list())
+        open_file.columns = cols
+        open_file.sort_values(by=[cols[0], cols[1]], inplace=True)
+        open_file.reset_index(drop=True, inplace=True)
+        return open_file
+    else:
+        return None
+
+
+############################## TreeViewer Files ###############################
+def _require_pyarrow(file):
+    if pa is None:
+        raise ImportError(
+            f"Reading/writing {file.name} requires pyarrow, install it with 'conda install pyarrow' or 'pip install pyarrow' (or use a .xlsx/.csv/.tsv TreeViewer file)"
+        )
+    return
+
+
+def treeviewer_table(df):
+    """Convert a TreeViewer DataFrame to an Arrow table with Chromosome and TopologyID dictionary-encoded"""
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    for col in DICTIONARY_COLUMNS:
+        i = table.schema.get_field_index(col)
+        if i < 0:
+            continue
+        column = table.column(i)
+        if pa.types.is_dictionary(column.type):
+            continue
+        if column.null_count == len(column):  # i.e., blank TopologyID column
+            column = column.cast(pa.string())
+        table = table.set_column(i, col, column.dictionary_encode())
+    return table
+
+
+def read_columnar_treeviewer(source, file):
+    """
+    Load a .parquet/.feather/.arrow TreeViewer file into a DataFrame. source is the
+    file's path (read memory-mapped) or its contents as bytes (i.e., an uploaded file).
+    """
+    file = Path(file)
+    _require_pyarrow(file)
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        source, memory_map = pa.BufferReader(source), False
+    else:
+        memory_map = True
+    if file.suffix == '.parquet':
+        table = pq.read_table(source, memory_map=memory_map)
+    else:
+        table = feather.read_table(source, memory_map=memory_map)
+    df = table.to_pandas()
+    # Dictionary-encoded columns load as categories - decode to plain values
+    for col in DICTIONARY_COLUMNS:
+        if (col in df.columns) and isinstance(df[col].dtype, pd.CategoricalDtype):
+            df[col] = df[col].astype(object)
+    return df
+
+
+def read_treeviewer_file(file):
+    """Load a TreeViewer file of any supported type into a DataFrame (rows in file order)"""
+    file = Path(file)
+    if file.suffix in COLUMNAR_SUFFIXES:
+        return read_columnar_treeviewer(file, file)
+    elif file.suffix in ('.xlsx', '.xls'):
+        return pd.read_excel(file, engine='openpyxl')
+    elif file.suffix == '.csv':
+        return pd.read_csv(file, sep=',')
+    elif file.suffix in ('.tsv', '.txt'):
+        return pd.read_csv(file, sep='\t')
+    raise ValueError(f"Unsupported TreeViewer file type: {file.name}")
+
+
+def write_treeviewer_file(df, file):
+    """Write a TreeViewer DataFrame in the file type given by the file's suffix"""
+    file = Path(file)
+    if file.suffix in COLUMNAR_SUFFIXES:
+        _require_pyarrow(file)
+        table = treeviewer_table(df)
+        if file.suffix == '.parquet':
+            pq.write_table(table, file)
+        else:
+            feather.write_feather(table, file)
+    elif file.suffix in ('.xlsx', '.xls'):
+        df.to_excel(file, index=False)
+    elif file.suffix == '.csv':
+        df.to_csv(file, index=False)
+    elif file.suffix in ('.tsv', '.txt'):
+        df.to_csv(file, sep='\t', index=False)
     else:
-        return None
\ No newline at end of file
+        raise ValueError(f"Unsupported TreeViewer file type: {file.name}")
+    return
@@ -0,0 +1,117 @@
+"""
+Native gap-threshold trimmer - an in-process alternative to running each
+window through `trimal -gapthreshold`.
+
+trimAl's -gapthreshold keeps columns where the fraction of sequences with
+a gap is at most 1 - gapthreshold. The number of gaps allowed per column is
+computed the same way trimAl does (single precision, truncated), so
+    gapthreshold 0.9 with 10 sequences -> at most 1 gap per column
+Columns are dropped with a boolean mask over the alignment matrix, so a
+chromosome's windows are trimmed in the worker process without starting a
+trimal process per window. Sequences keep their original case and output is
+written as fasta with 60 bp lines (trimAl's fasta layout).
+
+Windows trimAl can not trim produce no output, as with trimAl:
+    - sequences of different lengths (unaligned input)
+    - windows where every column is removed
+"""
+from collections import namedtuple
+
+import numpy as np
+
+from thexb.UTIL_encoding import is_ascii_gap
+from thexb.UTIL_window_archive import parse_fasta_text
+
+TRIMAL_ENGINES = ["trimal", "native", "validate"]
+FASTA_LINE_WIDTH = 60
+
+TrimmedAlignment = namedtuple("TrimmedAlignment", ["samples", "matrix"])
+
+
+############################## Helper Functions ###############################
+def allowed_gaps(num_seqs, TRIMAL_THRESH):
+    """Maximum number of gaps in a kept column (trimAl's gap cut point)"""
+    return int(np.float32(num_seqs) * (np.float32(1) - np.float32(TRIMAL_THRESH)))
+
+
+def gap_counts(matrix):
+    """Number of gaps per column of an ASCII alignment matrix"""
+    return np.count_nonzero(is_ascii_gap(matrix), axis=0)
+
+
+def gap_column_mask(matrix, TRIMAL_THRESH):
+    """Boolean mask of the columns kept at TRIMAL_THRESH"""
+    return gap_counts(matrix) <= allowed_gaps(matrix.shape[0], TRIMAL_THRESH)
+
+
+def read_fasta_matrix(text):
+    """
+    Return (samples, matrix) of fasta text, or None if the sequences are not
+    all the same length.
+    """
+    records = parse_fasta_text(text)
+    if not records:
+        return None
+    lengths = {len(seq) for seq in records.values()}
+    if len(lengths) != 1:
+        return None
+    matrix = np.frombuffer("".join(records.values()).encode("ascii"), dtype=np.uint8)
+    return list(records.keys()), matrix.reshape(len(records), lengths.pop())
+
+
+def format_fasta(samples, matrix, width=FASTA_LINE_WIDTH):
+    """Format an ASCII alignment matrix as fasta text"""
+    records = []
+    for sample, row in zip(samples, matrix):
+        seq = row.tobytes().decode("ascii")
+        lines = "\n".join(seq[i:i + width] for i in range(0, len(seq), width))
+        records.append(f">{sample}\n{lines}\n")
+    return "".join(records)
+
+
+############################### Trim Functions ################################
+def trim_alignment(text, TRIMAL_THRESH):
+    """
+    Trim the columns of fasta text that exceed the gap threshold. Returns a
+    TrimmedAlignment, or None when trimAl would produce no output.
+    """
+    alignment = read_fasta_matrix(text)
+    if alignment is None:
+        return None
+    samples, matrix = alignment
+    trimmed = matrix[:, gap_column_mask(matrix, TRIMAL_THRESH)]
+    if trimmed.shape[1] == 0:
+        return None
+    return TrimmedAlignment(samples, trimmed)
+
+
+def trim_window(f, outfile, TRIMAL_THRESH):
+    """Trim window file f into outfile. Returns the TrimmedAlignment, or None when no output is written."""
+    trimmed = trim_alignment(f.read_text(), TRIMAL_THRESH)
+    if trimmed is None:
+        return None
+    with open(outfile, "w") as oh:
+        oh.write(format_fasta(trimmed.samples, trimmed.matrix))
+    return trimmed
+
+
+def compare_trimmed_windows(trimal_file, native_file):
+    """
+    Return a description of the difference between a window trimmed by
+    trimAl and by the native trimmer, or None if they match (line wrapping
+    is ignored).
+    """
+    if not trimal_file.exists() and not native_file.exists():
+        return None
+    elif not trimal_file.exists():
+        return "No Trimal output, native output written"
+    elif not native_file.exists():
+        return "Trimal output written, no native output"
+    trimal_records = parse_fasta_text(trimal_file.read_text())
+    native_records = parse_fasta_text(native_file.read_text())
+    if list(trimal_records.keys()) != list(native_records.keys()):
+        return "Sample names differ"
+    for sample, seq in trimal_records.items():
+        if seq != native_records[sample]:
+            return f"Sequence of {sample} differs (Trimal: {len(seq)}bp, native: {len(native_records[sample])}bp)"
+    return None
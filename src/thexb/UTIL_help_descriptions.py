@@ -15,6 +15,10 @@ class HelpDesc:
         msg = "Fasta windowing step"
         return msg
 
+    def window_archive(self):
+        msg = "Pack windows into one archive file + offset index per chromosome instead of one fasta file per window. Later stages read archives directly and only extract windows to a temporary directory for Trimal and IQ-TREE."
+        return msg
+
     def trimal(self):
         msg = "Run windowed fasta files through Trimal"
         return msg
@@ -39,6 +43,18 @@ class HelpDesc:
         msg = "Calculate p-distance for one or more multiple-sequence alignment fasta files."
         return msg
 
+    def pdistance_matrix(self):
+        msg = "Calculate p-distance between every pair of samples in each window. Output is in long format (Chromosome, Window, SampleA, SampleB, Value) and does not require a reference."
+        return msg
+
+    def pdistance_step(self):
+        msg = "Step size between p-distance windows [bp/kb/mb] - use a step smaller than the window size for overlapping windows (default: window size)"
+        return msg
+
+    def pdistance_parquet(self):
+        msg = "Also write p-distance output as a Parquet file next to the TSV output (requires pyarrow)"
+        return msg
+
     def pdistance_threshold(self):
         msg = "Maximum frequency of missing data per-window. (default: 0.75)"
         return msg
@@ -83,6 +99,14 @@ class HelpDesc:
         msg = "Number of CPUs to use (default is system max)"
         return msg
 
+    def task_timeout(self):
+        msg = "Maximum run time in seconds of a single window in Trimal, Pairwise Filter and IQ-TREE. Windows that time out are retried or dropped (default: no limit)"
+        return msg
+
+    def task_retries(self):
+        msg = "Number of times a failed or timed out window is retried before it is dropped (default: 0)"
+        return msg
+
     def window_size(self):
         msg = "Window size [bp/kb/mb/gb] (default: 100kb)"
         return msg
@@ -91,6 +115,10 @@ class HelpDesc:
         msg = "Minimum percent of valid bases per-sequence in alignment required [0 - 1.0] (default: 0.9)"
         return msg
 
+    def trimal_engine(self):
+        msg = "Gap trimming engine: external Trimal (trimal), the built-in gap-threshold trimmer (native) or Trimal with every window compared against the built-in trimmer (validate) (default: trimal)"
+        return msg
+
     def trimal_minSeqLen(self):
         msg = "Minimum sequence length for a window to be retained (default: 1kb)"
         return msg
@@ -128,7 +156,11 @@ class HelpDesc:
         return msg
 
     def pwe_percent_chrom(self):
-        msg = "Percentage of each chromosome to randomly draw windows (default: 0.1)"
+        msg = "Maximum percentage of each chromosome to randomly draw windows (default: 0.1)"
+        return msg
+
+    def pwe_ci_width(self):
+        msg = "Stop sampling windows once the 95%% confidence intervals of the suggested p-distance and coverage cutoffs are narrower than this (default: 0.01)"
         return msg
 
     def iqtree_model(self):
@@ -140,13 +172,37 @@ class HelpDesc:
         return msg
 
     def iqtree_cpu_cores(self):
-        msg = "Number of cores to give each IQ-Tree run - recommended to use 3-5 cores max (default: 4)"
+        msg = "Number of cores to give each IQ-Tree run - AUTO gives each window cores by its size (sites x taxa), up to 8 (default: AUTO)"
+        return msg
+
+    def iqtree_cache(self):
+        msg = "Directory of the IQ-Tree result cache. Windows with an alignment, model, bootstrap count and IQ-Tree version already in the cache reuse the cached tree instead of running IQ-Tree. The cache can be shared between runs (default: no cache)"
+        return msg
+
+    def iqtree_cache_max_mb(self):
+        msg = "Maximum size of the IQ-Tree result cache in MB - least recently used trees are removed after each run (default: 1024)"
+        return msg
+
+    def iqtree_model_sample(self):
+        msg = "With a model selection option (i.e., --iqtree_model MFP), run ModelFinder on this many windows per chromosome region and give every window of the region the model chosen most often. Chosen models are stored in the working directory for reruns (default: 0 - ModelFinder runs in every window)"
+        return msg
+
+    def iqtree_model_region(self):
+        msg = "Number of consecutive windows that share a model chosen by --iqtree_model_sample - models are re-tested for each region along a chromosome (default: 0 - one model per chromosome)"
+        return msg
+
+    def iqtree_batch_size(self):
+        msg = "Number of windows to run per IQ-Tree process using IQ-Tree 2's per-locus tree mode (-S). Batches that fail are rerun one window at a time and --task_timeout applies per window of a batch (default: 1 - one IQ-Tree process per window)"
         return msg
 
     def tb_rooted_trees(self):
         msg = "True if input trees are rooted, False if they are unrooted (default: False)"
         return msg
 
+    def tb_max_rf(self):
+        msg = "Cluster topologies within this Robinson-Foulds distance of the most common topology of a cluster, instead of binning identical topologies only (default: 0)"
+        return msg
+
     def tb_outgroup(self):
         msg = "Sample(s) to set as outgroup (default: Will not root trees)"
         return msg
@@ -168,7 +224,7 @@ class HelpDesc:
         return msg
 
     def tv_file_name(self):
-        msg = "Name of Tree Viewer input file produced at the end of the Tree Viewer pipeline (default: TreeViewer_input_file.xlsx)"
+        msg = "Name of Tree Viewer input file produced at the end of the Tree Viewer pipeline, written as .parquet/.feather (requires pyarrow), .xlsx, .csv, or .tsv by file extension (default: TreeViewer_input_file.parquet)"
         return msg
 
     def trimal_dropwindows(self):
@@ -0,0 +1,145 @@
+"""
+IQ-TREE result cache - stores the .contree of every window IQ-TREE has run,
+keyed by a hash of the window's alignment and the settings that change the
+tree (model, bootstrap replicates, IQ-TREE version and whether the window was
+run in a per-locus batch).
+
+    iqtree_cache/
+        3f/
+            3f9c...e1.contree
+
+A window whose key is already in the cache is not run - its stored tree is
+copied to the window's output. The cache is a plain directory, so it can
+be shared between runs (and working directories). Entries are written
+atomically, a hit refreshes the entry's modification time and the least
+recently used entries are evicted once the cache is larger than its size
+limit.
+"""
+import hashlib
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+CACHE_SUFFIX = ".contree"
+HASH_BLOCK_SIZE = 1 << 20
+
+
+############################## Helper Functions ###############################
+def iqtree_version(IQTREE_PATH):
+    """Return IQ-TREE's version line, or None if it can not be read"""
+    try:
+        output = subprocess.run(
+            [f"{IQTREE_PATH} --version"],
+            shell=True,
+            check=True,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+        ).stdout.decode("utf-8", errors="replace")
+    except (subprocess.CalledProcessError, OSError):
+        return None
+    for line in output.splitlines():
+        if "version" in line.lower():
+            return line.strip()
+    return None
+
+
+def cache_size_to_bytes(size):
+    """Convert a cache size given in MB to bytes"""
+    return int(float(size) * 1024 * 1024)
+
+
+################################ IQ-TREE Cache ################################
+class IQTreeCache:
+    """Content-addressed store of IQ-TREE .contree files. Safe to pass to worker processes."""
+
+    def __init__(self, path, settings, max_bytes=None):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.settings = settings
+        self.max_bytes = max_bytes
+
+    @classmethod
+    def for_run(cls, path, IQT_MODEL, IQT_BOOTSTRAP, IQTREE_PATH, max_bytes=None, batched=False):
+        """Cache for a run's IQ-TREE settings, or None when IQ-TREE's version is unknown.
+        Trees of batched (-S) runs are kept apart from single-window runs."""
+        version = iqtree_version(IQTREE_PATH)
+        if version is None:
+            return None
+        settings = f"model={IQT_MODEL}\nbootstrap={IQT_BOOTSTRAP}\nversion={version}\n"
+        if batched:
+            settings += "batch=per-locus\n"
+        return cls(path, settings, max_bytes)
+
+    def key(self, f, model=None):
+        """Hash of a window file's content + the run settings (and the window's model when set)"""
+        digest = hashlib.sha256(self.settings.encode("utf-8"))
+        if model is not None:
+            digest.update(f"window_model={model}\n".encode("utf-8"))
+        with open(f, "rb") as fh:
+            for block in iter(lambda: fh.read(HASH_BLOCK_SIZE), b""):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def entry(self, key):
+        return self.path / key[:2] / f"{key}{CACHE_SUFFIX}"
+
+    def get(self, key, outfile):
+        """Copy a cached tree to outfile. Returns False on a cache miss."""
+        entry = self.entry(key)
+        try:
+            shutil.copyfile(entry, outfile)
+            os.utime(entry)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def put(self, key, contree):
+        """Store a window's tree. Failing to store a tree does not fail the window."""
+        entry = self.entry(key)
+        tmp_name = None
+        try:
+            entry.parent.mkdir(exist_ok=True)
+            with tempfile.NamedTemporaryFile(dir=entry.parent, suffix=".tmp", delete=False) as tmp:
+                tmp_name = tmp.name
+                with open(contree, "rb") as fh:
+                    shutil.copyfileobj(fh, tmp)
+            # Readers (other workers or runs) only ever see complete entries
+            os.replace(tmp_name, entry)
+        except OSError as e:
+            logger.warning(f"Could not add {contree} to the IQ-TREE cache: {e}")
+            if tmp_name is not None and os.path.exists(tmp_name):
+                os.unlink(tmp_name)
+            return False
+        return True
+
+    def entries(self):
+        return [e for e in self.path.glob(f"*/*{CACHE_SUFFIX}") if e.is_file()]
+
+    def evict(self):
+        """Remove least recently used entries until the cache fits max_bytes. Returns the number removed."""
+        if self.max_bytes is None:
+            return 0
+        entries = []
+        for e in self.entries():
+            try:
+                stat = e.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, e))
+        total = sum(size for _, size, _ in entries)
+        removed = 0
+        for _, size, e in sorted(entries, key=lambda x: x[0]):
+            if total <= self.max_bytes:
+                break
+            try:
+                e.unlink()
+            except FileNotFoundError:
+                pass
+            total -= size
+            removed += 1
+        return removed
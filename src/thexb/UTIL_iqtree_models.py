@@ -0,0 +1,145 @@
+"""
+ModelFinder model reuse - with a model selection option (i.e., -m MFP),
+IQ-TREE reruns ModelFinder in every window. Instead, ModelFinder is run on a
+sample of windows per region of a chromosome and the model chosen most often
+is given to every window of the region.
+
+    region = IQT_MODEL_REGION consecutive windows (0 = whole chromosome)
+    sample = IQT_MODEL_SAMPLE windows spread evenly over the region
+
+Regions re-test the model along the chromosome. Chosen models are stored in
+WORKING_DIR/iqtree_models.json (per model option, sample and region size)
+by region signature - a hash of the region's window ids and the content of
+its sampled windows - so reruns skip ModelFinder only for regions whose
+windows and sampled alignments are unchanged.
+"""
+import hashlib
+import json
+import re
+import subprocess
+import tempfile
+from collections import Counter
+from pathlib import Path
+from shlex import quote
+
+from thexb.UTIL_run_manifest import window_coordinates, window_id
+from thexb.UTIL_scheduler import run_tool
+
+MODELS_NAME = "iqtree_models.json"
+HASH_BLOCK_SIZE = 1 << 20
+# Model options that run ModelFinder -> the option that only runs ModelFinder (no tree search)
+MODEL_SELECTION_OPTIONS = {
+    "MFP": "MF",
+    "MF": "MF",
+    "TESTNEW": "MF",
+    "TEST": "TESTONLY",
+    "TESTONLY": "TESTONLY",
+    "TESTMERGE": "TESTMERGEONLY",
+    "TESTMERGEONLY": "TESTMERGEONLY",
+    "TESTNEWMERGE": "MF+MERGE",
+}
+BEST_MODEL_PATTERN = re.compile(r"Best-fit model[^:]*:\s*(\S+)")
+
+
+############################## Helper Functions ###############################
+def is_model_selection(IQT_MODEL):
+    """True if IQT_MODEL makes IQ-TREE run ModelFinder (i.e., MFP, MFP+MERGE, TEST)"""
+    return IQT_MODEL.split("+")[0].upper() in MODEL_SELECTION_OPTIONS
+
+
+def model_finder_only(IQT_MODEL):
+    """Return the model option that runs IQT_MODEL's model selection without a tree search"""
+    option, *rest = IQT_MODEL.split("+")
+    return "+".join([MODEL_SELECTION_OPTIONS[option.upper()]] + rest)
+
+
+def read_best_model(report):
+    """Return the best-fit model of an IQ-TREE .iqtree or .log file, or None"""
+    match = BEST_MODEL_PATTERN.search(Path(report).read_text())
+    return match.group(1) if match else None
+
+
+def window_order(task):
+    """Sort key of a window along its chromosome"""
+    start, _ = window_coordinates(window_id(task.window.name))
+    return (start is None, start or 0, task.window.name)
+
+
+def model_regions(tasks, IQT_MODEL_REGION):
+    """Split a chromosome's tasks (in chromosome order) into regions of IQT_MODEL_REGION windows"""
+    tasks = sorted(tasks, key=window_order)
+    if not IQT_MODEL_REGION:
+        return [tasks] if tasks else []
+    return [tasks[i:i + IQT_MODEL_REGION] for i in range(0, len(tasks), IQT_MODEL_REGION)]
+
+
+def sample_windows(region, IQT_MODEL_SAMPLE):
+    """Return IQT_MODEL_SAMPLE windows spread evenly over a region"""
+    n = min(IQT_MODEL_SAMPLE, len(region))
+    return [region[int((i + 0.5) * len(region) / n)] for i in range(n)]
+
+
+def region_signature(region, IQT_MODEL_SAMPLE):
+    """Hash of a region's window ids + the content of its sampled windows"""
+    digest = hashlib.sha256()
+    for task in region:
+        digest.update(f"{window_id(task.window.name)}\n".encode("utf-8"))
+    for task in sample_windows(region, IQT_MODEL_SAMPLE):
+        with open(task.window, "rb") as fh:
+            for block in iter(lambda: fh.read(HASH_BLOCK_SIZE), b""):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+def choose_model(models):
+    """Return the model chosen in most sampled windows (first chosen on ties), or None"""
+    models = [m for m in models if m is not None]
+    if not models:
+        return None
+    return Counter(models).most_common(1)[0][0]
+
+
+def modelfinder_task(task, IQT_MODEL, IQT_CORES, IQTREE_PATH):
+    """Run ModelFinder (no tree search) on a window. Returns the best-fit model, or None."""
+    threads = IQT_CORES if task.threads is None else task.threads
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        output_prefix = Path(tmp_dir) / task.window.stem
+        run_tool(
+            [
+                f"{IQTREE_PATH} -nt {threads} -s {quote(task.window.as_posix())} -m {quote(model_finder_only(IQT_MODEL))} -pre {quote(output_prefix.as_posix())} --quiet"
+            ],
+            stderr=subprocess.PIPE,
+        )
+        for suffix in (".iqtree", ".log"):
+            report = Path(f"{output_prefix}{suffix}")
+            if report.exists():
+                model = read_best_model(report)
+                if model is not None:
+                    return model
+    return None
+
+
+############################## Model Store ####################################
+def _models_key(IQT_MODEL, IQT_MODEL_SAMPLE, IQT_MODEL_REGION):
+    return f"{IQT_MODEL}|sample={IQT_MODEL_SAMPLE}|region={IQT_MODEL_REGION}"
+
+
+def load_models(WORKING_DIR, IQT_MODEL, IQT_MODEL_SAMPLE, IQT_MODEL_REGION):
+    """Return {region signature: model} chosen by a previous run with the same settings"""
+    try:
+        models = json.loads((WORKING_DIR / MODELS_NAME).read_text())
+    except (FileNotFoundError, ValueError):
+        return dict()
+    return models.get(_models_key(IQT_MODEL, IQT_MODEL_SAMPLE, IQT_MODEL_REGION), dict())
+
+
+def save_models(WORKING_DIR, IQT_MODEL, IQT_MODEL_SAMPLE, IQT_MODEL_REGION, chosen):
+    """Store {region signature: model} of a run, replacing models stored with the same settings"""
+    path = WORKING_DIR / MODELS_NAME
+    try:
+        models = json.loads(path.read_text())
+    except (FileNotFoundError, ValueError):
+        models = dict()
+    models[_models_key(IQT_MODEL, IQT_MODEL_SAMPLE, IQT_MODEL_REGION)] = chosen
+    path.write_text(json.dumps(models, indent=2))
+    return
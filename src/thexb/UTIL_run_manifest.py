@@ -0,0 +1,210 @@
+"""
+Run manifest - a per-run SQLite database (WORKING_DIR/run_manifest.sqlite)
+recording every window's coordinates, status, drop reason, stage timing and
+output location.
+
+Each stage records one row per window per chromosome once the chromosome is
+done (windows dropped by earlier stages included), along with where it wrote
+the chromosome's windows (a directory or an archive). A later stage looks up
+the stage that wrote the input it is reading, and takes its window list and
+window status from that stage's rows instead of listing the directory for
+"-DROPPED" files - so rows of stages that did not produce the input (i.e.,
+an old pairwise filter run when IQ-TREE is run on Trimal output) are never
+used. Drop-reason reports are a query rather than a log parse. -DROPPED
+files are still written so run directories stay readable by older versions,
+and stages fall back to listing directories + file names when no recorded
+stage wrote their input (i.e., runs without a manifest).
+"""
+import sqlite3
+from collections import namedtuple
+from pathlib import Path
+
+from thexb.UTIL_checks import check_fasta
+from thexb.UTIL_window_archive import ARCHIVE_SUFFIX
+
+MANIFEST_NAME = "run_manifest.sqlite"
+VALID = "valid"
+DROPPED = "dropped"
+
+WindowRecord = namedtuple("WindowRecord", ["window", "status", "reason", "output", "seconds"])
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS windows (
+    stage TEXT NOT NULL,
+    chromosome TEXT NOT NULL,
+    window TEXT NOT NULL,
+    start INTEGER,
+    end INTEGER,
+    status TEXT NOT NULL,
+    reason TEXT,
+    output TEXT,
+    seconds REAL,
+    PRIMARY KEY (stage, chromosome, window)
+)
+"""
+# Where each stage wrote a chromosome's windows (resolved directory or archive path)
+OUTPUTS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS outputs (
+    stage TEXT NOT NULL,
+    chromosome TEXT NOT NULL,
+    location TEXT NOT NULL,
+    PRIMARY KEY (stage, chromosome)
+)
+"""
+
+
+############################## Helper Functions ###############################
+def manifest_path(WORKING_DIR):
+    return WORKING_DIR / MANIFEST_NAME
+
+
+def window_id(name):
+    """Return the window id of a window file name (i.e., chr1_1_100-DROPPED.fasta -> chr1_1_100)"""
+    for suffix in (".fasta", ".contree"):
+        if name.endswith(suffix):
+            name = name[:-len(suffix)]
+    if name.endswith("-DROPPED"):
+        name = name[:-len("-DROPPED")]
+    return name
+
+
+def output_location(output):
+    """Return the location of a window's output - its archive, or the directory holding it"""
+    path = Path(output)
+    location = path if path.suffix == ARCHIVE_SUFFIX else path.parent
+    return location.resolve().as_posix()
+
+
+def window_coordinates(window):
+    """Return (start, end) of a window id, or (None, None) if it can not be parsed"""
+    try:
+        _, start, end = window.rsplit("_", 2)
+        return int(start), int(end)
+    except ValueError:
+        return None, None
+
+
+################################ Run Manifest #################################
+class RunManifest:
+    """Connection to a run's manifest. Safe to open from worker processes."""
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(str(path), timeout=300)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(SCHEMA)
+        self.conn.execute(OUTPUTS_SCHEMA)
+        self.conn.commit()
+
+    def record(self, stage, chromosome, records):
+        """Replace a stage's rows for a chromosome with records (WindowRecord) + record where they were written"""
+        rows = []
+        for r in records:
+            window = window_id(r.window)
+            start, end = window_coordinates(window)
+            rows.append((stage, chromosome, window, start, end, r.status, r.reason, r.output, r.seconds))
+        with self.conn:
+            self.conn.execute("DELETE FROM windows WHERE stage = ? AND chromosome = ?", (stage, chromosome))
+            self.conn.executemany("INSERT INTO windows VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            self.conn.execute("DELETE FROM outputs WHERE stage = ? AND chromosome = ?", (stage, chromosome))
+            if records:
+                self.conn.execute("INSERT INTO outputs VALUES (?, ?, ?)", (stage, chromosome, output_location(records[0].output)))
+
+    def set_output(self, stage, chromosome, output):
+        """Point every window of a stage + chromosome at one output (i.e., an archive)"""
+        with self.conn:
+            self.conn.execute("UPDATE windows SET output = ? WHERE stage = ? AND chromosome = ?", (output, stage, chromosome))
+            self.conn.execute("UPDATE outputs SET location = ? WHERE stage = ? AND chromosome = ?", (output_location(output), stage, chromosome))
+
+    def input_stage(self, chromosome, source):
+        """Return the stage that wrote a chromosome's windows to source (a directory or archive), or None"""
+        cur = self.conn.execute(
+            "SELECT stage FROM outputs WHERE chromosome = ? AND location = ?",
+            (chromosome, Path(source).resolve().as_posix()),
+        )
+        row = cur.fetchone()
+        return None if row is None else row[0]
+
+    def window_outputs(self, stage, chromosome):
+        """Return the output of every window a stage recorded for a chromosome"""
+        cur = self.conn.execute("SELECT output FROM windows WHERE stage = ? AND chromosome = ?", (stage, chromosome))
+        return [row[0] for row in cur.fetchall()]
+
+    def dropped_windows(self, stage, chromosome):
+        """Return {window: reason} of a chromosome's windows a stage recorded as dropped"""
+        cur = self.conn.execute(
+            "SELECT window, reason FROM windows WHERE stage = ? AND chromosome = ? AND status = ?",
+            (stage, chromosome, DROPPED),
+        )
+        return dict(cur.fetchall())
+
+    def drop_report(self, stage):
+        """Return [(chromosome, reason, count)] of windows dropped by a stage"""
+        cur = self.conn.execute(
+            "SELECT chromosome, reason, COUNT(*) FROM windows WHERE stage = ? AND status = ? GROUP BY chromosome, reason ORDER BY chromosome, reason",
+            (stage, DROPPED),
+        )
+        return cur.fetchall()
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def previously_dropped(MANIFEST, chromosome, source):
+    """
+    Return the set of window ids dropped by the stage that wrote a chromosome's
+    windows to source (the directory or archive a stage reads), or None when
+    no recorded stage wrote source and stages should fall back to "-DROPPED"
+    file names.
+    """
+    if MANIFEST is None or not MANIFEST.exists():
+        return None
+    with RunManifest(MANIFEST) as manifest:
+        stage = manifest.input_stage(chromosome, source)
+        if stage is None:
+            return None
+        return set(manifest.dropped_windows(stage, chromosome))
+
+
+def window_files(MANIFEST, chromosome, window_dir):
+    """
+    Return the window files of a chromosome's window directory from the rows of
+    the stage that wrote it, or list the directory when no recorded stage wrote
+    it (i.e., windows extracted from an archive or runs without a manifest).
+    """
+    stage = None
+    if MANIFEST is not None and MANIFEST.exists():
+        with RunManifest(MANIFEST) as manifest:
+            stage = manifest.input_stage(chromosome, window_dir)
+            if stage is not None:
+                outputs = manifest.window_outputs(stage, chromosome)
+    if stage is None:
+        return sorted([f for f in window_dir.iterdir() if check_fasta(f)], key=lambda f: f.name)
+    return sorted([window_dir / Path(o).name for o in outputs], key=lambda f: f.name)
+
+
+def is_dropped(name, dropped):
+    """Check a window's status from the manifest (dropped set) or its file name"""
+    if dropped is None:
+        return "-DROPPED" in name
+    return window_id(name) in dropped
+
+
+def drop_report_lines(MANIFEST, stage):
+    """Return log lines summarising why windows were dropped by a stage"""
+    if MANIFEST is None or not MANIFEST.exists():
+        return []
+    with RunManifest(MANIFEST) as manifest:
+        report = manifest.drop_report(stage)
+    if not report:
+        return []
+    lines = [f"=============== {stage} drop report ==============="]
+    for chromosome, reason, count in report:
+        lines.append(f"{chromosome} | {count} window(s) | Reason: {reason}")
+    return lines
@@ -0,0 +1,274 @@
+"""
+Window scheduler - runs the windows of every chromosome of a stage as one
+task queue, instead of one task per chromosome.
+
+    - Tasks run longest-expected-first (largest window file first), so a
+      large chromosome's windows spread over every worker and small
+      scaffolds fill the gaps at the end of a run.
+    - At most num_cpus tasks run at once. schedule_threaded_tasks() instead
+      runs tasks that use several threads (task.threads) within a budget of
+      cores, backfilling cores a waiting task can not use yet with smaller
+      tasks that will not delay it.
+    - Each task can be given a timeout (seconds) and a number of retries.
+      A task that still fails is returned with its error instead of
+      stopping the stage. External tools started with run_tool() are
+      killed (with any child processes) when their task times out.
+    - Results are streamed back as tasks finish. stream_chromosomes()
+      groups them so a stage can finish + log a chromosome as soon as its
+      last window is done.
+"""
+import itertools
+import os
+import queue
+import signal
+import subprocess
+import threading
+import time
+from collections import Counter, defaultdict, deque, namedtuple
+from functools import partial
+from multiprocessing import Pool
+
+from p_tqdm import p_uimap
+
+from thexb.UTIL_checks import check_fasta
+
+# A window of a chromosome. cost is the expected run time (i.e., window size in bytes),
+# source is the archive the window is read from (None for window files), threads is
+# the number of cores the task uses and model is the window's substitution model (both
+# None when the stage does not set them per task).
+WindowTask = namedtuple("WindowTask", ["chromosome", "window", "outdir", "cost", "source", "threads", "model"], defaults=[None, None, None])
+# result is the task function's return value, or None when error is set
+TaskResult = namedtuple("TaskResult", ["task", "result", "error", "attempts", "seconds"])
+
+
+############################# Custom Exceptions ###############################
+class TaskTimeout(Exception):
+    """Raised in a worker when a task runs longer than its timeout"""
+
+    pass
+
+
+############################## Helper Functions ###############################
+def window_tasks(chromosome, window_dir, outdir, files=None):
+    """Return a task for every window file in window_dir (or every file of files)"""
+    if files is None:
+        files = sorted([f for f in window_dir.iterdir() if check_fasta(f)], key=lambda f: f.name)
+    return [WindowTask(chromosome, f, outdir, f.stat().st_size) for f in files]
+
+
+def describe_error(error):
+    """Return a log-friendly description of a task's error"""
+    if isinstance(error, subprocess.CalledProcessError) and error.stderr:
+        stderr = error.stderr.decode("utf-8") if isinstance(error.stderr, bytes) else error.stderr
+        return stderr.strip()
+    elif isinstance(error, (TaskTimeout, subprocess.TimeoutExpired)):
+        return f"Timed out - {error}"
+    return f"{type(error).__name__}: {error}"
+
+
+def _raise_timeout(TIMEOUT, signum, frame):
+    raise TaskTimeout(f"task ran longer than {TIMEOUT} seconds")
+
+
+def call_with_timeout(func, task, TIMEOUT=None):
+    """
+    Call func(task), raising TaskTimeout after TIMEOUT seconds. Timeouts
+    need SIGALRM (not available on Windows) and are ignored outside of a
+    process's main thread.
+    """
+    use_alarm = (
+        TIMEOUT is not None
+        and hasattr(signal, "SIGALRM")
+        and threading.current_thread() is threading.main_thread()
+    )
+    if not use_alarm:
+        return func(task)
+    previous_handler = signal.signal(signal.SIGALRM, partial(_raise_timeout, TIMEOUT))
+    signal.setitimer(signal.ITIMER_REAL, TIMEOUT)
+    try:
+        return func(task)
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous_handler)
+
+
+def run_tool(command, stderr=None):
+    """
+    Run an external tool's shell command like subprocess.run(check=True).
+    The tool runs in its own process group, which is killed if the task is
+    interrupted (i.e., times out).
+    """
+    with subprocess.Popen(command, shell=True, stderr=stderr, start_new_session=True) as process:
+        try:
+            _, errors = process.communicate()
+        except BaseException:
+            if hasattr(os, "killpg"):
+                os.killpg(process.pid, signal.SIGKILL)
+            else:
+                process.kill()
+            raise
+    if process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, command, stderr=errors)
+    return process
+
+
+def run_task(func, task, TIMEOUT=None, RETRIES=0):
+    """Run func(task) up to RETRIES + 1 times. Returns a TaskResult."""
+    start_time = time.perf_counter()
+    error = None
+    for attempt in range(1, RETRIES + 2):
+        try:
+            result = call_with_timeout(func, task, TIMEOUT)
+            return TaskResult(task, result, None, attempt, time.perf_counter() - start_time)
+        except Exception as e:
+            error = describe_error(e)
+            continue
+    return TaskResult(task, None, error, attempt, time.perf_counter() - start_time)
+
+
+############################### Task Scheduling ###############################
+def schedule_tasks(func, tasks, num_cpus, TIMEOUT=None, RETRIES=0, desc=None):
+    """
+    Run func(task) for each task on at most num_cpus worker processes,
+    longest expected task first. Yields a TaskResult as each task finishes.
+    """
+    tasks = sorted(tasks, key=lambda t: t.cost, reverse=True)
+    if not tasks:
+        return
+    yield from p_uimap(
+        partial(run_task, func, TIMEOUT=TIMEOUT, RETRIES=RETRIES),
+        tasks,
+        num_cpus=max(1, min(num_cpus, len(tasks))),
+        desc=desc,
+    )
+
+
+def task_threads(task, core_budget):
+    return max(1, min(task.threads or 1, core_budget))
+
+
+def reservation(running, head_threads, free_cores, seconds_per_cost):
+    """
+    Return the expected time a task needing head_threads cores can start and
+    the cores it will leave free then. running holds the (start time, task,
+    threads) of each running task.
+    """
+    start = 0.0
+    for end, threads in sorted((t0 + task.cost * seconds_per_cost, threads) for t0, task, threads in running):
+        if free_cores >= head_threads:
+            break
+        free_cores += threads
+        start = end
+    return start, free_cores - head_threads
+
+
+def can_backfill(task, threads, now, seconds_per_cost, start, spare_cores):
+    """
+    A task can run ahead of a waiting task if it is expected to finish before
+    the waiting task's reserved start, or only uses cores it leaves spare.
+    Returns (can run, cores taken from spare_cores).
+    """
+    if now + task.cost * seconds_per_cost <= start:
+        return True, 0
+    if threads <= spare_cores:
+        return True, threads
+    return False, 0
+
+
+def _start_threaded_task(pool, finished, key, func, task, TIMEOUT, RETRIES):
+    """Start a task on pool - its result is queued on finished with its key"""
+    pool.apply_async(
+        run_task,
+        (func, task, TIMEOUT, RETRIES),
+        callback=lambda result: finished.put((key, result)),
+        error_callback=finished.put,
+    )
+
+
+def schedule_threaded_tasks(func, tasks, core_budget, TIMEOUT=None, RETRIES=0):
+    """
+    Run func(task) for each task, longest expected task first, where each task
+    uses task.threads cores. Tasks are started in order as soon as enough of the
+    core_budget is free, so large multi-threaded tasks start first and
+    single-threaded tasks fill the remaining cores. Yields a TaskResult as each
+    task finishes.
+
+    When the next task has to wait for cores, smaller tasks further down the
+    queue are backfilled onto the free cores if they will not delay it (EASY
+    backfilling): the waiting task reserves the time enough running tasks are
+    expected to finish, and a task is backfilled only if it is expected to end
+    before then or uses cores the waiting task will not need. Expected run
+    times are task.cost scaled by the seconds per cost of finished tasks, so
+    nothing is backfilled until the first task finishes.
+    """
+    pending = deque(sorted(tasks, key=lambda t: t.cost, reverse=True))
+    if not pending:
+        return
+    pending_threads = Counter(task_threads(t, core_budget) for t in pending)
+    finished = queue.Queue()
+    free_cores = core_budget
+    # key -> (start time, task, threads) of each running task
+    running = dict()
+    keys = itertools.count()
+    finished_seconds = finished_cost = 0.0
+    with Pool(processes=max(1, min(core_budget, len(pending)))) as pool:
+        while pending or running:
+            now = time.monotonic()
+            starting = []
+            while pending and task_threads(pending[0], core_budget) <= free_cores:
+                task = pending.popleft()
+                free_cores -= task_threads(task, core_budget)
+                starting.append(task)
+            # Backfill - only when a pending task fits the free cores
+            if pending and finished_cost and any(c and n <= free_cores for n, c in pending_threads.items()):
+                seconds_per_cost = finished_seconds / finished_cost
+                start, spare_cores = reservation(running.values(), task_threads(pending[0], core_budget), free_cores, seconds_per_cost)
+                i = 1
+                while i < len(pending) and free_cores:
+                    task = pending[i]
+                    threads = task_threads(task, core_budget)
+                    if threads <= free_cores:
+                        backfill, spare_used = can_backfill(task, threads, now, seconds_per_cost, start, spare_cores)
+                        if backfill:
+                            del pending[i]
+                            free_cores -= threads
+                            spare_cores -= spare_used
+                            starting.append(task)
+                            continue
+                    i += 1
+            for task in starting:
+                key = next(keys)
+                running[key] = (now, task, task_threads(task, core_budget))
+                pending_threads[task_threads(task, core_budget)] -= 1
+                _start_threaded_task(pool, finished, key, func, task, TIMEOUT, RETRIES)
+            result = finished.get()
+            if isinstance(result, BaseException):
+                raise result
+            key, result = result
+            free_cores += running.pop(key)[2]
+            finished_seconds += result.seconds
+            finished_cost += result.task.cost
+            yield result
+
+
+def run_tasks_serially(func, tasks, TIMEOUT=None, RETRIES=0):
+    """Run tasks in the current process - returns a list of TaskResult"""
+    return [run_task(func, task, TIMEOUT, RETRIES) for task in tasks]
+
+
+def stream_chromosomes(results, tasks, chromosomes):
+    """
+    Group streamed TaskResults by chromosome. Yields (chromosome, results)
+    as soon as every task of a chromosome has finished. Chromosomes without
+    tasks are yielded first with no results.
+    """
+    remaining = Counter(t.chromosome for t in tasks)
+    for chromosome in chromosomes:
+        if not remaining[chromosome]:
+            yield chromosome, []
+    finished = defaultdict(list)
+    for r in results:
+        finished[r.task.chromosome].append(r)
+        remaining[r.task.chromosome] -= 1
+        if remaining[r.task.chromosome] == 0:
+            yield r.task.chromosome, finished.pop(r.task.chromosome)
@@ -0,0 +1,131 @@
+"""
+Topology hashing - bins trees with identical topologies (Robinson-Foulds
+distance of 0) by a canonical signature instead of comparing every tree
+against every bin.
+
+Each tree is parsed once (see UTIL_tree_arrays) and reduced to its leaf
+names + the set of its non-trivial bipartitions (leaf bitmasks):
+    rooted   - the leaves below each internal node (clades)
+    unrooted - each edge's split, stored as the side without the first
+               leaf name so both sides of an edge give the same split
+Two trees with the same leaves have an RF distance of 0 exactly when their
+signatures are equal, so binning is a dict lookup per tree. Trees with
+different leaf sets are never binned together.
+
+Near-topology clustering (RF <= max_rf) groups the exact bins, most common
+topology first: each topology joins the closest cluster whose first
+topology is within max_rf, or starts a new cluster. The RF distance of two
+signatures is the size of their symmetric difference, and candidate
+clusters are found with an inverted index from bipartition to cluster, so
+topologies are only compared with clusters they share bipartitions with.
+"""
+from collections import defaultdict
+
+from thexb.UTIL_tree_arrays import parse_tree_column, tree_arrays
+
+
+############################## Helper Functions ###############################
+def signature(arrays, rooted=False):
+    """Return the canonical topology signature of a parsed tree (TreeArrays)"""
+    num_leaves = len(arrays.names)
+    full = (1 << num_leaves) - 1
+    splits = set()
+    # Node 0 is the root
+    for i in range(1, len(arrays.parents)):
+        if arrays.leaf_ids[i] >= 0:
+            continue
+        mask = arrays.splits[i]
+        if rooted:
+            if 1 < bin(mask).count("1") < num_leaves:
+                splits.add(mask)
+        else:
+            if mask & 1:
+                mask = full ^ mask
+            if 1 < bin(mask).count("1") < num_leaves - 1:
+                splits.add(mask)
+    return arrays.names, frozenset(splits)
+
+
+def topology_signature(newick, rooted=False):
+    """Return the canonical topology signature of a newick string"""
+    return signature(tree_arrays(newick), rooted)
+
+
+def _sort_by_count(topologies):
+    return {
+        k: v
+        for k, v in sorted(
+            topologies.items(), key=lambda item: item[1]["count"], reverse=True
+        )
+    }
+
+
+def bin_signatures(trees, rooted=False, cpu_count=1):
+    """Return {signature: {"count": n, "idx": [tree indexes]}} in the order topologies are found"""
+    bins = dict()
+    for n, arrays in enumerate(parse_tree_column(trees, cpu_count)):
+        if arrays is None:
+            continue
+        key = signature(arrays, rooted)
+        if key in bins:
+            bins[key]["count"] += 1
+            bins[key]["idx"].append(n)
+        else:
+            bins[key] = {"count": 1, "idx": [n]}
+    return bins
+
+
+def bin_topologies(trees, rooted=False, cpu_count=1):
+    """
+    Bin trees (newick strings, "NoTree" entries are skipped) by topology. Trees are
+    parsed across cpu_count processes (see UTIL_tree_arrays). Returns
+    {index of the bin's first tree: {"count": n, "idx": [tree indexes]}} sorted by
+    count, largest first - bins with the same count keep the order they were found.
+    """
+    bins = bin_signatures(trees, rooted, cpu_count)
+    return _sort_by_count({b["idx"][0]: b for b in bins.values()})
+
+
+def cluster_topologies(trees, max_rf, rooted=False, cpu_count=1):
+    """
+    Cluster trees whose topology is within an RF distance of max_rf of a cluster's
+    first (most common) topology. Returns clusters in the same form as bin_topologies -
+    max_rf 0 gives the exact bins.
+    """
+    bins = bin_signatures(trees, rooted, cpu_count)
+    # Most common topologies start clusters first
+    ordered = sorted(bins.items(), key=lambda item: item[1]["count"], reverse=True)
+    index = defaultdict(list)  # (leaves, bipartition) -> clusters holding it
+    by_size = defaultdict(list)  # (leaves, number of bipartitions) -> clusters
+    centers = list()
+    clusters = list()
+    for (leaves, splits), b in ordered:
+        shared = defaultdict(int)
+        for split in splits:
+            for c in index[(leaves, split)]:
+                shared[c] += 1
+        # Clusters sharing no bipartitions are only within max_rf when both are small
+        for size in range(0, max_rf - len(splits) + 1):
+            for c in by_size[(leaves, size)]:
+                shared.setdefault(c, 0)
+        best = None
+        for c, n_shared in shared.items():
+            rf = len(splits) + len(centers[c]) - 2 * n_shared
+            if rf <= max_rf and (best is None or (rf, c) < best):
+                best = (rf, c)
+        if best is not None:
+            cluster = clusters[best[1]]
+            cluster["count"] += b["count"]
+            cluster["idx"] += b["idx"]
+            continue
+        c = len(centers)
+        centers.append(splits)
+        clusters.append({"count": b["count"], "idx": list(b["idx"])})
+        for split in splits:
+            index[(leaves, split)].append(c)
+        by_size[(leaves, len(splits))].append(c)
+    topologies = dict()
+    for cluster in clusters:
+        cluster["idx"].sort()
+        topologies[cluster["idx"][0]] = cluster
+    return _sort_by_count(topologies)
@@ -0,0 +1,70 @@
+"""
+Bulk tree processing - parses a TreeViewer "NewickTree" column across a
+process pool (in chunks) into a compact, array-backed form that stages can
+use without parsing the newick strings again.
+
+TreeArrays of a tree with nodes in preorder (node 0 is the root):
+    parents  - parent node index of each node (-1 for the root)
+    lengths  - branch length of each node
+    names    - leaf-name table (sorted leaf names)
+    leaf_ids - index into names of each node (-1 for internal nodes)
+    splits   - bitset (int) of the leaves below each node, over names
+
+"NoTree" entries (and missing values) parse to None. Trees must already be
+in a newick format ete3 can read (i.e., heterotachy info removed).
+"""
+import math
+from collections import namedtuple
+from multiprocessing import Pool
+
+import numpy as np
+from ete3 import Tree
+
+TreeArrays = namedtuple("TreeArrays", ["parents", "lengths", "names", "leaf_ids", "splits"])
+CHUNK_SIZE = 500
+
+
+############################## Helper Functions ###############################
+def is_no_tree(t):
+    """True for "NoTree" entries and missing values (NaN)"""
+    return (t == "NoTree") or (isinstance(t, float) and math.isnan(t)) or (t is None)
+
+
+def tree_arrays(newick):
+    """Parse a newick string into TreeArrays (None for "NoTree")"""
+    if is_no_tree(newick):
+        return None
+    tree = Tree(newick)
+    nodes = list(tree.traverse("preorder"))
+    index = {node: i for i, node in enumerate(nodes)}
+    names = tuple(sorted(n.name for n in nodes if n.is_leaf()))
+    name_ids = {name: i for i, name in enumerate(names)}
+    parents = np.array([index[n.up] if n.up is not None else -1 for n in nodes], dtype=np.int32)
+    lengths = np.array([n.dist for n in nodes], dtype=np.float64)
+    leaf_ids = np.array([name_ids[n.name] if n.is_leaf() else -1 for n in nodes], dtype=np.int32)
+    # Children always come after their parent in preorder - fill bitsets in reverse
+    splits = [0] * len(nodes)
+    for i in range(len(nodes) - 1, -1, -1):
+        if leaf_ids[i] >= 0:
+            splits[i] |= 1 << int(leaf_ids[i])
+        if parents[i] >= 0:
+            splits[parents[i]] |= splits[i]
+    return TreeArrays(parents, lengths, names, leaf_ids, tuple(splits))
+
+
+def map_trees(func, trees, cpu_count=1, chunksize=CHUNK_SIZE):
+    """
+    Return [func(t) for t in trees], run across cpu_count processes in chunks of
+    chunksize trees. Columns of fewer than two chunks run in the current process.
+    func must be picklable (a module function or a partial of one).
+    """
+    trees = list(trees)
+    if (cpu_count or 1) <= 1 or len(trees) < 2 * chunksize:
+        return [func(t) for t in trees]
+    with Pool(processes=min(cpu_count, math.ceil(len(trees) / chunksize))) as pool:
+        return pool.map(func, trees, chunksize=chunksize)
+
+
+def parse_tree_column(trees, cpu_count=1, chunksize=CHUNK_SIZE):
+    """Parse a column of newick strings into a list of TreeArrays (None for "NoTree")"""
+    return map_trees(tree_arrays, trees, cpu_count, chunksize)
@@ -0,0 +1,162 @@
+"""
+Packed window archive - one file per chromosome per stage holding the
+concatenated fasta text of every window, plus an offset index.
+
+    windowed_fastas/
+        chr1.windows        <- window alignments back to back
+        chr1.windows.idx    <- name, offset, length (tab separated)
+
+Window names are the file names the window would otherwise be written to
+(i.e., chr1_1_100000.fasta or chr1_1_100000-DROPPED.fasta), so stages treat
+an archived window exactly like a window file. Archives replace a directory
+of per-window files (and their .fai indexes) with two files, and stages read
+windows from them directly. Only windows passed to an external tool (Trimal,
+IQ-TREE) are extracted, to a temporary directory.
+"""
+import tempfile
+from collections import namedtuple
+from contextlib import contextmanager
+from pathlib import Path
+
+from thexb.UTIL_checks import check_fasta
+
+ARCHIVE_SUFFIX = ".windows"
+INDEX_SUFFIX = ".idx"
+
+# A window inside an archive - used where stages expect a window file
+ArchivedWindow = namedtuple("ArchivedWindow", ["archive", "name"])
+
+
+############################## Helper Functions ###############################
+def is_window_archive(path):
+    return (path.suffix == ARCHIVE_SUFFIX) and path.is_file()
+
+
+def archive_path(outdir, chromosome):
+    """Return the archive file of a chromosome in a stage's output directory"""
+    return outdir / f"{chromosome}{ARCHIVE_SUFFIX}"
+
+
+def index_path(path):
+    return path.parent / f"{path.name}{INDEX_SUFFIX}"
+
+
+def parse_fasta_text(text):
+    """Return {header: sequence} of fasta formatted text"""
+    records = dict()
+    header = None
+    seq = []
+    for line in text.splitlines():
+        if line.startswith(">"):
+            if header is not None:
+                records[header] = "".join(seq)
+            header = (line[1:].split() or [""])[0]
+            seq = []
+        elif header is not None:
+            seq.append(line.strip())
+    if header is not None:
+        records[header] = "".join(seq)
+    return records
+
+
+############################### Archive Classes ###############################
+class WindowArchiveWriter:
+    """Append windows to a new archive. The index is written on close()."""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.names = []
+        self._index = []
+        self._offset = 0
+        self._fh = open(self.path, "wb")
+
+    def add(self, name, text):
+        data = text.encode("utf-8")
+        self._fh.write(data)
+        self._index.append(f"{name}\t{self._offset}\t{len(data)}\n")
+        self.names.append(name)
+        self._offset += len(data)
+
+    def close(self):
+        if self._fh.closed:
+            return
+        self._fh.close()
+        with open(index_path(self.path), "w") as oh:
+            oh.write("".join(self._index))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class WindowArchive:
+    """Read windows from an archive by name"""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.chromosome = self.path.stem
+        self.index = dict()
+        with open(index_path(self.path)) as fh:
+            for line in fh:
+                name, offset, length = line.rstrip("\n").split("\t")
+                self.index[name] = (int(offset), int(length))
+        self._fh = None
+
+    def names(self):
+        """Window names in archive order"""
+        return list(self.index.keys())
+
+    def read(self, name):
+        """Return the fasta text of a window"""
+        offset, length = self.index[name]
+        if self._fh is None:
+            self._fh = open(self.path, "rb")
+        self._fh.seek(offset)
+        return self._fh.read(length).decode("utf-8")
+
+    def records(self, name):
+        """Return {header: sequence} of a window"""
+        return parse_fasta_text(self.read(name))
+
+    def extract(self, outdir, names=None):
+        """Write windows (all by default) to outdir as individual fasta files"""
+        outdir.mkdir(parents=True, exist_ok=True)
+        names = self.names() if names is None else names
+        for name in names:
+            with open(outdir / name, "w") as oh:
+                oh.write(self.read(name))
+        return [outdir / name for name in names]
+
+    def close(self):
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def pack_window_dir(window_dir, path):
+    """Pack a directory of window files into an archive. Returns the archive names."""
+    files = sorted([f for f in window_dir.iterdir() if check_fasta(f)], key=lambda f: f.name)
+    with WindowArchiveWriter(path) as writer:
+        for f in files:
+            writer.add(f.name, f.read_text())
+    return writer.names
+
+
+@contextmanager
+def extracted_windows(path):
+    """
+    Extract an archive to a temporary chromosome directory (named after the
+    chromosome) for stages that run an external tool on window files.
+    """
+    with WindowArchive(path) as archive, tempfile.TemporaryDirectory() as tmp_dir:
+        window_dir = Path(tmp_dir) / archive.chromosome
+        archive.extract(window_dir)
+        yield window_dir
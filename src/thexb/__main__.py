@@ -12,6 +12,7 @@ from thex.version import __version__
 
 # --- Toolkit util imports ---
 from thexb.UTIL_converters import convert_window_size_to_int
+from thexb.UTIL_gap_trimmer import TRIMAL_ENGINES
 from thexb.UTIL_help_descriptions import HelpDesc
 
 # --- Toolkit pipeline stage imports ---
@@ -212,6 +213,12 @@ def main():
         help=HelpDesc().fasta_windowing(),
         default=False,
     )
+    tv_pipeline.add_argument(
+        "--window_archive",
+        action="store_true",
+        help=HelpDesc().window_archive(),
+        default=False,
+    )
     tv_pipeline.add_argument(
         "--trimal",
         action="store_true",
@@ -312,6 +319,14 @@ def main():
         help=HelpDesc().trimal_dropwindows(),
         default=True,
     )
+    tv_trimal_opts.add_argument(
+        "--trimal_engine",
+        type=str,
+        action="store",
+        choices=TRIMAL_ENGINES,
+        help=HelpDesc().trimal_engine(),
+        default="trimal",
+    )
     # Pairwise estimator
     tv_pw_estimator_opts.add_argument(
         "--pwe_percent_chrom",
@@ -321,6 +336,14 @@ def main():
         default=0.1,
         metavar="\b",
     )
+    tv_pw_estimator_opts.add_argument(
+        "--pwe_ci_width",
+        type=float,
+        action="store",
+        help=HelpDesc().pwe_ci_width(),
+        default=0.01,
+        metavar="\b",
+    )
     # Pairwise filter
     tv_pw_filter_opts.add_argument(
         "--pw_subwindow_size",
@@ -411,12 +434,52 @@ def main():
         default="AUTO",
         metavar="\b",
     )
+    tv_iqtree_opts.add_argument(
+        "--iqtree_cache",
+        type=str,
+        action="store",
+        help=HelpDesc().iqtree_cache(),
+        default=None,
+        metavar="\b",
+    )
+    tv_iqtree_opts.add_argument(
+        "--iqtree_cache_max_mb",
+        type=float,
+        action="store",
+        help=HelpDesc().iqtree_cache_max_mb(),
+        default=1024,
+        metavar="\b",
+    )
+    tv_iqtree_opts.add_argument(
+        "--iqtree_model_sample",
+        type=int,
+        action="store",
+        help=HelpDesc().iqtree_model_sample(),
+        default=0,
+        metavar="\b",
+    )
+    tv_iqtree_opts.add_argument(
+        "--iqtree_model_region",
+        type=int,
+        action="store",
+        help=HelpDesc().iqtree_model_region(),
+        default=0,
+        metavar="\b",
+    )
+    tv_iqtree_opts.add_argument(
+        "--iqtree_batch_size",
+        type=int,
+        action="store",
+        help=HelpDesc().iqtree_batch_size(),
+        default=1,
+        metavar="\b",
+    )
     tv_iqtree_opts.add_argument(
         "--tv_file_name",
         type=str,
         action="store",
         help=HelpDesc().tv_file_name(),
-        default="TreeViewer_input_file.xlsx",
+        default="TreeViewer_input_file.parquet",
         metavar="\b",
     )
     # Topobinner
@@ -429,6 +492,14 @@ def main():
         choices=["Y", "N"],
         metavar="\b",
     )
+    tv_topobinner_opts.add_argument(
+        "--tb_max_rf",
+        type=int,
+        action="store",
+        help=HelpDesc().tb_max_rf(),
+        default=0,
+        metavar="\b",
+    )
     # p-distance calculator
     pdist_pipeline.add_argument(
         "--pdistance",
@@ -436,6 +507,26 @@ def main():
         help=HelpDesc().pdistance(),
         default=False,
     )
+    pdist_pipeline.add_argument(
+        "--pdistance-matrix",
+        action="store_true",
+        help=HelpDesc().pdistance_matrix(),
+        default=False,
+    )
+    pdist_pipeline.add_argument(
+        "--pdist-step",
+        type=str,
+        action="store",
+        metavar="\b",
+        help=HelpDesc().pdistance_step(),
+        default=None,
+    )
+    pdist_pipeline.add_argument(
+        "--pdist-parquet",
+        action="store_true",
+        help=HelpDesc().pdistance_parquet(),
+        default=False,
+    )
     pdist_pipeline.add_argument(
         "--pdist_filename",
         type=str,
@@ -489,6 +580,22 @@ def main():
         default=os.cpu_count(),
         metavar="\b",
     )
+    sys_options.add_argument(
+        "--task_timeout",
+        type=float,
+        action="store",
+        help=HelpDesc().task_timeout(),
+        default=None,
+        metavar="\b",
+    )
+    sys_options.add_argument(
+        "--task_retries",
+        type=int,
+        action="store",
+        help=HelpDesc().task_retries(),
+        default=0,
+        metavar="\b",
+    )
     # Progam options
     program_options.add_argument(
         "--trimal-path",
@@ -516,6 +623,7 @@ def main():
     # --- Stages ---
     ALL_STEPS = args.tv_all
     MINIFASTAS = args.minifastas
+    WINDOW_ARCHIVE = args.window_archive
     TRIMAL = args.trimal
     PW_ESTIMATOR = args.pw_estimator
     PW_FILTER = args.pw_filter
@@ -527,6 +635,7 @@ def main():
     TRIMAL_MIN_SEQ_LEN = str(args.trimal_min_seq_len)
     TRIMAL_DROP_WINDOWS = args.trimal_drop_windows
     TRIMAL_THRESH = float(args.trimal_gap_threshold)
+    TRIMAL_ENGINE = args.trimal_engine
     PW_WINDOW_SIZE = str(args.pw_subwindow_size)
     PW_STEP = str(args.pw_step)
     PW_MIN_SEQ_LEN = str(args.pw_min_seq_len)
@@ -536,10 +645,17 @@ def main():
     PW_MISSING_CHAR = str(args.pw_missing_char)
     PW_EXCLUDE_LIST = str(args.pw_exclude)
     PW_EST_PERCENT_CHROM = float(args.pwe_percent_chrom)
+    PW_EST_CI_WIDTH = float(args.pwe_ci_width)
     IQT_MODEL = str(args.iqtree_model)
     IQT_BOOTSTRAP = int(args.iqtree_bootstrap)
     IQT_CORES = str(args.iqtree_cpu_cores)
+    IQT_CACHE_DIR = Path(args.iqtree_cache) if args.iqtree_cache else None
+    IQT_CACHE_MAX_MB = args.iqtree_cache_max_mb
+    IQT_BATCH_SIZE = int(args.iqtree_batch_size)
+    IQT_MODEL_SAMPLE = int(args.iqtree_model_sample)
+    IQT_MODEL_REGION = int(args.iqtree_model_region)
     TOPOBIN_ROOTED = args.tb_rooted_trees
+    TOPOBIN_MAX_RF = int(args.tb_max_rf)
     # --- Tree Viewer Toolkit inputs ---
     PARSE_TREEVIEWER_FILE = args.parse_treeviewer
     # PARSIMONY = args.parsimony_summary
@@ -547,6 +663,9 @@ def main():
     TV_OUTGROUP_REMOVE = args.keep_paraphyletic
     # --- p-distance ---
     P_DISTANCE = args.pdistance
+    PDIST_MATRIX = args.pdistance_matrix
+    PDIST_STEP = args.pdist_step
+    PDIST_PARQUET = args.pdist_parquet
     REFERENCE = args.reference
     PDIST_THRESHOLD = float(args.pdist_threshold)
     PDIST_MISSING_CHAR = str(args.pdist_missing_character)
@@ -557,6 +676,8 @@ def main():
     CONFIG_FILE = args.config
     LOG_LEVEL = args.log_level
     MULTIPROCESS = args.cpu
+    TASK_TIMEOUT = args.task_timeout
+    TASK_RETRIES = args.task_retries
     # --- Additional Tools ---
     CONFIG_TEMPLATE = args.tv_config_template
     # --- Program paths ---
@@ -620,9 +741,12 @@ def main():
             print(
                 "Invalid input for Multiprocess option. Value must an integer 1-n, where n is the total number of cores available"
             )
+        TASK_TIMEOUT = config.getfloat("Processing", "task_timeout", fallback=TASK_TIMEOUT)
+        TASK_RETRIES = config.getint("Processing", "task_retries", fallback=TASK_RETRIES)
 
         WINDOW_SIZE_STR = config["Fasta Windower"]["window_size"]
         WINDOW_SIZE_INT = convert_window_size_to_int(WINDOW_SIZE_STR)
+        WINDOW_ARCHIVE = config.getboolean("Fasta Windower", "window_archive", fallback=WINDOW_ARCHIVE)
 
         # Trimal
         TRIMAL_THRESH = float(config["Trimal"]["gap_threshold"])
@@ -630,6 +754,7 @@ def main():
             config["Trimal"]["minimum_seq_length"]
         )
         TRIMAL_DROP_WINDOWS = bool(config["Trimal"]["drop_windows"])
+        TRIMAL_ENGINE = config.get("Trimal", "engine", fallback=TRIMAL_ENGINE)
 
         # Pairwise Filtering Input Variables
         PW_WINDOW_SIZE = str(config["Pairwise Filter"]["filter_window_size"])
@@ -652,11 +777,18 @@ def main():
         PW_EST_PERCENT_CHROM = float(
             config["Pairwise Estimator"]["percent_of_chromosome_to_run"]
         )
+        PW_EST_CI_WIDTH = config.getfloat("Pairwise Estimator", "ci_width", fallback=PW_EST_CI_WIDTH)
 
         # IQ-TREE Input Variables
         IQT_MODEL = str(config["IQ-TREE"]["model"])
         IQT_BOOTSTRAP = int(config["IQ-TREE"]["bootstrap"])
         IQT_CORES = str(config["IQ-TREE"]["cores_per_job"])
+        if config.get("IQ-TREE", "cache_dir", fallback=""):
+            IQT_CACHE_DIR = Path(config.get("IQ-TREE", "cache_dir"))
+        IQT_CACHE_MAX_MB = config.getfloat("IQ-TREE", "cache_max_mb", fallback=IQT_CACHE_MAX_MB)
+        IQT_BATCH_SIZE = config.getint("IQ-TREE", "batch_size", fallback=IQT_BATCH_SIZE)
+        IQT_MODEL_SAMPLE = config.getint("IQ-TREE", "model_sample", fallback=IQT_MODEL_SAMPLE)
+        IQT_MODEL_REGION = config.getint("IQ-TREE", "model_region", fallback=IQT_MODEL_REGION)
 
         # TopoBin Input Variables - [Y/N]
         TOPOBIN_ROOTED = str(config["Topobinner"]["rooted_trees"])
@@ -670,6 +802,7 @@ def main():
         except InvalidIQTREERoot:
             print(f"ERROR: Topobinner 'rooted_trees' input can only be Y or N")
             exit(1)
+        TOPOBIN_MAX_RF = config.getint("Topobinner", "max_rf", fallback=TOPOBIN_MAX_RF)
 
         # ====================================================================
         # Check log level input + return log level int
@@ -767,7 +900,7 @@ def main():
     try:
         # ====================================================================
         # --- p-Distance Tracer Pipeline ---
-        if P_DISTANCE:
+        if P_DISTANCE or PDIST_MATRIX:
             # Input/output
             pdistance_output_dir = WORKING_DIR / "p-distance/"
             pdistance_output_dir.mkdir(parents=True, exist_ok=True)
@@ -780,9 +913,10 @@ def main():
                     "Invalid log level - Provide NOTSET, DEBUG, INFO, WARNING, ERROR, or CRITICAL"
                 )
 
+            PDIST_STEP_INT = convert_window_size_to_int(PDIST_STEP) if PDIST_STEP else None
             # Make sure all required input variables are valid
             try:
-                if not REFERENCE:
+                if (not REFERENCE) and (not PDIST_MATRIX):
                     raise AssertionError
             except AssertionError:
                 print("ERROR: No reference (-r, --reference) sample provided")
@@ -796,8 +930,13 @@ def main():
             logger.info(f"Input directory: {INPUT.as_posix()}")
             logger.info(f"Output directory: {pdistance_output_dir.as_posix()}")
             logger.info(f"Output file name: {PDIST_FILENAME}")
-            logger.info(f"Reference sample: {REFERENCE}")
+            logger.info(f"Parquet output: {PDIST_PARQUET}")
+            if PDIST_MATRIX:
+                logger.info(f"Mode: All-vs-all pairwise matrix")
+            else:
+                logger.info(f"Reference sample: {REFERENCE}")
             logger.info(f"Window size: {WINDOW_SIZE_STR}")
+            logger.info(f"Step size: {PDIST_STEP if PDIST_STEP else WINDOW_SIZE_STR}")
             logger.info(f"Missing data threshold: {PDIST_THRESHOLD}")
             logger.info(f"Missing data character: {PDIST_MISSING_CHAR}")
             logger.info(f"Ignore missing data: {PDIST_IGNORE_N}")
@@ -811,8 +950,11 @@ def main():
                 REFERENCE,
                 WORKING_DIR,
                 WINDOW_SIZE_INT,
+                PDIST_STEP_INT,
                 PDIST_IGNORE_N,
                 PDIST_REF_SUFFIX,
+                PDIST_MATRIX,
+                PDIST_PARQUET,
                 MULTIPROCESS,
                 LOG_LEVEL,
             )
@@ -851,6 +993,7 @@ def main():
                 TV_OUTGROUP_REMOVE,
                 WORKING_DIR,
                 LOG_LEVEL,
+                cpu_count=MULTIPROCESS,
             )
 
         # --- Tree Viewer Pipeline ---
@@ -887,12 +1030,14 @@ def main():
             logger.info(f"Input directory: {INPUT.as_posix()}")
             logger.info(f"Output directory: {outdir.as_posix()}")
             logger.info(f"Window size: {WINDOW_SIZE_STR}")
+            logger.info(f"Packed window archive: {WINDOW_ARCHIVE}")
             logger.info("------------------------------------")
             fasta_windower(
                 INPUT,
                 WORKING_DIR,
                 WINDOW_SIZE_STR,
                 WINDOW_SIZE_INT,
+                WINDOW_ARCHIVE,
                 MULTIPROCESS,
                 LOG_LEVEL,
             )
@@ -913,6 +1058,7 @@ def main():
             logger.info(f"Gap threshold: {TRIMAL_THRESH}")
             logger.info(f"Minimum post-trimal sequence length: {TRIMAL_MIN_LENGTH}")
             logger.info(f"Drop windows with missing samples: {TRIMAL_DROP_WINDOWS}")
+            logger.info(f"Trimming engine: {TRIMAL_ENGINE}")
             logger.info("------------------------------------")
             trimal(
                 windowed_fasta_dir,
@@ -924,6 +1070,9 @@ def main():
                 TRIMAL_PATH,
                 MULTIPROCESS,
                 LOG_LEVEL,
+                TRIMAL_ENGINE,
+                TASK_TIMEOUT,
+                TASK_RETRIES,
             )
             pass
 
@@ -940,9 +1089,16 @@ def main():
             logger.info(f"Input directory: {filtered_indir.as_posix()}")
             logger.info(f"Reference sample: {PW_REF}")
             logger.info(f"Percentage of chromosome sampled: {PW_EST_PERCENT_CHROM}")
+            logger.info(f"Confidence interval width: {PW_EST_CI_WIDTH}")
             logger.info("------------------------------------")
             pairwise_estimator(
-                filtered_indir, PW_REF, PW_EST_PERCENT_CHROM, WORKING_DIR, LOG_LEVEL
+                filtered_indir,
+                PW_EST_PERCENT_CHROM=PW_EST_PERCENT_CHROM,
+                PW_REF=PW_REF,
+                WORKING_DIR=WORKING_DIR,
+                LOG_LEVEL=LOG_LEVEL,
+                PW_EST_CI_WIDTH=PW_EST_CI_WIDTH,
+                cpu_count=MULTIPROCESS,
             )
             pass
 
@@ -992,6 +1148,8 @@ def main():
                 PW_MISSING_CHAR,
                 MULTIPROCESS,
                 LOG_LEVEL,
+                TASK_TIMEOUT,
+                TASK_RETRIES,
             )
             pass
 
@@ -1031,6 +1189,12 @@ def main():
             logger.info(f"Model: {IQT_MODEL}")
             logger.info(f"Number of bootstraps: {IQT_BOOTSTRAP}")
             logger.info(f"Number of cores per run: {IQT_CORES}")
+            if IQT_CACHE_DIR is not None:
+                logger.info(f"IQ-TREE cache: {IQT_CACHE_DIR.as_posix()} (max {IQT_CACHE_MAX_MB} MB)")
+            if IQT_BATCH_SIZE > 1:
+                logger.info(f"Windows per IQ-TREE run: {IQT_BATCH_SIZE}")
+            if IQT_MODEL_SAMPLE:
+                logger.info(f"ModelFinder windows sampled per region: {IQT_MODEL_SAMPLE} (windows per region: {IQT_MODEL_REGION or 'whole chromosome'})")
             logger.info("------------------------------------")
             iq_tree(
                 filtered_indir,
@@ -1043,6 +1207,13 @@ def main():
                 IQTREE_PATH,
                 MULTIPROCESS,
                 LOG_LEVEL,
+                TASK_TIMEOUT,
+                TASK_RETRIES,
+                IQT_CACHE_DIR,
+                IQT_CACHE_MAX_MB,
+                IQT_BATCH_SIZE,
+                IQT_MODEL_SAMPLE,
+                IQT_MODEL_REGION,
             )
             pass
 
@@ -1074,13 +1245,14 @@ def main():
                 TREEVIEWER_FN,
                 WORKING_DIR,
                 LOG_LEVEL,
+                cpu_count=MULTIPROCESS,
             )
             pass
 
         if TOPOBIN:
             # Input/Output
             TREEVIEWER_FN = INPUT if (INPUT) and (not CONFIG_FILE) else TREEVIEWER_FN
-            UPDATED_TV_FILENAME = WORKING_DIR / f"{TREEVIEWER_FN.stem}.topobinner.xlsx"
+            UPDATED_TV_FILENAME = WORKING_DIR / f"{TREEVIEWER_FN.stem}.topobinner{TREEVIEWER_FN.suffix}"
             logger.info("")
             logger.info("=======================================")
             logger.info("========== Topology Binning =========== ")
@@ -1090,6 +1262,8 @@ def main():
             logger.info(f"Tree Viewer file: {TREEVIEWER_FN}")
             logger.info(f"Topobinned output file: {UPDATED_TV_FILENAME}")
             logger.info(f"Trees rooted?: {TOPOBIN_ROOTED}")
+            if TOPOBIN_MAX_RF:
+                logger.info(f"Maximum RF distance within a topology cluster: {TOPOBIN_MAX_RF}")
             logger.info("------------------------------------")
             topobinner(
                 TREEVIEWER_FN,
@@ -1097,6 +1271,8 @@ def main():
                 TOPOBIN_ROOTED,
                 WORKING_DIR,
                 LOG_LEVEL,
+                cpu_count=MULTIPROCESS,
+                TOPOBIN_MAX_RF=TOPOBIN_MAX_RF,
             )
 
         if PHYBIN: